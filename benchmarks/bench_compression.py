@@ -0,0 +1,79 @@
+"""Measure compressing reports with gzip, xz and bz2 at each level.
+
+First each codec compresses a report that's already in memory, at every
+level, for its throughput (in MB of XML a second) and how small it gets.
+Then the whole conversion is timed writing straight to a compressed file,
+with the compression on the background thread and then inline, to show how
+much of the compression is hidden behind building the ballots (which needs
+more than one core).
+
+Run from the top of the repo:
+
+    python -m benchmarks.bench_compression [--file county.csv] [--codecs gz,xz]
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+
+from castvoterecords import EssCsvReader, write_report, open_compressed
+from castvoterecords.compression import CODECS, _codec_file
+from convert_to_cvr import fall18_wd9, fall18_wd9_cvr_report
+
+LEVELS = {'.gz': range(1, 10), '.xz': range(0, 10), '.bz2': range(1, 10)}
+_CHUNK = 1 << 20
+
+
+def report_bytes(path, indent):
+	out = io.BytesIO()
+	with open(path, newline='') as f:
+		write_report(out, fall18_wd9_cvr_report, EssCsvReader(f, fall18_wd9).cvrs(compact=True), indent)
+	return out.getvalue()
+
+
+def time_level(data, suffix, level):
+	out = io.BytesIO()
+	start = time.perf_counter()
+	with _codec_file(CODECS[suffix], out, 'wb', level) as stream:
+		for i in range(0, len(data), _CHUNK):
+			stream.write(data[i:i + _CHUNK])
+	return time.perf_counter() - start, len(out.getvalue())
+
+
+def time_conversion(csv_path, path, indent, background):
+	start = time.perf_counter()
+	with open(csv_path, newline='') as f, open_compressed(path, 'wb', background=background) as out:
+		write_report(out, fall18_wd9_cvr_report, EssCsvReader(f, fall18_wd9).cvrs(compact=True), indent)
+	return time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark report compression at each level, and background vs inline compression')
+	parser.add_argument("--file", help="ESS CSV to convert. Default is ward9_fall18.csv", default="ward9_fall18.csv")
+	parser.add_argument("--codecs", help="Comma-separated suffixes to try. Default is gz,xz,bz2", default="gz,xz,bz2")
+	parser.add_argument("--no-indent", help="Benchmark reports without indentation", action="store_true")
+	args = parser.parse_args()
+	indent = None if args.no_indent else '  '
+	suffixes = ['.' + codec.strip('.') for codec in args.codecs.split(',')]
+
+	data = report_bytes(args.file, indent)
+	mb = len(data) / 1e6
+	print('{:.1f} MB of XML'.format(mb))
+	for suffix in suffixes:
+		for level in LEVELS[suffix]:
+			seconds, size = time_level(data, suffix, level)
+			print('{} level {}: {:6.1f} MB/s, {:8,} bytes, {:5.1f}x smaller'.format(suffix, level, mb / seconds, size, len(data) / size))
+
+	with tempfile.TemporaryDirectory() as directory:
+		plain = time_conversion(args.file, os.path.join(directory, 'report.xml'), indent, True)
+		print('convert, uncompressed: {:.2f}s'.format(plain))
+		for suffix in suffixes:
+			path = os.path.join(directory, 'report.xml' + suffix)
+			inline = time_conversion(args.file, path, indent, False)
+			background = time_conversion(args.file, path, indent, True)
+			print('convert, {} at the default level: {:.2f}s inline, {:.2f}s on the background thread'.format(suffix, inline, background))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,62 @@
+"""Compare tabulating a BallotTable with NumPy and with a Counter.
+
+Both ways have to give the same totals, which is checked first, on the
+Ward 9 ballots and on a made-up contest with 126 selections - the most an
+int8 column holds - where every code turns up.
+
+Run from the top of the repo:
+
+    python -m benchmarks.bench_tabulate [--repeat N]
+"""
+import argparse
+import time
+
+from castvoterecords import BallotTable, CandidateContest, CandidateSelection, Candidate, Election, tabulate
+from castvoterecords.table import UNDERVOTE, OVERVOTE, WRITE_IN, NOT_ON_BALLOT
+from convert_to_cvr import fall18_wd9
+
+
+def wide_table(selections=126, ballots=10000):
+	candidates = [Candidate(id='_wide_{}'.format(i), name='Candidate {}'.format(i)) for i in range(selections)]
+	contest = CandidateContest(id='_Contest_wide', name='Wide', contest_selections=[
+		CandidateSelection(candidate=candidate, id='_sel' + candidate.id) for candidate in candidates])
+	election = Election(id='_wide', name='Wide', candidates=candidates, contests=[contest])
+	table = BallotTable(election)
+	codes = list(range(selections)) + [UNDERVOTE, OVERVOTE, WRITE_IN, NOT_ON_BALLOT]
+	for i in range(ballots):
+		table.append_codes('_cvr_{}'.format(i), [codes[i % len(codes)]])
+	return table
+
+
+def check(table):
+	with_numpy = tabulate(table, use_numpy=True)
+	with_counter = tabulate(table, use_numpy=False)
+	for contest_id, tally in with_counter.items():
+		assert with_numpy[contest_id] == tally, contest_id
+
+
+def time_tabulate(table, use_numpy, repeat):
+	start = time.perf_counter()
+	for _ in range(repeat):
+		tabulate(table, use_numpy)
+	return time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark tabulating a BallotTable with NumPy vs a Counter')
+	parser.add_argument("--file", help="ESS CSV to take ballots from. Default is ward9_fall18.csv", default="ward9_fall18.csv")
+	parser.add_argument("--repeat", help="Times to tabulate each table. Default is 20", type=int, default=20)
+	args = parser.parse_args()
+
+	with open(args.file, newline='') as f:
+		ward9 = BallotTable.from_ess_csv(fall18_wd9, f)
+	for name, table in (('ward 9', ward9), ('126 selections', wide_table())):
+		check(table)
+		counter = time_tabulate(table, False, args.repeat)
+		numpy = time_tabulate(table, True, args.repeat)
+		print('{}: {:,} ballots, Counter {:.4f}s, NumPy {:.4f}s, {:.1f}x faster'.format(
+			name, len(table), counter / args.repeat, numpy / args.repeat, counter / numpy))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,43 @@
+"""Compare serializing CVRs through to_xml() with the precomputed templates.
+
+Run from the top of the repo:
+
+    python -m benchmarks.bench_templates [--repeat N]
+"""
+import argparse
+import time
+
+from castvoterecords import EssCsvReader, cvr_to_string
+from convert_to_cvr import fall18_wd9
+
+
+def time_serializer(cvrs, indent, fast, repeat):
+	start = time.perf_counter()
+	for _ in range(repeat):
+		for cvr in cvrs:
+			cvr_to_string(cvr, indent, fast)
+	return time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark CVR serialization: to_xml() vs templates')
+	parser.add_argument("--file", help="ESS CSV to take ballots from. Default is ward9_fall18.csv", default="ward9_fall18.csv")
+	parser.add_argument("--repeat", help="Times to serialize every ballot. Default is 5", type=int, default=5)
+	args = parser.parse_args()
+
+	with open(args.file, newline='') as f:
+		cvrs = list(EssCsvReader(f, fall18_wd9).cvrs())
+
+	for indent in ('  ', None):
+		for cvr in cvrs:
+			assert cvr_to_string(cvr, indent, True) == cvr_to_string(cvr, indent, False)
+
+		ballots = len(cvrs) * args.repeat
+		slow = time_serializer(cvrs, indent, False, args.repeat)
+		fast = time_serializer(cvrs, indent, True, args.repeat)
+		print('indent={!r}: to_xml {:,.0f} ballots/s, templates {:,.0f} ballots/s, {:.1f}x faster'.format(
+			indent, ballots / slow, ballots / fast, slow / fast))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,122 @@
+"""Make synthetic ESS CSVs and CVR reports of any size from the Ward 9 data.
+
+Each column of the generated CSV is sampled independently, with the
+frequencies of the values in that column of ward9_fall18.csv, so the
+contests, candidates and under/over/write-in rates match the real data.
+The same seed always gives the same ballots.
+
+Run from the top of the repo:
+
+    python -m benchmarks.generate 1000000 --output county.csv
+"""
+import argparse
+import csv
+from collections import Counter
+from itertools import accumulate
+import random
+import sys
+
+from castvoterecords import CastVoteRecordReport, EssPlan
+from castvoterecords.ess import CVR_NUMBER_COLUMN
+from convert_to_cvr import fall18_wd9, fall18_wd9_cvr_report
+
+WARD9_CSV = 'ward9_fall18.csv'
+SIZES = (10000, 100000, 1000000, 5000000)
+
+# rows are sampled a batch at a time, which is much faster than one cell at a time
+_BATCH = 10000
+
+
+class BallotModel:
+	"""The header and per-column value frequencies of an ESS CSV."""
+
+	def __init__(self, header, frequencies):
+		self.header = header
+		# one (values, cumulative weights) pair per column, None for the ballot number
+		self.frequencies = frequencies
+
+	@classmethod
+	def from_csv(cls, path=WARD9_CSV):
+		with open(path, newline='') as f:
+			rows = csv.reader(f)
+			header = next(rows)
+			counters = [Counter() for _ in header]
+			for row in rows:
+				for counter, value in zip(counters, row):
+					counter[value] += 1
+
+		frequencies = []
+		for name, counter in zip(header, counters):
+			if name == CVR_NUMBER_COLUMN:
+				frequencies.append(None)
+			else:
+				values, counts = zip(*sorted(counter.items()))
+				frequencies.append((values, list(accumulate(counts))))
+		return cls(header, frequencies)
+
+	def rows(self, count, seed=0, first_number=1):
+		"""Yield count CSV rows (lists of strings), numbered from first_number."""
+		rng = random.Random(seed)
+		number = first_number
+		while count > 0:
+			batch = min(count, _BATCH)
+			columns = []
+			for frequencies in self.frequencies:
+				if frequencies is None:
+					columns.append([str(n) for n in range(number, number + batch)])
+				else:
+					values, cum_weights = frequencies
+					if len(values) == 1:
+						columns.append(values * batch)
+					else:
+						columns.append(rng.choices(values, cum_weights=cum_weights, k=batch))
+			for row in zip(*columns):
+				yield list(row)
+			number += batch
+			count -= batch
+
+
+def write_csv(f, count, model=None, seed=0):
+	"""Write a synthetic ESS CSV with count ballots to the text file f."""
+	model = model or BallotModel.from_csv()
+	writer = csv.writer(f, lineterminator='\n')
+	writer.writerow(model.header)
+	writer.writerows(model.rows(count, seed))
+
+
+def generate_cvrs(count, model=None, seed=0, election=fall18_wd9, compact=False):
+	"""Yield count synthetic CVRs for election, without going through a file."""
+	model = model or BallotModel.from_csv()
+	plan = EssPlan(model.header, election)
+	return plan.cvrs(model.rows(count, seed), compact=compact)
+
+
+def generate_report(count, model=None, seed=0):
+	"""A Ward 9 CastVoteRecordReport holding count synthetic CVRs.
+
+	Everything is in memory, so this is for the sizes where to_xml() is
+	still an option; stream generate_cvrs() into write_report() otherwise.
+	"""
+	template = fall18_wd9_cvr_report
+	return CastVoteRecordReport(cvrs=list(generate_cvrs(count, model, seed)), election=template.election,
+		gp_unit=template.gp_unit, reporting_device=template.reporting_device, parties=template.parties)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Write a synthetic ESS CSV modelled on the Ward 9 data')
+	parser.add_argument("ballots", help="How many ballots to generate, e.g. {}".format(', '.join(str(n) for n in SIZES)), type=int)
+	parser.add_argument("--output", help="File to write the CSV to. Default is stdout", default="-")
+	parser.add_argument("--seed", help="Random seed. Default is 0", type=int, default=0)
+	parser.add_argument("--file", help="ESS CSV to model the ballots on. Default is " + WARD9_CSV, default=WARD9_CSV)
+	args = parser.parse_args()
+
+	model = BallotModel.from_csv(args.file)
+	if args.output == '-':
+		write_csv(sys.stdout, args.ballots, model, args.seed)
+	else:
+		with open(args.output, 'w', newline='') as f:
+			write_csv(f, args.ballots, model, args.seed)
+
+
+if __name__ == '__main__':
+	main()
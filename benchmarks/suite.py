@@ -0,0 +1,199 @@
+"""Time each stage of the CVR pipeline on synthetic data of several sizes.
+
+For each size a CSV is generated (see benchmarks.generate), then each stage
+runs in a fresh process so its peak memory isn't mixed up with the others:
+
+    csv_to_cvr   read the CSV into CVR objects
+    write        stream the CVRs to an XML report (the precomputed templates)
+    write_to_xml the same through to_xml(), one Element tree per CVR
+    prettify     build the whole report with to_xml() and pretty-print it
+    read         read the report back a CVR at a time
+    tabulate     count the votes straight from the CSV through a BallotTable
+    validate     validate.py --stream (needs lxml)
+
+Results are JSON, so runs can be compared between releases. Run from the
+top of the repo:
+
+    python -m benchmarks.suite --sizes 10000,100000 --output results.json
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from benchmarks.generate import BallotModel, write_csv, SIZES
+from castvoterecords import peak_rss
+
+STAGES = ('csv_to_cvr', 'write', 'write_to_xml', 'prettify', 'read', 'tabulate', 'validate')
+# stages that hold the whole report in memory are skipped past this many ballots by default
+IN_MEMORY_STAGES = ('prettify',)
+XSD = 'NIST_V0_cast_vote_records.xsd'
+
+
+def _csv_to_cvr(csv_path, xml_path):
+	from castvoterecords import EssCsvReader
+	from convert_to_cvr import fall18_wd9
+	with open(csv_path, newline='') as f:
+		for _ in EssCsvReader(f, fall18_wd9).cvrs(compact=True):
+			pass
+
+
+def _write(csv_path, xml_path, fast=True):
+	from castvoterecords import EssCsvReader, write_report
+	from convert_to_cvr import fall18_wd9, fall18_wd9_cvr_report
+	with open(csv_path, newline='') as f, open(xml_path, 'wb') as out:
+		write_report(out, fall18_wd9_cvr_report, EssCsvReader(f, fall18_wd9).cvrs(compact=True), fast=fast)
+
+
+def _write_to_xml(csv_path, xml_path):
+	_write(csv_path, os.devnull, fast=False)
+
+
+def _prettify(csv_path, xml_path):
+	from castvoterecords import EssCsvReader
+	from convert_to_cvr import fall18_wd9, fall18_wd9_cvr_report
+	from utils import prettify
+	report = fall18_wd9_cvr_report
+	with open(csv_path, newline='') as f:
+		report.cvrs = list(EssCsvReader(f, fall18_wd9).cvrs())
+	prettify(report.to_xml())
+
+
+def _read(csv_path, xml_path):
+	from castvoterecords import CastVoteRecordReportReader
+	for _ in CastVoteRecordReportReader(xml_path):
+		pass
+
+
+def _tabulate(csv_path, xml_path):
+	from castvoterecords import BallotTable, tabulate
+	from convert_to_cvr import fall18_wd9
+	with open(csv_path, newline='') as f:
+		tabulate(BallotTable.from_ess_csv(fall18_wd9, f))
+
+
+def _validate(csv_path, xml_path):
+	from validate import validate_streaming
+	with contextlib.redirect_stdout(io.StringIO()):
+		if not validate_streaming(xml_path, XSD):
+			raise ValueError('{} is not valid'.format(xml_path))
+
+
+_STAGE_FUNCTIONS = {
+	'csv_to_cvr': _csv_to_cvr,
+	'write': _write,
+	'write_to_xml': _write_to_xml,
+	'prettify': _prettify,
+	'read': _read,
+	'tabulate': _tabulate,
+	'validate': _validate,
+}
+
+
+def _run_stage(stage, csv_path, xml_path):
+	# runs in its own process: the imports are done first so they don't count towards the stage
+	import castvoterecords
+	import convert_to_cvr
+	baseline = peak_rss()
+	start = time.perf_counter()
+	_STAGE_FUNCTIONS[stage](csv_path, xml_path)
+	seconds = time.perf_counter() - start
+	return seconds, baseline, peak_rss()
+
+
+def run_stage(stage, csv_path, xml_path):
+	"""Run one stage in a new process, returning (seconds, baseline RSS, peak RSS)."""
+	context = multiprocessing.get_context('spawn')
+	with ProcessPoolExecutor(1, mp_context=context) as executor:
+		return executor.submit(_run_stage, stage, csv_path, xml_path).result()
+
+
+def run(sizes, stages, seed=0, in_memory_limit=100000, workdir=None, log=sys.stderr):
+	"""Run the stages at each size and return the results as a JSON-ready dict."""
+	model = BallotModel.from_csv()
+	results = []
+	if workdir:
+		os.makedirs(workdir, exist_ok=True)
+	with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+		for size in sizes:
+			csv_path = os.path.join(tmp, 'ballots_{}.csv'.format(size))
+			xml_path = os.path.join(tmp, 'ballots_{}.xml'.format(size))
+
+			start = time.perf_counter()
+			with open(csv_path, 'w', newline='') as f:
+				write_csv(f, size, model, seed)
+			print('{:>9,} ballots: generated in {:.1f}s'.format(size, time.perf_counter() - start), file=log)
+
+			for stage in stages:
+				if stage in IN_MEMORY_STAGES and in_memory_limit and size > in_memory_limit:
+					print('{:>9,} ballots: {:<12} skipped, over --in-memory-limit'.format(size, stage), file=log)
+					continue
+				if stage in ('read', 'validate') and not os.path.exists(xml_path):
+					# read and validate need the report the write stage makes
+					_write(csv_path, xml_path)
+				try:
+					seconds, baseline, peak = run_stage(stage, csv_path, xml_path)
+				except ImportError as e:
+					print('{:>9,} ballots: {:<12} skipped, {}'.format(size, stage, e), file=log)
+					continue
+
+				result = {
+					'stage': stage,
+					'ballots': size,
+					'seconds': round(seconds, 4),
+					'ballots_per_second': round(size / seconds, 1) if seconds else None,
+					'peak_rss_bytes': peak,
+					'peak_rss_over_baseline_bytes': peak - baseline if peak is not None else None,
+				}
+				if stage == 'write' and os.path.exists(xml_path):
+					result['output_bytes'] = os.path.getsize(xml_path)
+				results.append(result)
+				print('{:>9,} ballots: {:<12} {:8.2f}s {:>12,.0f} ballots/s {:>8} MB peak'.format(
+					size, stage, seconds, size / seconds if seconds else 0,
+					'-' if peak is None else '{:.0f}'.format(peak / 2 ** 20)), file=log)
+
+	return {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'cpus': os.cpu_count(),
+		'seed': seed,
+		'results': results,
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark each stage of the CVR pipeline on synthetic ballots')
+	parser.add_argument("--sizes", help="Comma-separated ballot counts. Default is 10000,100000; the full set is " + ','.join(str(n) for n in SIZES),
+		default="10000,100000")
+	parser.add_argument("--stages", help="Comma-separated stages to run. Default is all of " + ','.join(STAGES), default=','.join(STAGES))
+	parser.add_argument("--seed", help="Random seed for the ballots. Default is 0", type=int, default=0)
+	parser.add_argument("--in-memory-limit", help="Skip stages that hold the whole report in memory past this many ballots (0 for no limit). Default is 100000",
+		type=int, default=100000)
+	parser.add_argument("--workdir", help="Directory for the generated files. Default is the system temp directory")
+	parser.add_argument("--output", help="File to write the JSON results to. Default is stdout", default="-")
+	args = parser.parse_args()
+
+	sizes = [int(size) for size in args.sizes.split(',')]
+	stages = args.stages.split(',')
+	for stage in stages:
+		if stage not in STAGES:
+			parser.error('unknown stage {!r}'.format(stage))
+
+	results = run(sizes, stages, args.seed, args.in_memory_limit, args.workdir)
+	if args.output == '-':
+		json.dump(results, sys.stdout, indent=2)
+		print()
+	else:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,20 @@
+from castvoterecords import build_index, index_path_for
+
+import argparse
+import sys
+import time
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Index where each CVR is in an existing NIST CVR XML report, in one pass, so castvoterecords.IndexedReport can fetch ballots by UniqueId or position')
+	parser.add_argument("report", help="The report to index. It has to be uncompressed")
+	parser.add_argument("--output", help="Where to write the index. Default is the report's name with .idx added")
+	args = parser.parse_args()
+
+	started = time.perf_counter()
+	count = build_index(args.report, args.output)
+	print('Indexed {} CVRs into {} in {:.1f}s'.format(count, args.output or index_path_for(args.report), time.perf_counter() - started), file=sys.stderr)
+
+
+if __name__ == '__main__':
+	main()
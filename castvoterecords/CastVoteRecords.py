@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import List
 from enum import Enum
 import xml.etree.ElementTree as ET
@@ -52,6 +52,14 @@ class Code:
 
 		return code_element
 
+	def to_json(self):
+		code = {'@type': 'CVR.Code', 'Type': self.code_type.value, 'Value': self.value}
+		if self.label:
+			code['Label'] = self.label
+		if self.other_type:
+			code['OtherType'] = self.other_type
+		return code
+
 @dataclass
 class Party:
 	id: str = None
@@ -67,9 +75,12 @@ class Party:
 
 		name_element = ET.SubElement(party_element, 'Name')
 		name_element.text = self.name
-		
+
 		return party_element
 
+	def to_json(self):
+		return {'@type': 'CVR.Party', '@id': self.id, 'Abbreviation': self.abbreviation, 'Name': self.name}
+
 @dataclass
 class Candidate:
 	id: str = None
@@ -88,14 +99,27 @@ class Candidate:
 			party_id_element.text = self.party.id
 		return candidate_element
 
+	def to_json(self):
+		candidate = {'@type': 'CVR.Candidate', '@id': self.id}
+		if self.code:
+			candidate['Code'] = [self.code.to_json()]
+		if self.name:
+			candidate['Name'] = self.name
+		if self.party:
+			candidate['PartyId'] = self.party.id
+		return candidate
+
 @dataclass
 class ContestSelection:
 	id: str = None
 	code: Code = None
-	
+
 	def to_xml(self):
 		raise NotImplemented
 
+	def to_json(self):
+		raise NotImplementedError
+
 @dataclass
 class BallotMeasureSelection(ContestSelection):
 	selection: str = None
@@ -109,6 +133,9 @@ class BallotMeasureSelection(ContestSelection):
 
 		return ballot_measure_sel_element
 
+	def to_json(self):
+		return {'@type': 'CVR.BallotMeasureSelection', '@id': self.id, 'Selection': self.selection}
+
 @dataclass
 class CandidateSelection(ContestSelection):
 	candidate: Candidate = None
@@ -127,6 +154,18 @@ class CandidateSelection(ContestSelection):
 
 		return candidate_sel_element
 
+	def to_json(self):
+		candidate_sel = {'@type': 'CVR.CandidateSelection', '@id': self.id, 'CandidateIds': [self.candidate.id]}
+		if self.is_write_in:
+			candidate_sel['IsWriteIn'] = True
+		return candidate_sel
+
+def selection_name(selection):
+	"""The text a ballot uses for a selection - the candidate's name, or Yes/No for a measure."""
+	if isinstance(selection, CandidateSelection):
+		return selection.candidate.name if selection.candidate else None
+	return selection.selection
+
 @dataclass
 class Contest:
 	id: str = None
@@ -136,10 +175,48 @@ class Contest:
 	vote_variation: VoteVariation = None
 	other_vote_variation: str = None	
 	contest_selections: List[ContestSelection] = None
-	
+	# built on first lookup; see _selection_indexes()
+	_indexes: tuple = field(default=None, init=False, repr=False, compare=False)
+
 	def to_xml(self):
 		raise NotImplemented
 
+	def to_json(self):
+		raise NotImplementedError
+
+	def _json_members(self, contest):
+		# the members both kinds of contest have
+		if self.abbreviation:
+			contest['Abbreviation'] = self.abbreviation
+		if self.code:
+			contest['Code'] = [self.code.to_json()]
+		contest['ContestSelection'] = [sel.to_json() for sel in self.contest_selections]
+		contest['Name'] = self.name
+		if self.vote_variation:
+			contest['VoteVariation'] = self.vote_variation.value
+		return contest
+
+	def _selection_indexes(self):
+		# Rebuilt if contest_selections is replaced or changes length. If you swap
+		# selections in place, call invalidate_indexes() yourself.
+		selections = self.contest_selections or ()
+		key = (id(self.contest_selections), len(selections))
+		if self._indexes is None or self._indexes[0] != key:
+			by_id = {sel.id: sel for sel in selections}
+			by_name = {selection_name(sel): sel for sel in selections}
+			self._indexes = (key, by_id, by_name)
+		return self._indexes
+
+	def invalidate_indexes(self):
+		self._indexes = None
+
+	def selection_by_id(self, selection_id):
+		return self._selection_indexes()[1][selection_id]
+
+	def selection_by_name(self, name):
+		"""Find a selection by candidate name (or Yes/No for a ballot measure)."""
+		return self._selection_indexes()[2][name]
+
 @dataclass
 class BallotMeasureContest(Contest):
 	#
@@ -162,6 +239,9 @@ class BallotMeasureContest(Contest):
 
 		return contest_element
 
+	def to_json(self):
+		return self._json_members({'@type': 'CVR.BallotMeasureContest', '@id': self.id})
+
 @dataclass
 class CandidateContest(Contest):
 	number_elected: int = 1 
@@ -191,6 +271,12 @@ class CandidateContest(Contest):
 
 		return contest_element
 
+	def to_json(self):
+		contest = self._json_members({'@type': 'CVR.CandidateContest', '@id': self.id})
+		contest['NumberElected'] = self.number_elected
+		contest['VotesAllowed'] = self.votes_allowed
+		return contest
+
 @dataclass
 class CVRContestSelection:
 	id: str = None
@@ -214,6 +300,14 @@ class CVRContestSelection:
 
 		return cvr_contest_selection_element
 
+	def to_json(self):
+		return {
+			'@type': 'CVR.CVRContestSelection',
+			'ContestSelectionId': self.contest_selection.id,
+			'SelectionPosition': [{'@type': 'CVR.SelectionPosition', 'HasIndication': 'yes', 'IsAllocable': 'yes', 'NumberVotes': 1}],
+			'TotalNumberVotes': 1,
+		}
+
 @dataclass
 class CVRContest:
 	id: str = None
@@ -253,6 +347,23 @@ class CVRContest:
 
 		return cvr_contest_element
 
+	def to_json(self):
+		cvr_contest = {'@type': 'CVR.CVRContest', 'ContestId': self.contest.id}
+		if self.cvr_contest_selection:
+			cvr_contest['CVRContestSelection'] = [cvr_contest_sel.to_json() for cvr_contest_sel in self.cvr_contest_selection]
+		status = []
+		if self.overvotes:
+			cvr_contest['Overvotes'] = self.overvotes
+			status.append(ContestStatus.OVERVOTED.value)
+		if self.undervotes:
+			status.append(ContestStatus.UNDERVOTED.value)
+			cvr_contest['Undervotes'] = self.undervotes
+		if status:
+			cvr_contest['Status'] = status
+		if self.writeins:
+			cvr_contest['WriteIns'] = self.writeins
+		return cvr_contest
+
 @dataclass
 class CVRSnapshot:
 	id: str = None
@@ -271,6 +382,13 @@ class CVRSnapshot:
 		cvr_snapshot_type_element.text = CVRType.ORIGINAL.value
 		return cvr_snapshot_element
 
+	def to_json(self):
+		cvr_snapshot = {'@type': 'CVR.CVRSnapshot', '@id': self.id}
+		if self.cvr_contests:
+			cvr_snapshot['CVRContest'] = [cvr_contest.to_json() for cvr_contest in self.cvr_contests]
+		cvr_snapshot['Type'] = CVRType.ORIGINAL.value
+		return cvr_snapshot
+
 @dataclass
 class GpUnit:
 	code: Code = None
@@ -289,7 +407,15 @@ class GpUnit:
 		gp_type_element = ET.SubElement(gp_unit_element, 'Type')
 		gp_type_element.text = self.gp_type.value
 
-		return gp_unit_element	
+		return gp_unit_element
+
+	def to_json(self):
+		gp_unit = {'@type': 'CVR.GpUnit', '@id': self.id}
+		if self.code:
+			gp_unit['Code'] = [self.code.to_json()]
+		gp_unit['Name'] = self.name
+		gp_unit['Type'] = self.gp_type.value
+		return gp_unit
 
 @dataclass
 class Election:
@@ -299,7 +425,75 @@ class Election:
 	candidates: List[Candidate] = None
 	contests: List[Contest] = None
 	election_scope: GpUnit = None
+	# built on first lookup; see _lookup_indexes()
+	_indexes: dict = field(default=None, init=False, repr=False, compare=False)
 	
+	def _lookup_indexes(self):
+		# Rebuilt if contests or candidates is replaced or changes length. If you
+		# change them in place any other way, call invalidate_indexes() yourself.
+		contests = self.contests or ()
+		candidates = self.candidates or ()
+		key = (id(self.contests), len(contests), id(self.candidates), len(candidates))
+		if self._indexes is not None and self._indexes['key'] == key:
+			return self._indexes
+
+		indexes = {'key': key, 'shape': self._selections_shape(), 'contests': {}, 'selections': {}, 'candidates': {}, 'parties': {}}
+		for contest in contests:
+			indexes['contests'][contest.id] = contest
+			for sel in contest.contest_selections or ():
+				indexes['selections'][sel.id] = (contest, sel)
+			party = getattr(contest, 'party', None)
+			if party is not None:
+				indexes['parties'][party.id] = party
+		for candidate in candidates:
+			indexes['candidates'][candidate.id] = candidate
+			if candidate.party is not None:
+				indexes['parties'][candidate.party.id] = candidate.party
+		self._indexes = indexes
+		return indexes
+
+	def _selections_shape(self):
+		return tuple((id(contest.contest_selections), len(contest.contest_selections or ())) for contest in self.contests or ())
+
+	def _selection_entry(self, selection_id):
+		entry = self._lookup_indexes()['selections'].get(selection_id)
+		if entry is not None:
+			# make sure the contest still has it, in case its selections were edited in place
+			contest, sel = entry
+			if contest._selection_indexes()[1].get(selection_id) is sel:
+				return entry
+		elif self._indexes['shape'] == self._selections_shape():
+			raise KeyError(selection_id)
+
+		# a contest's selections have changed since we built the index
+		self.invalidate_indexes()
+		return self._lookup_indexes()['selections'][selection_id]
+
+	def invalidate_indexes(self):
+		self._indexes = None
+		for contest in self.contests or ():
+			contest.invalidate_indexes()
+
+	def contest_by_id(self, contest_id):
+		return self._lookup_indexes()['contests'][contest_id]
+
+	def selection_by_id(self, selection_id):
+		return self._selection_entry(selection_id)[1]
+
+	def contest_for_selection(self, selection_id):
+		"""The Contest a ContestSelection id belongs to."""
+		return self._selection_entry(selection_id)[0]
+
+	def selection_by_name(self, contest_id, name):
+		return self.contest_by_id(contest_id).selection_by_name(name)
+
+	def candidate_by_id(self, candidate_id):
+		return self._lookup_indexes()['candidates'][candidate_id]
+
+	def party_by_id(self, party_id):
+		"""Find one of the parties the election's candidates and contests refer to."""
+		return self._lookup_indexes()['parties'][party_id]
+
 	def to_xml(self):
 		election_element = ET.Element('Election')
 		election_element.set('ObjectId', self.id)
@@ -315,6 +509,18 @@ class Election:
 
 		return election_element
 
+	def to_json(self):
+		election = {
+			'@type': 'CVR.Election',
+			'@id': self.id,
+			'Candidate': [candidate.to_json() for candidate in self.candidates],
+			'Contest': [contest.to_json() for contest in self.contests],
+			'ElectionScopeId': self.election_scope.id,
+		}
+		if self.name:
+			election['Name'] = self.name
+		return election
+
 @dataclass
 class CVR:
 	id: str = None
@@ -334,6 +540,15 @@ class CVR:
 		cvr_unique_id_element.text = self.id
 		return cvr_element
 
+	def to_json(self):
+		return {
+			'@type': 'CVR.CVR',
+			'CurrentSnapshotId': self.cvr_snapshot[0].id,
+			'CVRSnapshot': [self.cvr_snapshot[0].to_json()],
+			'ElectionId': self.election.id,
+			'UniqueId': self.id,
+		}
+
 @dataclass
 class ReportingDevice:
 	id: str = None
@@ -352,6 +567,14 @@ class ReportingDevice:
 
 		return reporting_device_element
 
+	def to_json(self):
+		reporting_device = {'@type': 'CVR.ReportingDevice', '@id': self.id}
+		if self.model:
+			reporting_device['Model'] = self.model
+		if self.notes:
+			reporting_device['Notes'] = self.notes
+		return reporting_device
+
 
 
 @dataclass
@@ -365,35 +588,80 @@ class CastVoteRecordReport:
 	version: str = '1.0.0'
 	reporting_device: ReportingDevice = None
 
-	def to_xml(self):
-		cvr_data = []
-		election_data = self.election.to_xml()
+	def root_element(self):
 		cvr_report = ET.Element('CastVoteRecordReport')
 		cvr_report.set("xmlns", "NIST_V0_cast_vote_records.xsd")
 		cvr_report.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
-		for cvr in self.cvrs:
-			cvr_report.append(cvr.to_xml())
-
-		election_element = self.election.to_xml()
-		cvr_report.append(election_element)
+		return cvr_report
 
-		generated_date_element = ET.SubElement(cvr_report, 'GeneratedDate')
-		generated_date_element.text = datetime.datetime.now(datetime.timezone.utc).isoformat()
+	def trailer_elements(self):
+		# Everything the schema sequence puts after the CVRs, in order. A merged
+		# report can have several Elections, GpUnits and ReportingDevices.
+		for election in _as_list(self.election):
+			yield election.to_xml()
 
-		gpunit_element = self.gp_unit.to_xml()
-		cvr_report.append(gpunit_element)
+		generated_date_element = ET.Element('GeneratedDate')
+		generated_date_element.text = self.generatedDate or datetime.datetime.now(datetime.timezone.utc).isoformat()
+		yield generated_date_element
 
-		for party in self.parties:
-			cvr_report.append(party.to_xml())
+		for gp_unit in _as_list(self.gp_unit):
+			yield gp_unit.to_xml()
 
+		for party in self.parties or ():
+			yield party.to_xml()
 
-		report_generating_device_ids_element = ET.SubElement(cvr_report, 'ReportGeneratingDeviceIds')
-		report_generating_device_ids_element.text = self.reporting_device.id 
+		devices = _as_list(self.reporting_device)
+		report_generating_device_ids_element = ET.Element('ReportGeneratingDeviceIds')
+		report_generating_device_ids_element.text = ' '.join(device.id for device in devices)
+		yield report_generating_device_ids_element
 
-		reporting_device_element = self.reporting_device.to_xml()
-		cvr_report.append(reporting_device_element)
+		for device in devices:
+			yield device.to_xml()
 
-		version_element = ET.SubElement(cvr_report, 'Version')
+		version_element = ET.Element('Version')
 		version_element.text = self.version
+		yield version_element
 
+	def to_xml(self):
+		cvr_report = self.root_element()
+		for cvr in self.cvrs:
+			cvr_report.append(cvr.to_xml())
+
+		for element in self.trailer_elements():
+			cvr_report.append(element)
+
+		return cvr_report
+
+	def json_metadata(self):
+		"""Everything but the CVRs, as the members of a JSON CastVoteRecordReport.
+
+		JSON members aren't ordered by the schema, so these go before the CVR
+		array, where a streaming reader sees them first.
+		"""
+		metadata = {
+			'@type': 'CVR.CastVoteRecordReport',
+			'Election': [election.to_json() for election in _as_list(self.election)],
+			'GeneratedDate': self.generatedDate or datetime.datetime.now(datetime.timezone.utc).isoformat(),
+			'GpUnit': [gp_unit.to_json() for gp_unit in _as_list(self.gp_unit)],
+		}
+		if self.notes:
+			metadata['Notes'] = self.notes
+		metadata['Party'] = [party.to_json() for party in self.parties or ()]
+		devices = _as_list(self.reporting_device)
+		metadata['ReportGeneratingDeviceIds'] = [device.id for device in devices]
+		metadata['ReportingDevice'] = [device.to_json() for device in devices]
+		metadata['Version'] = self.version
+		return metadata
+
+	def to_json(self):
+		cvr_report = self.json_metadata()
+		cvr_report['CVR'] = [cvr.to_json() for cvr in self.cvrs or ()]
 		return cvr_report
+
+def _as_list(items):
+	# the reader gives a list when a report has more than one Election/GpUnit/ReportingDevice
+	if items is None:
+		return []
+	if isinstance(items, list):
+		return items
+	return [items]
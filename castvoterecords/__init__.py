@@ -1 +1,23 @@
-from .CastVoteRecords import Code, Candidate, Party, IdentifierType, Contest, CandidateContest, VoteVariation, CandidateSelection, ContestSelection, CVRContest, CVRContestSelection, CVRSnapshot, CVR, GpUnit, Election, ReportingUnitType, CastVoteRecordReport, ReportingDevice, BallotMeasureContest, BallotMeasureSelection, AllocationStatus
+from .CastVoteRecords import Code, Candidate, Party, IdentifierType, Contest, CandidateContest, VoteVariation, CandidateSelection, ContestSelection, CVRContest, CVRContestSelection, CVRSnapshot, CVR, GpUnit, Election, ReportingUnitType, CastVoteRecordReport, ReportingDevice, BallotMeasureContest, BallotMeasureSelection, AllocationStatus, selection_name
+from .writer import CastVoteRecordReportWriter, write_report, cvr_to_string
+from .serialize import element_to_string, write_xml
+from .reader import CastVoteRecordReportReader, read_report
+from .jsonwriter import CastVoteRecordReportJsonWriter, write_json_report, cvr_to_json
+from .jsonreader import CastVoteRecordReportJsonReader, read_json_report, report_from_json
+from .table import BallotTable, SparseBallotTable, UNDERVOTE, OVERVOTE, WRITE_IN, NOT_ON_BALLOT
+from .tabulate import ContestTally, RunningTally, tabulate, tabulate_cvrs, tabulate_ess_rows
+from .parallel import parallel_cvr_fragments
+from .ess import EssPlan, EssCsvReader, BallotStyle
+from .templates import CVRTemplates
+from .compact import CompactCVR, CompactCVRContest, CompactCVRContestSelection, CompactCVRSnapshot, CVRContestPool
+from .scan import ReportScanner, CVRFragment
+from .metrics import Metrics, NullMetrics, NULL_METRICS, peak_rss
+from .archive import CVRArchive, CVRArchiveWriter, write_archive, xml_to_archive, archive_to_xml
+from .sqlite import CVRDatabase, write_sqlite
+from .append import AppendConflict, ReportAppender, append_cvrs
+from .merge import MergeConflict, merge_metadata, merge_reports, read_report_metadata
+from .integrity import IntegrityChecker, IntegrityProblem, HashedIds, check_report, check_ess_csv
+from .shard import subset_election, subset_report, write_ess_shards
+from .compression import BackgroundCompressor, codec_for, open_compressed
+from .pipeline import Pipeline, StageStats, report_pipeline
+from .index import IndexedReport, ReportIndexBuilder, build_index, index_path_for
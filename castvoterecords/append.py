@@ -0,0 +1,226 @@
+from io import BytesIO
+import json
+import os
+import re
+
+from .CastVoteRecords import _as_list
+from .reader import CastVoteRecordReportReader
+from .scan import ReportScanner, fragment_unique_id, _ROOT_START_TAG, _OBJECT_ID
+from .writer import cvr_to_string
+
+# where the trailer starts: the Election, which the schema puts straight after the last CVR
+_ELECTION_START = re.compile(rb'<Election[\s>]')
+
+STATE_SUFFIX = '.append.json'
+IDS_SUFFIX = '.ids'
+
+
+class AppendConflict(ValueError):
+	"""A CVR can't go in the report: its ids are already used there, or it refers to something the report's Election doesn't have."""
+
+
+class ReportAppender:
+	"""Adds CVRs to an existing report file without rewriting the ones already in it.
+
+	New <CVR> elements go in just before the Election, which is where the
+	schema wants them, so an append only has to rewrite the trailer (the
+	Election and the rest of the report metadata), however big the report
+	is. The offset the trailer starts at is kept in a small state file next
+	to the report (path + '.append.json'), along with the trailer itself,
+	and the UniqueIds and ObjectIds already used in the report are kept one
+	CVR per line in path + '.ids', which appends only ever add to. The first
+	append to a report without these files scans it with ReportScanner to
+	make them.
+
+	append() rejects a CVR whose UniqueId or snapshot ObjectId is already in
+	the report (or earlier in the same batch), or which refers to an
+	Election, Contest or ContestSelection the report doesn't have, so the
+	file stays schema-valid. A rejected or interrupted append is rolled back
+	to the report as it was before it, either straight away or the next time
+	the report is opened.
+
+	New CVRs are written in the layout the report already has, indented or
+	not.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.state_path = path + STATE_SUFFIX
+		self.ids_path = path + IDS_SUFFIX
+		self.state = self._load_state()
+		if self.state is None:
+			self.state = self._scan()
+		elif self.state['pending']:
+			self._rollback()
+
+		self.unique_ids = set()
+		self.object_ids = set(self.state['object_ids'])
+		with open(self.ids_path, 'rb') as f:
+			for line in f.read(self.state['ids_size']).splitlines():
+				ids = json.loads(line)
+				self.unique_ids.add(ids[0])
+				self.object_ids.update(ids[1:])
+
+		report = self.report()
+		self.elections = {election.id: election for election in _as_list(report.election)}
+
+	def __len__(self):
+		return self.state['count']
+
+	def __contains__(self, unique_id):
+		return unique_id in self.unique_ids
+
+	def _load_state(self):
+		try:
+			with open(self.state_path) as f:
+				state = json.load(f)
+		except FileNotFoundError:
+			return None
+		if not os.path.exists(self.ids_path):
+			return None
+		if state['pending']:
+			return state
+		# if something other than this class has changed the report, start again from the file
+		with open(self.path, 'rb') as f:
+			if f.seek(0, os.SEEK_END) != state['size']:
+				return None
+			f.seek(state['insert_offset'])
+			if f.read() != state['trailer'].encode('utf-8'):
+				return None
+		return state
+
+	def _save_state(self):
+		temporary = self.state_path + '.tmp'
+		with open(temporary, 'w') as f:
+			json.dump(self.state, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temporary, self.state_path)
+
+	def _scan(self):
+		with open(self.path, 'rb') as f:
+			scanner = ReportScanner(f)
+			with open(self.ids_path, 'wb') as ids:
+				for fragment in scanner:
+					ids.write(_ids_line(fragment_unique_id(fragment.data), [m.decode('utf-8') for m in _OBJECT_ID.findall(fragment.data)]))
+				ids_size = ids.tell()
+			size = f.seek(0, os.SEEK_END)
+
+		tail = scanner.tail
+		match = _ELECTION_START.search(tail)
+		if match is None:
+			raise ValueError('{} has no Election after its CVRs'.format(self.path))
+		# back up over the Election's indentation, so new CVRs go in at the start of its line
+		start = match.start()
+		while start > 0 and tail[start - 1] in b' \t':
+			start -= 1
+		indent = tail[start:match.start()].decode('ascii') if start > 0 and tail[start - 1] in b'\r\n' else None
+		insert_offset = scanner.tail_offset + start
+
+		head = _ROOT_START_TAG.search(scanner.head or tail)
+		if head is None:
+			raise ValueError('{} has no CastVoteRecordReport start tag'.format(self.path))
+		trailer = tail[start:]
+
+		self.state = {
+			'size': size,
+			'insert_offset': insert_offset,
+			'indent': indent,
+			'count': scanner.count,
+			'ids_size': ids_size,
+			'head': (scanner.head or tail)[:head.end()].decode('utf-8'),
+			'trailer': trailer.decode('utf-8'),
+			# ObjectIds in the report metadata, which CVR snapshots mustn't reuse
+			'object_ids': [m.decode('utf-8') for m in _OBJECT_ID.findall(trailer)],
+			'pending': False,
+		}
+		self._save_state()
+		return self.state
+
+	def report(self):
+		"""The report's metadata, without its CVRs, read from the trailer."""
+		envelope = (self.state['head'] + self.state['trailer']).encode('utf-8')
+		return CastVoteRecordReportReader(BytesIO(envelope)).read_metadata()
+
+	def _rollback(self):
+		# put the trailer back where it was before the append started, dropping any CVRs written since
+		with open(self.path, 'r+b') as f:
+			f.seek(self.state['insert_offset'])
+			f.write(self.state['trailer'].encode('utf-8'))
+			f.truncate()
+		with open(self.ids_path, 'r+b') as f:
+			f.truncate(self.state['ids_size'])
+		self.state['pending'] = False
+		self._save_state()
+
+	def _check(self, cvr):
+		if cvr.id is None or cvr.id in self.unique_ids:
+			raise AppendConflict('The report already has a CVR with UniqueId {}'.format(cvr.id))
+		snapshot = cvr.cvr_snapshot[0]
+		if snapshot.id is None or snapshot.id in self.object_ids:
+			raise AppendConflict('CVR {}: the report already uses ObjectId {}'.format(cvr.id, snapshot.id))
+
+		election = self.elections.get(cvr.election.id)
+		if election is None:
+			raise AppendConflict('CVR {}: the report has no Election {}'.format(cvr.id, cvr.election.id))
+		for cvr_contest in snapshot.cvr_contests or ():
+			try:
+				contest = election.contest_by_id(cvr_contest.contest.id)
+				for cvr_contest_sel in cvr_contest.cvr_contest_selection or ():
+					contest.selection_by_id(cvr_contest_sel.contest_selection.id)
+			except KeyError as e:
+				raise AppendConflict('CVR {}: {} is not in Election {}'.format(cvr.id, e.args[0], election.id)) from None
+		return snapshot.id
+
+	def append(self, cvrs):
+		"""Add cvrs (any iterable of CVRs or CompactCVRs) to the report; returns how many were added.
+
+		If any of them is rejected, none of them are added.
+		"""
+		state = self.state
+		state['pending'] = True
+		self._save_state()
+
+		added = []
+		try:
+			with open(self.path, 'r+b') as f, open(self.ids_path, 'r+b') as ids:
+				f.seek(state['insert_offset'])
+				ids.seek(state['ids_size'])
+				for cvr in cvrs:
+					snapshot_id = self._check(cvr)
+					self.unique_ids.add(cvr.id)
+					self.object_ids.add(snapshot_id)
+					added.append((cvr.id, snapshot_id))
+					f.write(cvr_to_string(cvr, state['indent']).encode('utf-8'))
+					ids.write(_ids_line(cvr.id, [snapshot_id]))
+
+				insert_offset = f.tell()
+				f.write(state['trailer'].encode('utf-8'))
+				f.truncate()
+				f.flush()
+				os.fsync(f.fileno())
+				size = f.tell()
+				ids_size = ids.tell()
+		except BaseException:
+			for unique_id, snapshot_id in added:
+				self.unique_ids.discard(unique_id)
+				self.object_ids.discard(snapshot_id)
+			self._rollback()
+			raise
+
+		state['insert_offset'] = insert_offset
+		state['size'] = size
+		state['ids_size'] = ids_size
+		state['count'] += len(added)
+		state['pending'] = False
+		self._save_state()
+		return len(added)
+
+
+def _ids_line(unique_id, object_ids):
+	return (json.dumps([unique_id] + object_ids) + '\n').encode('utf-8')
+
+
+def append_cvrs(path, cvrs):
+	"""Add cvrs to the report at path; see ReportAppender."""
+	return ReportAppender(path).append(cvrs)
@@ -0,0 +1,483 @@
+from array import array
+from bisect import bisect_left
+import json
+import mmap
+import re
+import struct
+import sys
+
+from .CastVoteRecords import CVR, CVRSnapshot
+from .compact import CompactCVRContest, CompactCVRContestSelection
+from .jsonreader import report_from_json
+from .table import BallotTable, NOT_ON_BALLOT
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+#
+# The layout of an archive file:
+#
+#   MAGIC, then the length of the header as a little-endian uint64
+#   the header: UTF-8 JSON with the report metadata (the same as json_metadata()),
+#     the ballot count, the contest outcome tables and layouts, and where each
+#     section is
+#   the sections, each starting on an 8-byte boundary, all little-endian:
+#     layouts         one code per ballot: which contests it has, in what order
+#     column:<i>      one outcome code per ballot for the i'th contest, -1 if it's not on the ballot
+#     ids             every UniqueId, UTF-8, back to back
+#     id_offsets      where each ballot's UniqueId starts in ids, plus the end
+#     id_order        ballot numbers in UniqueId order (left out when the ids were already in order)
+#     snapshot_*      snapshot ids that don't follow the header's snapshot_id_format
+#
+# An outcome is everything a CVRContest says - the selections, overvotes,
+# undervotes and write-ins - and each contest has a table of the ones that
+# occur, so the columns stay one or two bytes wide.
+#
+MAGIC = b'CVRARCv1'
+_ALIGN = 8
+_DTYPES = {'b': '<i1', 'h': '<i2', 'i': '<i4', 'B': '<u1', 'H': '<u2', 'Q': '<u8'}
+_TYPECODES = {dtype: typecode for typecode, dtype in _DTYPES.items()}
+# the next wider type to switch to when a code doesn't fit
+_WIDER = {'b': 'h', 'h': 'i', 'B': 'H', 'H': 'Q'}
+_TRAILING_NUMBER = re.compile(r'\d+$')
+
+
+def _append(column, code):
+	# appends code, widening the column if it doesn't fit; returns the column to use from now on
+	try:
+		column.append(code)
+	except OverflowError:
+		column = array(_WIDER[column.typecode], column)
+		column.append(code)
+	return column
+
+
+class _PackedStrings:
+	def __init__(self):
+		self.data = bytearray()
+		self.offsets = array('Q', [0])
+
+	def append(self, text):
+		self.data += text.encode('utf-8')
+		self.offsets.append(len(self.data))
+
+
+def _snapshot_id_format(cvr_id, snapshot_id):
+	# '_cvr_snapshot_269377_001' for '_cvr_269377' gives '_cvr_snapshot_{}_001'
+	match = _TRAILING_NUMBER.search(cvr_id)
+	if match is None or match.group() not in snapshot_id:
+		return None
+	before, _, after = snapshot_id.partition(match.group())
+	return before.replace('{', '{{').replace('}', '}}') + '{}' + after.replace('{', '{{').replace('}', '}}')
+
+
+def _expected_snapshot_id(id_format, cvr_id):
+	if id_format is None:
+		return None
+	match = _TRAILING_NUMBER.search(cvr_id)
+	return id_format.format(match.group()) if match else None
+
+
+class CVRArchiveWriter:
+	"""Builds a CVR archive from the report metadata and any iterable of CVRs.
+
+	CVRs are added with append() or append_cvrs(), and the file is written
+	by close(); everything kept in the meantime is packed into arrays, a few
+	bytes per contest per ballot. The archive keeps everything the XML
+	output says about a CVR, so converting XML to an archive and back gives
+	the same file. All the CVRs have to be for one Election.
+	"""
+
+	def __init__(self, path, report):
+		self.path = path
+		self.report = report
+		elections = report.election if isinstance(report.election, list) else [report.election]
+		if len(elections) != 1:
+			raise ValueError('A CVR archive holds the CVRs for a single Election, but the report has {}'.format(len(elections)))
+		self.election = elections[0]
+		self.contests = list(self.election.contests)
+		self._positions = {contest.id: i for i, contest in enumerate(self.contests)}
+		self._outcomes = [{} for _ in self.contests]
+		self._columns = [array('b') for _ in self.contests]
+		self._layouts = {}
+		self._layout_column = array('B')
+		# id of a shared tuple of compact contest records -> (the tuple, layout code, codes)
+		self._ballots = {}
+		self._ids = _PackedStrings()
+		self._ids_sorted = True
+		self._last_id = None
+		self._snapshot_id_format = None
+		self._snapshot_exception_ordinals = array('Q')
+		self._snapshot_exceptions = _PackedStrings()
+		self.count = 0
+		self._closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+
+	def _outcome_code(self, position, cvr_contest):
+		selections = cvr_contest.cvr_contest_selection
+		key = (tuple(sel.contest_selection.id for sel in selections) if selections else (),
+			cvr_contest.overvotes, cvr_contest.undervotes, cvr_contest.writeins)
+		outcomes = self._outcomes[position]
+		code = outcomes.get(key)
+		if code is None:
+			code = outcomes[key] = len(outcomes)
+		return code
+
+	def _ballot_codes(self, cvr):
+		# (layout code, outcome code for every column) for a ballot's contests
+		layout = []
+		codes = [-1] * len(self.contests)
+		for cvr_contest in cvr.cvr_snapshot[0].cvr_contests or ():
+			position = self._positions.get(cvr_contest.contest.id)
+			if position is None:
+				raise ValueError('CVR {} has a CVRContest for {!r}, which is not in the Election'.format(cvr.id, cvr_contest.contest.id))
+			if codes[position] != -1:
+				raise ValueError('CVR {} has two CVRContests for {!r}'.format(cvr.id, cvr_contest.contest.id))
+			layout.append(position)
+			codes[position] = self._outcome_code(position, cvr_contest)
+
+		layout = tuple(layout)
+		layout_code = self._layouts.get(layout)
+		if layout_code is None:
+			layout_code = self._layouts[layout] = len(self._layouts)
+		return layout_code, codes
+
+	def append(self, cvr):
+		if cvr.election is not self.election and cvr.election.id != self.election.id:
+			raise ValueError('CVR {} is for Election {!r}, but the archive is for {!r}'.format(cvr.id, cvr.election.id, self.election.id))
+		n = self.count
+
+		# compact CVRs share one tuple of contest records between ballots marked the same way,
+		# so their codes only have to be worked out once
+		cvr_contests = getattr(cvr, 'cvr_contests', None)
+		if type(cvr_contests) is tuple:
+			cached = self._ballots.get(id(cvr_contests))
+			if cached is None or cached[0] is not cvr_contests:
+				cached = self._ballots[id(cvr_contests)] = (cvr_contests,) + self._ballot_codes(cvr)
+			layout_code, codes = cached[1:]
+		else:
+			layout_code, codes = self._ballot_codes(cvr)
+
+		columns = self._columns
+		for position, code in enumerate(codes):
+			try:
+				columns[position].append(code)
+			except OverflowError:
+				columns[position] = _append(columns[position], code)
+		self._layout_column = _append(self._layout_column, layout_code)
+
+		cvr_id = cvr.id
+		encoded_id = cvr_id.encode('utf-8')
+		self._ids.data += encoded_id
+		self._ids.offsets.append(len(self._ids.data))
+		if self._ids_sorted and self._last_id is not None and encoded_id < self._last_id:
+			self._ids_sorted = False
+		self._last_id = encoded_id
+
+		snapshot_id = cvr.cvr_snapshot[0].id
+		if n == 0:
+			self._snapshot_id_format = _snapshot_id_format(cvr_id, snapshot_id)
+		if _expected_snapshot_id(self._snapshot_id_format, cvr_id) != snapshot_id:
+			self._snapshot_exception_ordinals.append(n)
+			self._snapshot_exceptions.append(snapshot_id)
+		self.count += 1
+
+	def append_cvrs(self, cvrs):
+		for cvr in cvrs:
+			self.append(cvr)
+
+	def _id_order(self):
+		data = bytes(self._ids.data)
+		offsets = self._ids.offsets
+		order = sorted(range(self.count), key=lambda i: data[offsets[i]:offsets[i + 1]])
+		return array('Q', order)
+
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+
+		sections = [('layouts', self._layout_column)]
+		for position, column in enumerate(self._columns):
+			sections.append(('column:{}'.format(position), column))
+		sections.append(('ids', self._ids.data))
+		sections.append(('id_offsets', self._ids.offsets))
+		if not self._ids_sorted:
+			sections.append(('id_order', self._id_order()))
+		if self._snapshot_exception_ordinals:
+			sections.append(('snapshot_exception_ordinals', self._snapshot_exception_ordinals))
+			sections.append(('snapshot_exceptions', self._snapshot_exceptions.data))
+			sections.append(('snapshot_exception_offsets', self._snapshot_exceptions.offsets))
+
+		directory = {}
+		offset = 0
+		for name, data in sections:
+			typecode = data.typecode if isinstance(data, array) else 'B'
+			nbytes = len(data) * (data.itemsize if isinstance(data, array) else 1)
+			directory[name] = {'offset': offset, 'count': len(data), 'dtype': _DTYPES[typecode]}
+			offset += nbytes + (-nbytes % _ALIGN)
+
+		header = {
+			'count': self.count,
+			'report': self.report.json_metadata(),
+			'contests': [contest.id for contest in self.contests],
+			'outcomes': [[[list(selection_ids), over, under, writeins] for selection_ids, over, under, writeins in outcomes]
+				for outcomes in self._outcomes],
+			'layouts': [list(layout) for layout in self._layouts],
+			'ids_sorted': self._ids_sorted,
+			'snapshot_id_format': self._snapshot_id_format,
+			'sections': directory,
+		}
+		header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+		prefix_length = len(MAGIC) + 8 + len(header_bytes)
+
+		with open(self.path, 'wb') as f:
+			f.write(MAGIC)
+			f.write(struct.pack('<Q', len(header_bytes)))
+			f.write(header_bytes)
+			f.write(b'\0' * (-prefix_length % _ALIGN))
+			for name, data in sections:
+				if isinstance(data, array) and sys.byteorder == 'big' and data.itemsize > 1:
+					data = array(data.typecode, data)
+					data.byteswap()
+				f.write(data)
+				nbytes = len(data) * (data.itemsize if isinstance(data, array) else 1)
+				f.write(b'\0' * (-nbytes % _ALIGN))
+
+
+def write_archive(path, report, cvrs=None):
+	"""Write report (or report plus an iterable of CVRs) to a CVR archive at path; returns the ballot count."""
+	if cvrs is None:
+		cvrs = report.cvrs
+	with CVRArchiveWriter(path, report) as writer:
+		writer.append_cvrs(cvrs)
+	return writer.count
+
+
+class CVRArchive:
+	"""A CVR archive opened with mmap.
+
+	Opening only parses the JSON header, so it takes the same time however
+	many ballots there are. Sections are read in place: with NumPy they're
+	NumPy views straight onto the mapped file, without it memoryviews.
+	len() is the ballot count, cvr(n) builds ballot n's CVR without
+	looking at any other ballot, cvr_by_id() finds a ballot by UniqueId with
+	a binary search, and iterating yields every CVR in order. outcomes()
+	gives a contest's column of outcome codes and column() the same ballots
+	as BallotTable codes; to_table() makes a whole BallotTable.
+
+	Close the archive (or use it as a context manager) once you're done with
+	it, after dropping any views it handed out.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if self._mmap[:len(MAGIC)] != MAGIC:
+			self._mmap.close()
+			raise ValueError('{} is not a CVR archive'.format(path))
+		header_length, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+		header_start = len(MAGIC) + 8
+		header = json.loads(self._mmap[header_start:header_start + header_length].decode('utf-8'))
+		self._data_start = header_start + header_length + (-(header_start + header_length) % _ALIGN)
+		self._sections = header['sections']
+		self.count = header['count']
+
+		# the metadata is the same JSON the JSON writer puts ahead of the CVRs
+		self.report = report_from_json(header['report'])
+		self.election = self.report.election
+		self.contests = [self.election.contest_by_id(contest_id) for contest_id in header['contests']]
+		self._positions = {contest.id: position for position, contest in enumerate(self.contests)}
+
+		# one shared CVRContest per outcome, as the compact CVRs use
+		self._outcomes = []
+		selections = {}
+		for contest, outcomes in zip(self.contests, header['outcomes']):
+			cvr_contests = []
+			for selection_ids, over, under, writeins in outcomes:
+				cvr_contest_selection = None
+				if selection_ids:
+					cvr_contest_selection = []
+					for selection_id in selection_ids:
+						if selection_id not in selections:
+							selections[selection_id] = CompactCVRContestSelection(contest.selection_by_id(selection_id))
+						cvr_contest_selection.append(selections[selection_id])
+					cvr_contest_selection = tuple(cvr_contest_selection)
+				cvr_contests.append(CompactCVRContest(contest, cvr_contest_selection, writeins, over, under))
+			self._outcomes.append(cvr_contests)
+		self._layouts = [tuple(layout) for layout in header['layouts']]
+
+		self._ids_sorted = header['ids_sorted']
+		self._snapshot_id_format = header['snapshot_id_format']
+		self._layout_column = self._section('layouts')
+		self._columns = [self._section('column:{}'.format(i)) for i in range(len(self.contests))]
+		self._ids = self._section('ids', raw=True)
+		self._id_offsets = self._section('id_offsets')
+		self._id_order = self._section('id_order') if 'id_order' in self._sections else None
+		if 'snapshot_exception_ordinals' in self._sections:
+			self._snapshot_exception_ordinals = self._section('snapshot_exception_ordinals')
+			self._snapshot_exceptions = self._section('snapshot_exceptions', raw=True)
+			self._snapshot_exception_offsets = self._section('snapshot_exception_offsets')
+		else:
+			self._snapshot_exception_ordinals = None
+
+	def _section(self, name, raw=False):
+		section = self._sections[name]
+		start = self._data_start + section['offset']
+		dtype = section['dtype']
+		if raw:
+			return memoryview(self._mmap)[start:start + section['count']]
+		if np is not None:
+			return np.frombuffer(self._mmap, dtype=dtype, count=section['count'], offset=start)
+		typecode = _TYPECODES[dtype]
+		nbytes = section['count'] * array(typecode).itemsize
+		view = memoryview(self._mmap)[start:start + nbytes]
+		if sys.byteorder == 'big' and dtype[-1] != '1':
+			# can't be read in place, so this one's a copy
+			column = array(typecode, view.tobytes())
+			column.byteswap()
+			return column
+		return view.cast(typecode)
+
+	def close(self):
+		self._layout_column = self._columns = self._ids = self._id_offsets = self._id_order = None
+		self._snapshot_exception_ordinals = self._snapshot_exceptions = self._snapshot_exception_offsets = None
+		try:
+			self._mmap.close()
+		except BufferError:
+			# something still holds a view onto the file; it's unmapped once that's gone
+			pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def __len__(self):
+		return self.count
+
+	def cvr_id(self, n):
+		return bytes(self._ids[int(self._id_offsets[n]):int(self._id_offsets[n + 1])]).decode('utf-8')
+
+	def _snapshot_id(self, n, cvr_id):
+		ordinals = self._snapshot_exception_ordinals
+		if ordinals is not None:
+			i = bisect_left(ordinals, n)
+			if i < len(ordinals) and ordinals[i] == n:
+				offsets = self._snapshot_exception_offsets
+				return bytes(self._snapshot_exceptions[int(offsets[i]):int(offsets[i + 1])]).decode('utf-8')
+		return _expected_snapshot_id(self._snapshot_id_format, cvr_id)
+
+	def cvr(self, n):
+		"""Ballot n (counting from 0) as a CVR."""
+		if not 0 <= n < self.count:
+			raise IndexError(n)
+		cvr_id = self.cvr_id(n)
+		outcomes = self._outcomes
+		columns = self._columns
+		cvr_contests = [outcomes[position][columns[position][n]] for position in self._layouts[self._layout_column[n]]]
+		return CVR(id=cvr_id, election=self.election, cvr_snapshot=[CVRSnapshot(id=self._snapshot_id(n, cvr_id), cvr_contests=cvr_contests)])
+
+	def __getitem__(self, n):
+		if n < 0:
+			n += self.count
+		return self.cvr(n)
+
+	def __iter__(self, block=1 << 16):
+		# the same as cvr(n) for each n, but pulling the codes out a block at a time
+		election = self.election
+		outcomes = self._outcomes
+		layouts = self._layouts
+		ids = self._ids
+		for start in range(0, self.count, block):
+			stop = min(start + block, self.count)
+			offsets = self._id_offsets[start:stop + 1].tolist()
+			layout_codes = self._layout_column[start:stop].tolist()
+			columns = [column[start:stop].tolist() for column in self._columns]
+			for i in range(stop - start):
+				cvr_id = bytes(ids[offsets[i]:offsets[i + 1]]).decode('utf-8')
+				cvr_contests = [outcomes[position][columns[position][i]] for position in layouts[layout_codes[i]]]
+				snapshot = CVRSnapshot(id=self._snapshot_id(start + i, cvr_id), cvr_contests=cvr_contests)
+				yield CVR(id=cvr_id, election=election, cvr_snapshot=[snapshot])
+
+	def index(self, cvr_id):
+		"""The ballot number of the CVR with UniqueId cvr_id; raises KeyError if there isn't one."""
+		order = self._id_order
+		lo = 0
+		hi = self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.cvr_id(mid if order is None else int(order[mid])) < cvr_id:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo < self.count:
+			n = lo if order is None else int(order[lo])
+			if self.cvr_id(n) == cvr_id:
+				return n
+		raise KeyError(cvr_id)
+
+	def cvr_by_id(self, cvr_id):
+		return self.cvr(self.index(cvr_id))
+
+	def outcomes(self, contest_id):
+		"""A contest's outcome codes, one per ballot, read in place; -1 means the contest wasn't on the ballot."""
+		return self._columns[self._position(contest_id)]
+
+	def _position(self, contest_id):
+		return self._positions[contest_id]
+
+	def outcome(self, contest_id, code):
+		"""The (shared) CVRContest an outcome code stands for."""
+		return self._outcomes[self._position(contest_id)][code]
+
+	def _code_map(self, position, table):
+		# BallotTable codes for each outcome, shifted by one so -1 (not on the ballot) is at 0
+		return [NOT_ON_BALLOT] + [table._cvr_contest_code(cvr_contest) for cvr_contest in self._outcomes[position]]
+
+	def column(self, contest_id, table=None):
+		"""A contest's votes as BallotTable codes (a copy, since they're worked out from the outcome codes)."""
+		position = self._position(contest_id)
+		table = table or BallotTable(self.election, self.contests)
+		code_map = self._code_map(position, table)
+		typecode = table.columns[contest_id].typecode
+		outcomes = self._columns[position]
+		if np is not None:
+			return np.asarray(code_map, dtype=typecode)[outcomes.astype(np.intp) + 1]
+		return array(typecode, [code_map[code + 1] for code in outcomes])
+
+	def to_table(self):
+		"""All the ballots as a BallotTable."""
+		table = BallotTable(self.election, self.contests)
+		for contest in self.contests:
+			column = self.column(contest.id, table)
+			table.columns[contest.id] = array(table.columns[contest.id].typecode, column.tobytes() if np is not None else column)
+		table._ids = bytearray(self._ids)
+		table._id_offsets = array('Q', self._id_offsets.tobytes() if np is not None else self._id_offsets)
+		return table
+
+
+def xml_to_archive(source, path):
+	"""Convert an XML report (a file name or seekable binary file) to an archive; returns the ballot count."""
+	from .reader import CastVoteRecordReportReader
+
+	reader = CastVoteRecordReportReader(source)
+	return write_archive(path, reader.read_metadata(), reader)
+
+
+def archive_to_xml(path, f, indent='  '):
+	"""Write an archive back out as an XML report to the binary file f; returns the ballot count."""
+	from .writer import write_report
+
+	with CVRArchive(path) as archive:
+		return write_report(f, archive.report, archive, indent)
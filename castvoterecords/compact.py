@@ -0,0 +1,130 @@
+from .CastVoteRecords import CVRContestSelection, CVRContest, CVRSnapshot, CVR
+
+# Past this many distinct ballots the pool stops interning new ones
+MAX_INTERNED_BALLOTS = 100000
+
+#
+# Slotted stand-ins for the per-ballot classes. They have the same attributes
+# (and borrow the same to_xml() and to_json() methods) as the dataclasses, so the writer,
+# BallotTable and tabulate_cvrs() take either. The difference is that nothing
+# per-ballot is stored twice: contest records are shared between every ballot
+# with the same marks, and ids are only formatted when something asks for them.
+#
+
+class CompactCVRContestSelection:
+	__slots__ = ('contest_selection',)
+
+	# CVRContestSelection ids are never written out, and a shared instance can't have one
+	id = None
+	to_xml = CVRContestSelection.to_xml
+	to_json = CVRContestSelection.to_json
+
+	def __init__(self, contest_selection):
+		self.contest_selection = contest_selection
+
+
+class CompactCVRContest:
+	"""A CVRContest that's shared by every ballot with the same outcome in the contest.
+
+	Treat these as immutable; use CompactCVR.cvr_contest_id() for the id the
+	dataclass version would have had.
+	"""
+	__slots__ = ('contest', 'cvr_contest_selection', 'writeins', 'overvotes', 'undervotes')
+
+	id = None
+	to_xml = CVRContest.to_xml
+	to_json = CVRContest.to_json
+
+	def __init__(self, contest, cvr_contest_selection=None, writeins=0, overvotes=0, undervotes=0):
+		self.contest = contest
+		self.cvr_contest_selection = cvr_contest_selection
+		self.writeins = writeins
+		self.overvotes = overvotes
+		self.undervotes = undervotes
+
+
+class CompactCVRSnapshot:
+	__slots__ = ('id', 'cvr_contests')
+
+	to_xml = CVRSnapshot.to_xml
+	to_json = CVRSnapshot.to_json
+
+	def __init__(self, id, cvr_contests):
+		self.id = id
+		self.cvr_contests = cvr_contests
+
+
+class CompactCVR:
+	"""A CVR that stores just its ballot number, election and shared contest records.
+
+	id, the snapshot and its id are worked out from number when they're
+	read, using the same formats EssPlan gives the full dataclasses.
+	"""
+	__slots__ = ('number', 'election', 'cvr_contests')
+
+	id_format = '_cvr_{}'
+	snapshot_id_format = '_cvr_snapshot_{}_001'
+	cvr_contest_id_format = '_cvr_contest_{}{}'
+
+	to_xml = CVR.to_xml
+	to_json = CVR.to_json
+
+	def __init__(self, number, election, cvr_contests):
+		self.number = number
+		self.election = election
+		self.cvr_contests = cvr_contests
+
+	@property
+	def id(self):
+		return self.id_format.format(self.number)
+
+	@property
+	def cvr_snapshot(self):
+		return [CompactCVRSnapshot(self.snapshot_id_format.format(self.number), self.cvr_contests)]
+
+	def cvr_contest_id(self, i):
+		return self.cvr_contest_id_format.format(self.number, self.cvr_contests[i].contest.id)
+
+
+class CVRContestPool:
+	"""Hands out one shared CompactCVRContest per distinct contest outcome.
+
+	Whole ballots are interned as well, so ballots marked the same way share
+	one tuple of contest records, up to MAX_INTERNED_BALLOTS distinct ones so
+	memory stays flat on a long run. Ballots after that get a list of their
+	own, which the archive and SQLite loaders know not to cache.
+	"""
+
+	def __init__(self):
+		self._selections = {}
+		self._contests = {}
+		self._ballots = {}
+
+	def cvr_contest(self, contest, selection=None, writeins=0, overvotes=0, undervotes=0):
+		key = (contest.id, selection.id if selection is not None else None, writeins, overvotes, undervotes)
+		try:
+			return self._contests[key]
+		except KeyError:
+			pass
+
+		cvr_contest_selection = None
+		if selection is not None:
+			cvr_sel = self._selections.get(selection.id)
+			if cvr_sel is None:
+				cvr_sel = self._selections[selection.id] = CompactCVRContestSelection(selection)
+			cvr_contest_selection = (cvr_sel,)
+		cvr_contest = self._contests[key] = CompactCVRContest(contest, cvr_contest_selection, writeins, overvotes, undervotes)
+		return cvr_contest
+
+	def ballot(self, cvr_contests):
+		key = tuple(cvr_contests)
+		ballot = self._ballots.get(key)
+		if ballot is not None:
+			return ballot
+		if len(self._ballots) < MAX_INTERNED_BALLOTS:
+			self._ballots[key] = key
+			return key
+		return list(key)
+
+	def __len__(self):
+		return len(self._contests)
@@ -0,0 +1,136 @@
+import bz2
+import gzip
+import lzma
+import queue
+import threading
+
+# file suffix -> the stdlib module that reads and writes it
+CODECS = {'.gz': gzip, '.xz': lzma, '.bz2': bz2}
+# what each codec calls its compression level, and the level we use when none is given
+_LEVELS = {gzip: ('compresslevel', 6), lzma: ('preset', 6), bz2: ('compresslevel', 9)}
+
+
+def codec_for(path):
+	"""The module (gzip, lzma or bz2) for path's suffix, or None for an uncompressed file."""
+	if not isinstance(path, str):
+		return None
+	for suffix, codec in CODECS.items():
+		if path.endswith(suffix):
+			return codec
+	return None
+
+
+def _codec_file(codec, f, mode, level):
+	name, default = _LEVELS[codec]
+	if 'r' in mode:
+		return codec.open(f, mode)
+	return codec.open(f, mode, **{name: default if level is None else level})
+
+
+class BackgroundCompressor:
+	"""A binary file object that compresses what's written to it on another thread.
+
+	Writes are collected into chunks of chunk_size bytes, and each full chunk
+	goes on a queue of at most queue_size chunks for a thread that feeds them
+	to the codec (gzip, lzma or bz2) and writes the result to f. zlib, lzma
+	and bz2 all let go of the GIL while they compress, so serializing the
+	next CVRs carries on while the last ones are being compressed; if the
+	compressor falls behind, the queue fills up and write() waits for it,
+	so memory stays bounded.
+
+	close() waits for the thread to finish, closes the codec stream (and f,
+	if it was opened from a path) and raises anything that went wrong on the
+	thread.
+	"""
+
+	_DONE = object()
+
+	def __init__(self, f, codec, level=None, chunk_size=1 << 20, queue_size=8):
+		self._owns = isinstance(f, str)
+		self._raw = open(f, 'wb') if self._owns else f
+		self._stream = _codec_file(codec, self._raw, 'wb', level)
+		self.chunk_size = chunk_size
+		self._buffer = bytearray()
+		self._queue = queue.Queue(queue_size)
+		self._error = None
+		self._closed = False
+		self._thread = threading.Thread(target=self._compress, name='compressor', daemon=True)
+		self._thread.start()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def _compress(self):
+		while True:
+			chunk = self._queue.get()
+			if chunk is self._DONE:
+				return
+			if self._error is None:
+				# after an error, keep taking chunks so write() never blocks on a full queue
+				try:
+					self._stream.write(chunk)
+				except BaseException as e:
+					self._error = e
+
+	def _check(self):
+		if self._error is not None:
+			raise self._error
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		if self._closed:
+			raise ValueError('write to closed file')
+		self._buffer += data
+		if len(self._buffer) >= self.chunk_size:
+			self._check()
+			self._queue.put(bytes(self._buffer))
+			self._buffer.clear()
+		return len(data)
+
+	def flush(self):
+		# hand over what's buffered; close() is what waits for it to be written
+		if self._buffer:
+			self._queue.put(bytes(self._buffer))
+			self._buffer.clear()
+		self._check()
+
+	def close(self):
+		if self._closed:
+			return
+		self._closed = True
+		try:
+			if self._buffer:
+				self._queue.put(bytes(self._buffer))
+				self._buffer.clear()
+			self._queue.put(self._DONE)
+			self._thread.join()
+			if self._error is None:
+				self._stream.close()
+		finally:
+			if self._owns:
+				self._raw.close()
+		self._check()
+
+
+def open_compressed(path, mode='rb', level=None, background=True):
+	"""Open path for binary reading or writing, compressed or not according to its suffix.
+
+	.gz, .xz and .bz2 files are read and written with the stdlib codecs, and
+	anything else is opened as it is. Files opened for writing are
+	compressed on a BackgroundCompressor thread unless background is False;
+	level is the codec's compression level (gzip and bz2's compresslevel,
+	or lzma's preset).
+	"""
+	if mode not in ('rb', 'wb'):
+		raise ValueError("open_compressed() opens files with mode 'rb' or 'wb', not {!r}".format(mode))
+	codec = codec_for(path)
+	if codec is None:
+		return open(path, mode)
+	if mode == 'wb' and background:
+		return BackgroundCompressor(path, codec, level)
+	return _codec_file(codec, path, mode, level)
@@ -0,0 +1,177 @@
+import csv
+
+from .CastVoteRecords import CVRContestSelection, CVRContest, CVRSnapshot, CVR, selection_name
+from .table import UNDERVOTE, OVERVOTE, WRITE_IN
+from .compact import CompactCVR, CVRContestPool
+
+CVR_NUMBER_COLUMN = 'Cast Vote Record'
+PRECINCT_COLUMN = 'Precinct'
+BALLOT_STYLE_COLUMN = 'Ballot Style'
+
+
+class EssPlan:
+	"""How to turn rows of an ESS ElectionWare CVR export into CVRs.
+
+	The export has a column per contest, named after the contest, and each
+	cell holds a candidate name (or Yes/No), 'overvote', 'undervote', or
+	nothing when the contest wasn't on that ballot. The plan is compiled once
+	from the header: for each column that matches a Contest in the election,
+	it keeps the column's index and a lookup from cell value to
+	(code, ContestSelection), where code is the BallotTable code for the
+	value. Decoding a row then only touches those columns, however many
+	contests the county-wide export has.
+
+	A county-wide export has a column for every contest in the county, but
+	each ballot style only has some of them, and the rest of its cells are
+	empty. So the plan also learns, from the Ballot Style column, which of
+	its columns each style uses (see BallotStyle), and decoding a row only
+	looks at those.
+
+	Plans only hold the election and plain lists and dicts, so they can be
+	pickled and sent to worker processes.
+	"""
+
+	def __init__(self, header, election):
+		self.election = election
+		self.pool = CVRContestPool()
+		columns = {name: i for i, name in enumerate(header)}
+		self.id_index = columns[CVR_NUMBER_COLUMN]
+		self.precinct_index = columns.get(PRECINCT_COLUMN)
+		self.ballot_style_index = columns.get(BALLOT_STYLE_COLUMN)
+
+		missing = [contest.name for contest in election.contests if contest.name not in columns]
+		if missing:
+			raise ValueError('No column in the export for contest(s) {}'.format(', '.join(missing)))
+
+		# (column index, contest, value lookup), in the order the columns appear in the export
+		self.columns = []
+		for contest in sorted(election.contests, key=lambda contest: columns[contest.name]):
+			lookup = {'overvote': (OVERVOTE, None), 'undervote': (UNDERVOTE, None)}
+			for code, sel in enumerate(contest.contest_selections):
+				lookup[selection_name(sel)] = (code, sel)
+			self.columns.append((columns[contest.name], contest, lookup))
+		# ballot style name -> BallotStyle
+		self.styles = {}
+
+	def ballot_style(self, row):
+		"""The BallotStyle for row, with every contest the row has a cell for.
+
+		A style's contests are learned from the cells that aren't empty on its
+		first row. Every row is still checked for anything in the style's other
+		columns, a slice at a time, and if there is the style gets those columns
+		too from then on. Exports without a Ballot Style column are treated as
+		one style.
+		"""
+		name = row[self.ballot_style_index] if self.ballot_style_index is not None else None
+		style = self.styles.get(name)
+		if style is None or any(''.join(row[start:stop]) for start, stop in style.other_runs):
+			used = {index for index, contest, lookup in style.columns} if style is not None else set()
+			used.update(index for index, contest, lookup in self.columns if row[index])
+			style = self.styles[name] = BallotStyle(name, [column for column in self.columns if column[0] in used],
+				[column[0] for column in self.columns if column[0] not in used])
+		return style
+
+	def _decode(self, value, contest, lookup):
+		try:
+			return lookup[value]
+		except KeyError:
+			# a write-in with no write-in selection in the contest to point at
+			if value.startswith('write-in'):
+				return (WRITE_IN, None)
+			raise ValueError('{!r} is not a selection in {}'.format(value, contest.name)) from None
+
+	def codes(self, row):
+		"""Yield (contest, code) for each contest on the ballot, skipping ones it doesn't have."""
+		for index, contest, lookup in self.ballot_style(row).columns:
+			value = row[index]
+			if value:
+				yield contest, self._decode(value, contest, lookup)[0]
+
+	def cvr(self, row):
+		cvr_number = row[self.id_index]
+		cvr_contests = []
+		for index, contest, lookup in self.ballot_style(row).columns:
+			value = row[index]
+			if not value:
+				continue
+			code, sel = self._decode(value, contest, lookup)
+			cvr_contest_id = '_cvr_contest_{}{}'.format(cvr_number, contest.id)
+			if code == OVERVOTE:
+				cvr_contest = CVRContest(contest=contest, id=cvr_contest_id, overvotes=1)
+			elif code == UNDERVOTE:
+				cvr_contest = CVRContest(contest=contest, id=cvr_contest_id, undervotes=1)
+			elif code == WRITE_IN:
+				cvr_contest = CVRContest(contest=contest, id=cvr_contest_id, writeins=1)
+			else:
+				cvr_contest_selection = CVRContestSelection(contest_selection=sel, id='_cvr{}_cs{}'.format(cvr_number, contest.id))
+				cvr_contest = CVRContest(contest=contest, id=cvr_contest_id, cvr_contest_selection=[cvr_contest_selection])
+			cvr_contests.append(cvr_contest)
+
+		return CVR(id='_cvr_{}'.format(cvr_number),
+			election=self.election,
+			cvr_snapshot=[CVRSnapshot(id='_cvr_snapshot_{}_001'.format(cvr_number), cvr_contests=cvr_contests)])
+
+	def compact_cvr(self, row):
+		"""Like cvr(), but a CompactCVR whose contest records are shared with other ballots."""
+		pool = self.pool
+		cvr_contests = []
+		for index, contest, lookup in self.ballot_style(row).columns:
+			value = row[index]
+			if not value:
+				continue
+			code, sel = self._decode(value, contest, lookup)
+			if code == OVERVOTE:
+				cvr_contests.append(pool.cvr_contest(contest, overvotes=1))
+			elif code == UNDERVOTE:
+				cvr_contests.append(pool.cvr_contest(contest, undervotes=1))
+			elif code == WRITE_IN:
+				cvr_contests.append(pool.cvr_contest(contest, writeins=1))
+			else:
+				cvr_contests.append(pool.cvr_contest(contest, sel))
+		return CompactCVR(row[self.id_index], self.election, pool.ballot(cvr_contests))
+
+	def cvrs(self, rows, compact=False):
+		make_cvr = self.compact_cvr if compact else self.cvr
+		for row in rows:
+			yield make_cvr(row)
+
+
+class BallotStyle:
+	"""The columns of an EssPlan that one ballot style uses.
+
+	columns is the plan's (column index, contest, value lookup) for each
+	contest on the style, in the export's order, and contests is just the
+	contests. other_runs is the plan's columns the style doesn't use, as
+	(start, stop) slices of a row - few of them, since a style's contests
+	are usually next to each other in the export.
+	"""
+
+	def __init__(self, name, columns, other_indexes):
+		self.name = name
+		self.columns = columns
+		self.contests = tuple(contest for index, contest, lookup in columns)
+		self.other_runs = []
+		for index in sorted(other_indexes):
+			if self.other_runs and self.other_runs[-1][1] == index:
+				self.other_runs[-1][1] = index + 1
+			else:
+				self.other_runs.append([index, index + 1])
+
+
+class EssCsvReader:
+	"""Reads an ESS CVR export, compiling an EssPlan from its header.
+
+	Iterating over the reader gives the raw rows as lists; cvrs() gives a CVR
+	per row.
+	"""
+
+	def __init__(self, f, election):
+		self.rows = csv.reader(f)
+		self.header = next(self.rows)
+		self.plan = EssPlan(self.header, election)
+
+	def __iter__(self):
+		return self.rows
+
+	def cvrs(self, compact=False):
+		return self.plan.cvrs(self.rows, compact)
@@ -0,0 +1,207 @@
+from array import array
+from bisect import bisect_left
+import hashlib
+from io import BytesIO
+import os
+import struct
+import sys
+import xml.etree.ElementTree as ET
+
+from .compression import codec_for
+from .reader import CastVoteRecordReportReader
+from .scan import ReportScanner, read_envelope, root_namespaces, standalone_fragment, fragment_unique_id, _CVR_START, _CVR_END, _ROOT_START_TAG
+from .table import np
+
+#
+# An index file is a header - the magic, how many CVRs and the size of the
+# report it's for - and then four little-endian arrays of that many items:
+# each CVR's byte offset (Q) and length (I) in report order, then a 64-bit
+# hash of each UniqueId (Q) sorted, with the ordinal of the CVR it came from
+# (I) alongside.
+#
+_MAGIC = b'CVRINDX1'
+_HEADER = struct.Struct('<8sQQ')
+INDEX_SUFFIX = '.idx'
+_UNIQUE_ID_START = b'<UniqueId>'
+
+
+def index_path_for(report_path):
+	"""Where the index for report_path goes by default: next to it, with .idx added."""
+	return report_path + INDEX_SUFFIX
+
+
+def _key(unique_id):
+	# hash() is salted per process, so the index needs a hash of its own
+	return int.from_bytes(hashlib.blake2b(unique_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _little_endian(items):
+	if sys.byteorder == 'big':
+		items = array(items.typecode, items)
+		items.byteswap()
+	return items
+
+
+class ReportIndexBuilder:
+	"""Collects where each CVR in a report is, and saves it as an index file.
+
+	Either add() each CVR's UniqueId, byte offset and length - as
+	build_index() does from a ReportScanner - or feed() it the report's bytes
+	in the order they're written, as CastVoteRecordReportWriter does when
+	it's given one, and it finds the CVRs in them. Every call to feed() has to
+	hold whole CVRs, which is how the writer writes them. Offsets are in the
+	uncompressed report, so an index is only any use next to an uncompressed
+	one.
+	"""
+
+	def __init__(self):
+		self.offsets = array('Q')
+		self.lengths = array('I')
+		self.keys = array('Q')
+		# bytes fed so far, which is the report's size once it's all written
+		self.size = 0
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def add(self, unique_id, offset, length):
+		self.offsets.append(offset)
+		self.lengths.append(length)
+		# a CVR without a UniqueId can still be got at by its ordinal
+		self.keys.append(_key(unique_id) if unique_id is not None else 0)
+
+	def feed(self, data):
+		pos = 0
+		while True:
+			match = _CVR_START.search(data, pos)
+			if match is None:
+				break
+			start = match.start()
+			end = data.index(_CVR_END, match.end()) + len(_CVR_END)
+			# UniqueId is near the end of a CVR, so look for it from there rather than with a regex from the start
+			unique_id = data.rfind(_UNIQUE_ID_START, start, end)
+			if unique_id >= 0:
+				unique_id += len(_UNIQUE_ID_START)
+				unique_id = data[unique_id:data.index(b'</UniqueId>', unique_id)].strip().decode('utf-8')
+			else:
+				unique_id = None
+			self.add(unique_id, self.size + start, end - start)
+			pos = end
+		self.size += len(data)
+
+	def _sorted_keys(self):
+		if np is not None:
+			keys = np.frombuffer(self.keys, dtype=np.uint64)
+			# stable, so CVRs with the same UniqueId stay in report order
+			order = np.argsort(keys, kind='stable')
+			return array('Q', keys[order].tobytes()), array('I', order.astype(np.uint32).tobytes())
+		order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+		return array('Q', [self.keys[i] for i in order]), array('I', order)
+
+	def save(self, path, report_size=None):
+		"""Write the index to path. report_size defaults to the bytes fed to feed()."""
+		keys, ordinals = self._sorted_keys()
+		with open(path, 'wb') as f:
+			f.write(_HEADER.pack(_MAGIC, len(self), self.size if report_size is None else report_size))
+			for items in (self.offsets, self.lengths, keys, ordinals):
+				_little_endian(items).tofile(f)
+
+
+def build_index(report_path, index_path=None):
+	"""Index an existing report in one pass with a ReportScanner, returning how many CVRs it has."""
+	if codec_for(report_path) is not None:
+		raise ValueError('{} is compressed, and an index needs to seek in the report; decompress it first'.format(report_path))
+	builder = ReportIndexBuilder()
+	with open(report_path, 'rb') as f:
+		scanner = ReportScanner(f)
+		for fragment in scanner:
+			builder.add(fragment_unique_id(fragment.data), fragment.offset, len(fragment.data))
+		size = f.tell()
+	builder.save(index_path or index_path_for(report_path), size)
+	return len(builder)
+
+
+def _read_array(f, typecode, count):
+	items = array(typecode)
+	items.fromfile(f, count)
+	if sys.byteorder == 'big':
+		items.byteswap()
+	return items
+
+
+class IndexedReport:
+	"""Random access to the CVRs in a report, through its index file.
+
+	get_cvr_by_index(n) gives the nth CVR in the report and get_cvr(uid) the
+	one with that UniqueId (the first, if there's more than one); either way
+	only that CVR's bytes are read and parsed, plus the report metadata once
+	at the start, which comes from the two ends of the file. fragment(n) is
+	the raw <CVR> element if that's all that's wanted.
+
+	The index is index_path, or the report's name with .idx added. If the
+	report isn't the size the index says it should be, it has changed since
+	it was indexed and that's a ValueError.
+	"""
+
+	def __init__(self, report_path, index_path=None):
+		if codec_for(report_path) is not None:
+			raise ValueError('{} is compressed, so it can\'t be read at random; decompress it first'.format(report_path))
+		self.report_path = report_path
+		self.index_path = index_path or index_path_for(report_path)
+		with open(self.index_path, 'rb') as f:
+			magic, count, report_size = _HEADER.unpack(f.read(_HEADER.size))
+			if magic != _MAGIC:
+				raise ValueError('{} isn\'t a CVR index'.format(self.index_path))
+			self.offsets = _read_array(f, 'Q', count)
+			self.lengths = _read_array(f, 'I', count)
+			self._keys = _read_array(f, 'Q', count)
+			self._ordinals = _read_array(f, 'I', count)
+		self._f = open(report_path, 'rb')
+		try:
+			actual_size = os.fstat(self._f.fileno()).st_size
+			if actual_size != report_size:
+				raise ValueError('{} is {} bytes but its index is for {} bytes; rebuild the index'.format(report_path, actual_size, report_size))
+			envelope = read_envelope(self._f)
+		except BaseException:
+			self._f.close()
+			raise
+		self._reader = CastVoteRecordReportReader(BytesIO(envelope))
+		self.report = self._reader.read_metadata()
+		self._namespaces = root_namespaces(_ROOT_START_TAG.search(envelope).group())
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def close(self):
+		self._f.close()
+
+	def fragment(self, n):
+		"""The bytes of the nth CVR, from <CVR> to </CVR>."""
+		if not -len(self) <= n < len(self):
+			raise IndexError('CVR {} is out of range for a report of {}'.format(n, len(self)))
+		self._f.seek(self.offsets[n])
+		return self._f.read(self.lengths[n])
+
+	def get_cvr_by_index(self, n):
+		return self._reader._parse_cvr(ET.fromstring(standalone_fragment(self.fragment(n), self._namespaces)))
+
+	def index_of(self, unique_id):
+		"""The ordinal of the CVR with this UniqueId, or a KeyError."""
+		key = _key(unique_id)
+		i = bisect_left(self._keys, key)
+		# a different UniqueId can share the hash, so check each one that does
+		while i < len(self._keys) and self._keys[i] == key:
+			n = self._ordinals[i]
+			if fragment_unique_id(self.fragment(n)) == unique_id:
+				return n
+			i += 1
+		raise KeyError(unique_id)
+
+	def get_cvr(self, unique_id):
+		return self.get_cvr_by_index(self.index_of(unique_id))
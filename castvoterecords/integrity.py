@@ -0,0 +1,339 @@
+from array import array
+from collections import namedtuple
+import heapq
+import re
+import struct
+import tempfile
+
+from .CastVoteRecords import _as_list
+from .compression import open_compressed
+from .ess import EssCsvReader
+from .reader import CastVoteRecordReportReader
+from .scan import ReportScanner, fragment_unique_id, _OBJECT_ID
+from .table import np
+
+_ELECTION_ID = re.compile(rb'<ElectionId>\s*([^<]*?)\s*</ElectionId>')
+_CURRENT_SNAPSHOT_ID = re.compile(rb'<CurrentSnapshotId>\s*([^<]*?)\s*</CurrentSnapshotId>')
+_CVR_CONTEST = re.compile(rb'<CVRContest>(.*?)</CVRContest>', re.DOTALL)
+_CONTEST_ID = re.compile(rb'<ContestId>\s*([^<]*?)\s*</ContestId>')
+_CONTEST_SELECTION_ID = re.compile(rb'<ContestSelectionId>\s*([^<]*?)\s*</ContestSelectionId>')
+
+# what's wrong (one of the kinds below), the id it's about, and where: for a
+# report the CVR's byte offset and line, for an ESS export the row number
+IntegrityProblem = namedtuple('IntegrityProblem', ['kind', 'id', 'message', 'offset', 'line'])
+
+DUPLICATE_UNIQUE_ID = 'duplicate-unique-id'
+DUPLICATE_OBJECT_ID = 'duplicate-object-id'
+UNKNOWN_ELECTION = 'unknown-election'
+UNKNOWN_CONTEST = 'unknown-contest'
+SELECTION_NOT_IN_CONTEST = 'selection-not-in-contest'
+REPEATED_CONTEST = 'repeated-contest'
+BAD_CURRENT_SNAPSHOT = 'bad-current-snapshot'
+UNKNOWN_SELECTION = 'unknown-selection'
+
+_PAIR = struct.Struct('<QQ')
+_MASK = (1 << 64) - 1
+
+
+class HashedIds:
+	"""Finds ids that turn up more than once, in memory that doesn't depend on how many there are.
+
+	add() keeps a 64-bit hash of each id with the ordinal of the record it
+	came from - 16 bytes an id, where a set of the strings would take ten
+	times that. Once memory_budget bytes of them have built up they're
+	sorted by hash and spilled to a run file in tmpdir, and duplicates()
+	merges the runs with heapq.merge() to find the hashes that occur more
+	than once.
+
+	Two different ids can share a hash, so what duplicates() gives are
+	candidates; the caller checks the actual ids (IntegrityChecker makes a
+	second pass for them). Hashes are Python's own, so a HashedIds only
+	makes sense within one process.
+	"""
+
+	def __init__(self, memory_budget=128 << 20, tmpdir=None):
+		# without NumPy, sorting goes through Python ints at ~100 bytes each
+		self.capacity = max(1024, memory_budget // (16 if np is not None else 100))
+		self.tmpdir = tmpdir
+		self._hashes = array('Q')
+		self._ordinals = array('Q')
+		self._runs = []
+		self.count = 0
+
+	def add(self, id_value, ordinal):
+		self._hashes.append(hash(id_value) & _MASK)
+		self._ordinals.append(ordinal)
+		self.count += 1
+		if len(self._hashes) >= self.capacity:
+			self._spill()
+
+	def _sorted_pairs(self):
+		# the buffered (hash, ordinal) pairs in hash order, ordinals in order for equal hashes
+		if np is not None:
+			hashes = np.frombuffer(self._hashes, dtype=np.uint64)
+			ordinals = np.frombuffer(self._ordinals, dtype=np.uint64)
+			order = np.lexsort((ordinals, hashes))
+			pairs = np.empty((len(order), 2), dtype='<u8')
+			pairs[:, 0] = hashes[order]
+			pairs[:, 1] = ordinals[order]
+			return pairs
+		return sorted(zip(self._hashes, self._ordinals))
+
+	def _spill(self):
+		pairs = self._sorted_pairs()
+		run = tempfile.TemporaryFile(dir=self.tmpdir)
+		if np is not None:
+			run.write(pairs.tobytes())
+		else:
+			run.write(b''.join(_PAIR.pack(h, o) for h, o in pairs))
+		run.seek(0)
+		self._runs.append(run)
+		self._hashes = array('Q')
+		self._ordinals = array('Q')
+
+	def _read_run(self, run, block=1 << 16):
+		while True:
+			data = run.read(_PAIR.size * block)
+			if not data:
+				return
+			yield from _PAIR.iter_unpack(data)
+
+	def duplicates(self):
+		"""Yield the ordinals, in order, of each group of ids that share a hash."""
+		if not self._runs:
+			# it all fit in memory, so there's nothing to merge
+			pairs = self._sorted_pairs()
+			if np is not None and len(pairs):
+				hashes = pairs[:, 0]
+				repeated = hashes[1:] == hashes[:-1]
+				if not repeated.any():
+					return
+				pairs = pairs[np.concatenate(([False], repeated)) | np.concatenate((repeated, [False]))].tolist()
+			merged = iter(pairs)
+		else:
+			if len(self._hashes):
+				self._spill()
+			merged = heapq.merge(*(self._read_run(run) for run in self._runs))
+
+		group = []
+		last = None
+		for h, ordinal in merged:
+			if h != last:
+				if len(group) > 1:
+					yield group
+				group = []
+				last = h
+			group.append(ordinal)
+		if len(group) > 1:
+			yield group
+
+	def close(self):
+		for run in self._runs:
+			run.close()
+		self._runs = []
+
+
+class IntegrityResult:
+	"""What a check found: problems holds the first max_problems of them, and problem_count counts them all."""
+
+	def __init__(self, max_problems):
+		self.max_problems = max_problems
+		self.problems = []
+		self.problem_count = 0
+		self.records = 0
+
+	def add(self, kind, id_value, message, offset=None, line=None):
+		self.problem_count += 1
+		if self.max_problems is None or len(self.problems) < self.max_problems:
+			if isinstance(id_value, bytes):
+				id_value = id_value.decode('utf-8', 'replace')
+			self.problems.append(IntegrityProblem(kind, id_value, message, offset, line))
+
+	def __bool__(self):
+		# true when the report is clean, like validate_document()'s result
+		return self.problem_count == 0
+
+
+class IntegrityChecker:
+	"""Streams a report (or an ESS export) looking for duplicate ids and broken references.
+
+	For a report, every CVR is checked against the Election's indexes as it
+	goes past: its ElectionId has to be one of the report's Elections, each
+	ContestId a Contest in that Election (and only once per CVR), each
+	ContestSelectionId a selection of that very Contest, and
+	CurrentSnapshotId one of the CVR's own snapshots. UniqueIds and ObjectIds
+	(including the metadata's) go into HashedIds, so finding duplicates
+	among tens of millions of CVRs takes about memory_budget bytes and some
+	temporary files. If any hashes repeat, a second pass picks out the
+	actual ids to report.
+
+	For an ESS export, each row's CVR number must be unique and each cell
+	one of its contest's selections (or overvote, undervote or a write-in).
+
+	The CVRs are found with ReportScanner and picked apart with regular
+	expressions rather than parsed, so this expects the layout this package
+	writes; validate.py checks everything else the schema says.
+	"""
+
+	def __init__(self, memory_budget=256 << 20, tmpdir=None, max_problems=1000):
+		self.memory_budget = memory_budget
+		self.tmpdir = tmpdir
+		self.max_problems = max_problems
+
+	def check_report(self, path):
+		result = IntegrityResult(self.max_problems)
+		report = CastVoteRecordReportReader(path).read_metadata()
+		elections = {election.id: election for election in _as_list(report.election)}
+
+		unique_ids = HashedIds(self.memory_budget // 2, self.tmpdir)
+		object_ids = HashedIds(self.memory_budget // 2, self.tmpdir)
+		try:
+			# ordinal 0 is the report metadata, and CVRs count from 1
+			for element in report.trailer_elements():
+				for elem in element.iter():
+					if elem.get('ObjectId') is not None:
+						object_ids.add(elem.get('ObjectId').encode('utf-8'), 0)
+
+			with open_compressed(path) as f:
+				for ordinal, fragment in enumerate(ReportScanner(f), 1):
+					data = fragment.data
+					unique_ids.add(fragment_unique_id(data), ordinal)
+					snapshot_ids = _OBJECT_ID.findall(data)
+					for object_id in snapshot_ids:
+						object_ids.add(object_id, ordinal)
+					self._check_references(data, fragment, snapshot_ids, elections, result)
+					result.records = ordinal
+
+			self._report_duplicates(path, unique_ids, object_ids, result)
+		finally:
+			unique_ids.close()
+			object_ids.close()
+		return result
+
+	def _check_references(self, data, fragment, snapshot_ids, elections, result):
+		unique_id = fragment_unique_id(data)
+		current = _CURRENT_SNAPSHOT_ID.search(data)
+		if current is None or current.group(1) not in snapshot_ids:
+			result.add(BAD_CURRENT_SNAPSHOT, unique_id, 'CurrentSnapshotId {} is not one of the CVR\'s snapshots'.format(
+				current.group(1).decode('utf-8') if current else None), fragment.offset, fragment.line)
+
+		match = _ELECTION_ID.search(data)
+		election_id = match.group(1).decode('utf-8') if match else None
+		election = elections.get(election_id)
+		if election is None:
+			result.add(UNKNOWN_ELECTION, unique_id, 'ElectionId {} is not an Election in the report'.format(
+				election_id), fragment.offset, fragment.line)
+			return
+
+		seen = set()
+		for cvr_contest in _CVR_CONTEST.finditer(data):
+			block = cvr_contest.group(1)
+			match = _CONTEST_ID.search(block)
+			contest_id = match.group(1).decode('utf-8') if match else ''
+			try:
+				contest = election.contest_by_id(contest_id)
+			except KeyError:
+				result.add(UNKNOWN_CONTEST, unique_id, 'ContestId {} is not a Contest in Election {}'.format(
+					contest_id, election_id), fragment.offset, fragment.line)
+				continue
+			if contest_id in seen:
+				result.add(REPEATED_CONTEST, unique_id, 'Contest {} appears more than once in the CVR'.format(
+					contest_id), fragment.offset, fragment.line)
+			seen.add(contest_id)
+			for selection_id in _CONTEST_SELECTION_ID.findall(block):
+				selection_id = selection_id.decode('utf-8')
+				try:
+					contest.selection_by_id(selection_id)
+				except KeyError:
+					result.add(SELECTION_NOT_IN_CONTEST, unique_id, 'ContestSelectionId {} is not a selection in Contest {}'.format(
+						selection_id, contest_id), fragment.offset, fragment.line)
+
+	def _report_duplicates(self, path, unique_ids, object_ids, result):
+		# ordinal -> the kinds of id it shares a hash on, for every CVR in a group whose hashes match
+		flagged = {}
+		for kind, ids in ((DUPLICATE_UNIQUE_ID, unique_ids), (DUPLICATE_OBJECT_ID, object_ids)):
+			for ordinals in ids.duplicates():
+				for ordinal in ordinals:
+					flagged.setdefault(ordinal, set()).add(kind)
+		if not flagged:
+			return
+
+		# second pass: the actual ids, and where they are, for just the flagged CVRs
+		found = {DUPLICATE_UNIQUE_ID: {}, DUPLICATE_OBJECT_ID: {}}
+		if 0 in flagged:
+			report = CastVoteRecordReportReader(path).read_metadata()
+			for element in report.trailer_elements():
+				for elem in element.iter():
+					if elem.get('ObjectId') is not None:
+						found[DUPLICATE_OBJECT_ID].setdefault(elem.get('ObjectId'), []).append((None, None))
+		with open_compressed(path) as f:
+			for ordinal, fragment in enumerate(ReportScanner(f), 1):
+				kinds = flagged.get(ordinal)
+				if kinds is None:
+					continue
+				where = (fragment.offset, fragment.line)
+				if DUPLICATE_UNIQUE_ID in kinds:
+					found[DUPLICATE_UNIQUE_ID].setdefault(fragment_unique_id(fragment.data), []).append(where)
+				if DUPLICATE_OBJECT_ID in kinds:
+					for object_id in _OBJECT_ID.findall(fragment.data):
+						found[DUPLICATE_OBJECT_ID].setdefault(object_id.decode('utf-8'), []).append(where)
+
+		for kind, ids in found.items():
+			label = 'UniqueId' if kind == DUPLICATE_UNIQUE_ID else 'ObjectId'
+			for id_value, places in ids.items():
+				if len(places) < 2:
+					# a hash collision, or the other half of a group that's already reported
+					continue
+				first = places[0]
+				for offset, line in places[1:]:
+					result.add(kind, id_value, '{} {} is already used{}'.format(label, id_value,
+						' at line {}'.format(first[1]) if first[1] is not None else ' in the report metadata'), offset, line)
+
+	def check_ess_csv(self, f, election):
+		"""Check an ESS export (an open text file) against election."""
+		result = IntegrityResult(self.max_problems)
+		reader = EssCsvReader(f, election)
+		plan = reader.plan
+		numbers = HashedIds(self.memory_budget, self.tmpdir)
+		try:
+			# rows count from 2, under the header, like a spreadsheet would show them
+			for row_number, row in enumerate(reader, 2):
+				number = row[plan.id_index]
+				numbers.add(number, row_number)
+				for index, contest, lookup in plan.ballot_style(row).columns:
+					value = row[index]
+					if value:
+						try:
+							plan._decode(value, contest, lookup)
+						except ValueError as e:
+							result.add(UNKNOWN_SELECTION, number, 'Row {}: {}'.format(row_number, e), line=row_number)
+				result.records += 1
+
+			flagged = set()
+			for ordinals in numbers.duplicates():
+				flagged.update(ordinals)
+			if flagged:
+				# second pass for the actual numbers
+				f.seek(0)
+				reader = EssCsvReader(f, election)
+				rows = {}
+				for row_number, row in enumerate(reader, 2):
+					if row_number in flagged:
+						rows.setdefault(row[plan.id_index], []).append(row_number)
+				for number, row_numbers in rows.items():
+					for row_number in row_numbers[1:]:
+						result.add(DUPLICATE_UNIQUE_ID, number, 'Row {}: CVR number {} is already used on row {}'.format(
+							row_number, number, row_numbers[0]), line=row_number)
+		finally:
+			numbers.close()
+		return result
+
+
+def check_report(path, memory_budget=256 << 20, tmpdir=None, max_problems=1000):
+	"""Check the report at path for duplicate ids and broken references; see IntegrityChecker."""
+	return IntegrityChecker(memory_budget, tmpdir, max_problems).check_report(path)
+
+
+def check_ess_csv(f, election, memory_budget=256 << 20, tmpdir=None, max_problems=1000):
+	"""Check an ESS export for duplicate CVR numbers and unknown selections; see IntegrityChecker."""
+	return IntegrityChecker(memory_budget, tmpdir, max_problems).check_ess_csv(f, election)
@@ -0,0 +1,332 @@
+import codecs
+import json
+
+from .CastVoteRecords import (Code, Candidate, Party, IdentifierType, CandidateContest, VoteVariation, CandidateSelection,
+	CVRContestSelection, CVRContest, CVRSnapshot, CVR, Election, GpUnit, ReportingUnitType, CastVoteRecordReport,
+	ReportingDevice, BallotMeasureContest, BallotMeasureSelection)
+from .CastVoteRecords import _as_list
+from .compression import open_compressed
+from .reader import _lookup, _one_or_list
+
+_WHITESPACE = ' \t\n\r'
+
+
+class _JsonStream:
+	# Pulls one JSON value at a time out of a file with raw_decode(), reading
+	# more of the file whenever a value runs past the end of what's buffered.
+
+	def __init__(self, f, chunk_size):
+		self.f = f
+		self.chunk_size = chunk_size
+		self.buf = ''
+		self.pos = 0
+		self.eof = False
+		self._decode = json.JSONDecoder().raw_decode
+		self._decoder = None
+
+	def _fill(self):
+		if self.eof:
+			return False
+		chunk = self.f.read(self.chunk_size)
+		if isinstance(chunk, bytes):
+			if self._decoder is None:
+				self._decoder = codecs.getincrementaldecoder('utf-8-sig')()
+			chunk = self._decoder.decode(chunk, final=not chunk)
+		if not chunk:
+			self.eof = True
+		# drop what's been used up rather than let the buffer grow with the file
+		self.buf = self.buf[self.pos:] + chunk
+		self.pos = 0
+		return True
+
+	def peek(self):
+		"""The next non-whitespace character, or '' at the end of the file."""
+		while True:
+			buf = self.buf
+			pos = self.pos
+			while pos < len(buf) and buf[pos] in _WHITESPACE:
+				pos += 1
+			self.pos = pos
+			if pos < len(buf):
+				return buf[pos]
+			if not self._fill():
+				return ''
+
+	def expect(self, chars):
+		c = self.peek()
+		if not c or c not in chars:
+			raise ValueError('Expected {!r} in JSON, found {!r}'.format(chars, c or 'end of file'))
+		self.pos += 1
+		return c
+
+	def value(self):
+		self.peek()
+		while True:
+			try:
+				value, end = self._decode(self.buf, self.pos)
+			except json.JSONDecodeError:
+				if not self._fill():
+					raise
+				continue
+			# a number running up to the end of the buffer might carry on in the next chunk
+			if end == len(self.buf) and not self.eof:
+				self._fill()
+				continue
+			self.pos = end
+			return value
+
+
+class CastVoteRecordReportJsonReader:
+	"""Reads a NIST CVR JSON report a ballot at a time.
+
+	Takes the JSON CastVoteRecordReportJsonWriter writes, in either form: one
+	object with the metadata ahead of the CVR array, or NDJSON with the
+	metadata on the first line and a CVR on each line after it. Only one CVR
+	is held in memory at a time. read_metadata() returns the report without
+	its CVRs, and iterating over the reader yields CVR dataclasses whose
+	references point at the Election's objects, just as
+	CastVoteRecordReportReader does for XML.
+
+	If the CVR array comes before the Election (JSON written by something
+	else, say), the reader has to skip over the CVRs to find the metadata and
+	then go back, so source must then be a file name or a seekable file. Files
+	named .gz, .xz or .bz2 are decompressed as they're read.
+	"""
+
+	def __init__(self, source, chunk_size=1 << 20):
+		self.source = source
+		self.chunk_size = chunk_size
+		self._start = None if isinstance(source, str) else source.tell()
+		self.report = None
+		self.elections = {}
+		# the stream left at the start of the CVRs by read_metadata(), and whether they're an array
+		self._stream = None
+		self._in_array = None
+
+	def _open(self):
+		if self._start is None:
+			return _JsonStream(open_compressed(self.source), self.chunk_size)
+		self.source.seek(self._start)
+		return _JsonStream(self.source, self.chunk_size)
+
+	def _close(self, stream):
+		if self._start is None:
+			stream.f.close()
+
+	def _members(self, stream):
+		# read the report's members up to the CVR array, leaving stream at its '['
+		members = {}
+		stream.expect('{')
+		if stream.peek() == '}':
+			stream.pos += 1
+			return members, False
+		while True:
+			key = stream.value()
+			stream.expect(':')
+			if key == 'CVR':
+				return members, True
+			members[key] = stream.value()
+			if stream.expect(',}') == '}':
+				return members, False
+
+	def read_metadata(self):
+		"""Read the report's metadata and return the report without its CVRs."""
+		if self.report is not None:
+			return self.report
+
+		stream = self._open()
+		members, in_array = self._members(stream)
+		if in_array and 'Election' not in members:
+			# the CVRs come first: skip them, read the rest, then come back for them
+			if self._start is not None and not self.source.seekable():
+				raise ValueError('The CVRs come before the Election in this JSON, so the reader needs a file name or a seekable file')
+			for _ in self._array(stream):
+				pass
+			while stream.expect(',}') == ',':
+				key = stream.value()
+				stream.expect(':')
+				members[key] = stream.value()
+			self._close(stream)
+			stream = self._open()
+			self._members(stream)
+
+		self._stream = stream
+		self._in_array = in_array
+		self.report = report_from_json(members)
+		self.elections = {election.id: election for election in _as_list(self.report.election)}
+		return self.report
+
+	def _array(self, stream):
+		stream.expect('[')
+		if stream.peek() == ']':
+			stream.pos += 1
+			return
+		while True:
+			yield stream.value()
+			if stream.expect(',]') == ']':
+				return
+
+	def _ndjson(self, stream):
+		while stream.peek():
+			yield stream.value()
+
+	def __iter__(self):
+		"""Yield the report's CVRs one at a time."""
+		self.read_metadata()
+		stream = self._stream
+		self._stream = None
+		if stream is None:
+			# a second time through
+			stream = self._open()
+			self._members(stream)
+		try:
+			values = self._array(stream) if self._in_array else self._ndjson(stream)
+			for value in values:
+				yield self._parse_cvr(value)
+		finally:
+			self._close(stream)
+
+	def _parse_cvr(self, value):
+		election = _lookup(self.elections.get, value.get('ElectionId'), 'Election', 'CVR')
+		cvr = CVR(id=value.get('UniqueId'), election=election,
+			cvr_snapshot=[_parse_cvr_snapshot(snapshot, election) for snapshot in value.get('CVRSnapshot', ())])
+
+		# to_json() treats the first snapshot as the current one
+		current_snapshot_id = value.get('CurrentSnapshotId')
+		for i, snapshot in enumerate(cvr.cvr_snapshot):
+			if snapshot.id == current_snapshot_id:
+				cvr.cvr_snapshot.insert(0, cvr.cvr_snapshot.pop(i))
+				break
+		return cvr
+
+
+def report_from_json(members):
+	"""A CastVoteRecordReport (without CVRs) from the members of a JSON report, with its references resolved."""
+	parties = [_parse_party(party) for party in members.get('Party', ())]
+	gp_units = [_parse_gp_unit(gp_unit) for gp_unit in members.get('GpUnit', ())]
+	devices = [_parse_reporting_device(device) for device in members.get('ReportingDevice', ())]
+	elections = [_parse_election(election) for election in members.get('Election', ())]
+
+	parties_by_id = {party.id: party for party in parties}
+	gp_units_by_id = {gp_unit.id: gp_unit for gp_unit in gp_units}
+	for election in elections:
+		for candidate in election.candidates:
+			if candidate.party is not None:
+				candidate.party = _lookup(parties_by_id.get, candidate.party.id, 'Party', candidate.id)
+		if election.election_scope is not None:
+			election.election_scope = _lookup(gp_units_by_id.get, election.election_scope.id, 'GpUnit', election.id)
+
+	report = CastVoteRecordReport(parties=parties, generatedDate=members.get('GeneratedDate'), notes=members.get('Notes'))
+	if 'Version' in members:
+		report.version = members['Version']
+	report.election = _one_or_list(elections)
+	report.gp_unit = _one_or_list(gp_units)
+	report.reporting_device = _one_or_list(devices)
+	return report
+
+
+def _parse_cvr_snapshot(value, election):
+	return CVRSnapshot(id=value.get('@id'), cvr_contests=[_parse_cvr_contest(cvr_contest, election) for cvr_contest in value.get('CVRContest', ())])
+
+
+def _parse_cvr_contest(value, election):
+	contest = _lookup(election.contest_by_id, value.get('ContestId'), 'Contest', 'CVRContest')
+	cvr_contest = CVRContest(contest=contest, overvotes=value.get('Overvotes', 0), undervotes=value.get('Undervotes', 0),
+		writeins=value.get('WriteIns', 0))
+	if 'CVRContestSelection' in value:
+		cvr_contest.cvr_contest_selection = [
+			CVRContestSelection(contest_selection=_lookup(contest.selection_by_id, cvr_contest_sel.get('ContestSelectionId'), 'ContestSelection', 'CVRContestSelection'))
+			for cvr_contest_sel in value['CVRContestSelection']]
+	return cvr_contest
+
+
+def _parse_code(value):
+	codes = value if isinstance(value, list) else [value]
+	if not codes:
+		return None
+	# the classes hold a single Code
+	code = codes[0]
+	return Code(code_type=IdentifierType(code['Type']) if 'Type' in code else None, value=code.get('Value'),
+		label=code.get('Label'), other_type=code.get('OtherType'))
+
+
+def _parse_party(value):
+	return Party(id=value.get('@id'), abbreviation=value.get('Abbreviation'), name=value.get('Name'))
+
+
+def _parse_reporting_device(value):
+	return ReportingDevice(id=value.get('@id'), model=value.get('Model'), notes=value.get('Notes'))
+
+
+def _parse_gp_unit(value):
+	gp_unit = GpUnit(id=value.get('@id'), name=value.get('Name'))
+	if 'Code' in value:
+		gp_unit.code = _parse_code(value['Code'])
+	if 'Type' in value:
+		gp_unit.gp_type = ReportingUnitType(value['Type'])
+	return gp_unit
+
+
+def _parse_candidate(value):
+	candidate = Candidate(id=value.get('@id'), name=value.get('Name'))
+	if 'PartyId' in value:
+		# swapped for the real Party once the report's parties have been read
+		candidate.party = Party(id=value['PartyId'])
+	if 'Code' in value:
+		candidate.code = _parse_code(value['Code'])
+	return candidate
+
+
+def _parse_election(value):
+	election = Election(id=value.get('@id'), name=value.get('Name'), candidates=[], contests=[])
+	candidates_by_id = {}
+	for candidate_value in value.get('Candidate', ()):
+		candidate = _parse_candidate(candidate_value)
+		candidates_by_id[candidate.id] = candidate
+		election.candidates.append(candidate)
+	for contest_value in value.get('Contest', ()):
+		election.contests.append(_parse_contest(contest_value, candidates_by_id))
+	if 'ElectionScopeId' in value:
+		# swapped for the real GpUnit once the report's GpUnits have been read
+		election.election_scope = GpUnit(id=value['ElectionScopeId'])
+	return election
+
+
+def _parse_contest(value, candidates_by_id):
+	if value.get('@type') == 'CVR.BallotMeasureContest':
+		contest = BallotMeasureContest(id=value.get('@id'))
+	else:
+		contest = CandidateContest(id=value.get('@id'))
+		contest.number_elected = value.get('NumberElected', contest.number_elected)
+		contest.votes_allowed = value.get('VotesAllowed', contest.votes_allowed)
+	contest.name = value.get('Name')
+	contest.abbreviation = value.get('Abbreviation')
+	if 'Code' in value:
+		contest.code = _parse_code(value['Code'])
+	if 'VoteVariation' in value:
+		contest.vote_variation = VoteVariation(value['VoteVariation'])
+	contest.other_vote_variation = value.get('OtherVoteVariation')
+	contest.contest_selections = [_parse_contest_selection(sel, candidates_by_id, contest.id) for sel in value.get('ContestSelection', ())]
+	return contest
+
+
+def _parse_contest_selection(value, candidates_by_id, contest_id):
+	if value.get('@type') == 'CVR.BallotMeasureSelection':
+		return BallotMeasureSelection(id=value.get('@id'), selection=value.get('Selection'))
+
+	selection = CandidateSelection(id=value.get('@id'), is_write_in=value.get('IsWriteIn', False))
+	candidate_ids = value.get('CandidateIds')
+	if candidate_ids:
+		# the schema allows a list of ids here, but CandidateSelection holds a single candidate
+		selection.candidate = _lookup(candidates_by_id.get, candidate_ids[0], 'Candidate', contest_id)
+	if 'Code' in value:
+		selection.code = _parse_code(value['Code'])
+	return selection
+
+
+def read_json_report(source):
+	"""Read a whole (small) JSON report, CVRs and all, into a CastVoteRecordReport."""
+	reader = CastVoteRecordReportJsonReader(source)
+	report = reader.read_metadata()
+	report.cvrs = list(reader)
+	return report
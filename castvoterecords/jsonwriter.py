@@ -0,0 +1,180 @@
+import json
+from json.encoder import encode_basestring_ascii as _quote
+
+from .CastVoteRecords import CVRType
+from .metrics import NULL_METRICS
+from .templates import MAX_CACHED_OUTCOMES
+
+# compact, and what json.dumps(obj, separators=_SEPARATORS) gives is what the fast path writes
+_SEPARATORS = (',', ':')
+_dumps = json.JSONEncoder(separators=_SEPARATORS).encode
+
+
+class CVRJsonTemplates:
+	"""Serializes CVRs to JSON by joining cached strings, like CVRTemplates does for XML.
+
+	The JSON for each distinct contest outcome is cached the first time
+	it's seen. The output is exactly json.dumps(cvr.to_json()) with compact
+	separators.
+	"""
+
+	def __init__(self):
+		self._outcomes = {}
+		self._snapshot_end = ',"Type":{}}}],"ElectionId":'.format(_quote(CVRType.ORIGINAL.value))
+
+	def cvr_contest_to_json(self, cvr_contest):
+		selections = cvr_contest.cvr_contest_selection
+		key = (cvr_contest.contest.id,
+			tuple(sel.contest_selection.id for sel in selections) if selections else (),
+			cvr_contest.overvotes, cvr_contest.undervotes, cvr_contest.writeins)
+		try:
+			return self._outcomes[key]
+		except KeyError:
+			pass
+		fragment = _dumps(cvr_contest.to_json())
+		if len(self._outcomes) < MAX_CACHED_OUTCOMES:
+			self._outcomes[key] = fragment
+		return fragment
+
+	def cvr_to_json(self, cvr):
+		snapshot = cvr.cvr_snapshot[0]
+		snapshot_id = _quote(snapshot.id)
+		parts = ['{"@type":"CVR.CVR","CurrentSnapshotId":', snapshot_id, ',"CVRSnapshot":[{"@type":"CVR.CVRSnapshot","@id":', snapshot_id]
+		if snapshot.cvr_contests:
+			parts.append(',"CVRContest":[')
+			parts.append(','.join([self.cvr_contest_to_json(cvr_contest) for cvr_contest in snapshot.cvr_contests]))
+			parts.append(']')
+		parts.append(self._snapshot_end)
+		parts.append(_quote(cvr.election.id))
+		parts.append(',"UniqueId":')
+		parts.append(_quote(cvr.id))
+		parts.append('}')
+		return ''.join(parts)
+
+
+_templates = None
+
+
+def cvr_to_json(cvr, fast=True):
+	"""A CVR as a line of compact JSON; fast=False goes through cvr.to_json() and gives the same string."""
+	global _templates
+	if not fast:
+		return _dumps(cvr.to_json())
+	if _templates is None:
+		_templates = CVRJsonTemplates()
+	return _templates.cvr_to_json(cvr)
+
+
+class CastVoteRecordReportJsonWriter:
+	"""Writes a CastVoteRecordReport as NIST CVR JSON to a binary file object one CVR at a time.
+
+	Like CastVoteRecordReportWriter, the report supplies everything but the
+	CVRs, which are written as they're handed over. The report metadata is
+	written first, before the CVR array, so a reader can resolve each CVR's
+	references as soon as it sees it. Each CVR goes on its own line.
+
+	With ndjson=True the output is newline-delimited JSON instead: the
+	first line is the report without its CVRs, and every line after that is
+	one CVR. metrics works the same way it does for CastVoteRecordReportWriter.
+	"""
+
+	def __init__(self, f, report, ndjson=False, fast=True, metrics=None):
+		self.f = f
+		self.report = report
+		self.ndjson = ndjson
+		self.fast = fast
+		self.cvr_count = 0
+		self.metrics = metrics or NULL_METRICS
+		if self.metrics.enabled:
+			self._write = self._write_measured
+			self.write_cvr = self._write_cvr_measured
+		# what goes between two CVRs, and before the next one
+		self.separator = '\n' if ndjson else ',\n'
+		self._next = '\n'
+		self._started = False
+		self._closed = False
+
+	def __enter__(self):
+		self.write_header()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+
+	def _write(self, text):
+		self.f.write(text.encode('utf-8'))
+
+	def _write_measured(self, text):
+		metrics = self.metrics
+		data = text.encode('utf-8')
+		metrics.start('write')
+		self.f.write(data)
+		metrics.stop()
+		metrics.count('bytes_written', len(data))
+
+	def write_header(self):
+		if self._started:
+			return
+		self._started = True
+
+		metadata = _dumps(self.report.json_metadata())
+		if self.ndjson:
+			self._write(metadata)
+		else:
+			# leave the object open for the CVR array
+			self._write(metadata[:-1] + ',"CVR":[')
+
+	def write_cvr(self, cvr):
+		if not self._started:
+			self.write_header()
+		self._write(self._next + cvr_to_json(cvr, self.fast))
+		self._next = self.separator
+		self.cvr_count += 1
+
+	def _write_cvr_measured(self, cvr):
+		if not self._started:
+			self.write_header()
+		metrics = self.metrics
+		metrics.start('serialize')
+		text = cvr_to_json(cvr, self.fast)
+		metrics.stop()
+		self._write(self._next + text)
+		self._next = self.separator
+		self.cvr_count += 1
+		metrics.count('cvrs')
+
+	def write_fragment(self, fragment, count=1):
+		"""Write CVRs already serialized by cvr_to_json() and joined with separator."""
+		if not self._started:
+			self.write_header()
+		if count:
+			self._write(self._next + fragment)
+			self._next = self.separator
+			self.cvr_count += count
+			self.metrics.count('cvrs', count)
+
+	def write_cvrs(self, cvrs):
+		for cvr in cvrs:
+			self.write_cvr(cvr)
+
+	def close(self):
+		if self._closed:
+			return
+		if not self._started:
+			self.write_header()
+		self._closed = True
+		self._write('\n' if self.ndjson else '\n]}\n')
+		self.f.flush()
+
+
+def write_json_report(f, report, cvrs=None, ndjson=False, fast=True, metrics=None):
+	"""Stream a whole report as JSON (or NDJSON) to the binary file object f; see write_report()."""
+	if cvrs is None:
+		cvrs = report.cvrs
+
+	with CastVoteRecordReportJsonWriter(f, report, ndjson, fast, metrics) as writer:
+		with writer.metrics.profiled():
+			writer.write_cvrs(cvrs)
+
+	return writer.cvr_count
@@ -0,0 +1,261 @@
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+
+from .CastVoteRecords import Election, CastVoteRecordReport, _as_list
+from .compression import open_compressed
+from .integrity import HashedIds
+from .reader import CastVoteRecordReportReader, _one_or_list
+from .scan import ReportScanner, fragment_unique_id, _OBJECT_ID
+from .writer import CastVoteRecordReportWriter
+
+
+class MergeConflict(ValueError):
+	"""Two reports define the same id differently."""
+
+
+def _unify(merged, items, kind, source):
+	# add items to merged (id -> item), checking anything already there is defined the same way
+	for item in items:
+		existing = merged.get(item.id)
+		if existing is None:
+			merged[item.id] = item
+		elif existing is not item and existing.to_json() != item.to_json():
+			raise MergeConflict('{} {} in {} is not the same as in the reports before it'.format(kind, item.id, source))
+
+
+def merge_metadata(reports, sources=None, election_scope=None):
+	"""Combine the metadata of several reports (without their CVRs) into one report.
+
+	Elections, and the Contests and Candidates in them, are unified by id, as
+	are Parties, GpUnits and ReportingDevices: the first report to define an
+	id supplies the object, and any later definition that differs raises
+	MergeConflict. Contests and Candidates that only some of the reports have
+	are all kept. Elections with the same id must have the same name and the
+	same scope, unless election_scope is given, in which case it's the scope
+	of every merged Election and is added to the GpUnits.
+
+	sources names each report in error messages.
+	"""
+	if sources is None:
+		sources = ['report {}'.format(i + 1) for i in range(len(reports))]
+
+	parties = {}
+	gp_units = {}
+	devices = {}
+	elections = {}
+	# election id -> (contests by id, candidates by id)
+	election_members = {}
+	version = None
+	if election_scope is not None:
+		gp_units[election_scope.id] = election_scope
+
+	for report, source in zip(reports, sources):
+		if version is None:
+			version = report.version
+		elif report.version != version:
+			raise MergeConflict('{} is version {}, but the reports before it are {}'.format(source, report.version, version))
+		_unify(parties, report.parties or (), 'Party', source)
+		_unify(gp_units, _as_list(report.gp_unit), 'GpUnit', source)
+		_unify(devices, _as_list(report.reporting_device), 'ReportingDevice', source)
+
+		for election in _as_list(report.election):
+			merged = elections.get(election.id)
+			if merged is None:
+				merged = elections[election.id] = Election(id=election.id, name=election.name, candidates=[], contests=[],
+					election_scope=election_scope or election.election_scope)
+				election_members[election.id] = ({}, {})
+			elif merged.name != election.name:
+				raise MergeConflict('Election {} is called {!r} in {}, but {!r} in the reports before it'.format(
+					election.id, election.name, source, merged.name))
+			elif election_scope is None and _id(merged.election_scope) != _id(election.election_scope):
+				raise MergeConflict('Election {} has scope {} in {}, but {} in the reports before it (pass election_scope to merge them)'.format(
+					election.id, _id(election.election_scope), source, _id(merged.election_scope)))
+
+			contests, candidates = election_members[election.id]
+			for candidate in election.candidates or ():
+				if candidate.id not in candidates:
+					merged.candidates.append(candidate)
+			_unify(candidates, election.candidates or (), 'Candidate', source)
+			for contest in election.contests or ():
+				if contest.id not in contests:
+					merged.contests.append(contest)
+			_unify(contests, election.contests or (), 'Contest', source)
+
+	return CastVoteRecordReport(election=_one_or_list(list(elections.values())), gp_unit=_one_or_list(list(gp_units.values())),
+		parties=list(parties.values()), reporting_device=_one_or_list(list(devices.values())), version=version or '1.0.0')
+
+
+def _id(item):
+	return item.id if item is not None else None
+
+
+def read_report_metadata(path):
+	"""The report at path without its CVRs, reading only the start and end of the file unless it's compressed."""
+	return CastVoteRecordReportReader(path).read_metadata()
+
+
+def _fragment_batches(path, batch_size):
+	with open_compressed(path) as f:
+		batch = []
+		for fragment in ReportScanner(f):
+			batch.append(fragment.data)
+			if len(batch) == batch_size:
+				yield batch
+				batch = []
+		if batch:
+			yield batch
+
+
+class _ReadAhead:
+	# Scans reports in background threads, with a bounded queue of batches for
+	# each, so the next reports are being read while this one is written.
+	# Threads take the reports in order, so the one being written always has
+	# a thread, and at most workers reports are read at a time, each at most
+	# queue_size batches ahead.
+
+	_DONE = object()
+
+	def __init__(self, paths, batch_size, workers, queue_size=8):
+		self.stop = threading.Event()
+		self.executor = ThreadPoolExecutor(workers)
+		self.queues = []
+		for path in paths:
+			batches = queue.Queue(queue_size)
+			self.queues.append(batches)
+			self.executor.submit(self._produce, path, batch_size, batches)
+
+	def _put(self, batches, item):
+		while not self.stop.is_set():
+			try:
+				batches.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def _produce(self, path, batch_size, batches):
+		if self.stop.is_set():
+			return
+		try:
+			for batch in _fragment_batches(path, batch_size):
+				if not self._put(batches, batch):
+					return
+		except BaseException as e:
+			self._put(batches, e)
+			return
+		self._put(batches, self._DONE)
+
+	def batches(self, i):
+		batches = self.queues[i]
+		while True:
+			item = batches.get()
+			if item is self._DONE:
+				return
+			if isinstance(item, BaseException):
+				raise item
+			yield item
+
+	def close(self):
+		self.stop.set()
+		self.executor.shutdown(wait=True)
+
+
+def merge_reports(paths, f, indent='  ', election_scope=None, check_ids=True, workers=0, batch_size=1000, metrics=None,
+		memory_budget=256 << 20, tmpdir=None):
+	"""Merge the reports at paths into one report written to the binary file object f.
+
+	Each report's metadata is read from the two ends of its file and
+	combined with merge_metadata() before any CVRs are written, so a
+	conflict is found straight away. Then the CVRs are copied over, report by
+	report, as the bytes they were in their own file, without being parsed -
+	the ids they refer to are the same in the merged report.
+
+	check_ids rejects a UniqueId or ObjectId that turns up twice. The ids
+	go into HashedIds as they're copied, so that takes about memory_budget
+	bytes (and temporary files in tmpdir past that) however many ballots
+	there are. Any hashes that repeat are checked against the actual ids
+	with a second pass over the reports once the CVRs are all copied, and a
+	real duplicate raises MergeConflict before the report's trailer is
+	written. Pass check_ids=False to skip all that.
+
+	With workers more than 0, that many reports are read ahead in background
+	threads while the current one is written out. indent is the writer's,
+	and goes in front of each copied CVR; the CVRs' own layout is left as it
+	was. Returns how many CVRs were written.
+	"""
+	reports = [read_report_metadata(path) for path in paths]
+	merged = merge_metadata(reports, paths, election_scope)
+
+	unique_ids = HashedIds(memory_budget // 2, tmpdir) if check_ids else None
+	object_ids = HashedIds(memory_budget // 2, tmpdir) if check_ids else None
+	prefix = b'' if indent is None else indent.encode('utf-8')
+	suffix = b'' if indent is None else b'\n'
+	read_ahead = _ReadAhead(paths, batch_size, workers) if workers > 0 else None
+	try:
+		if check_ids:
+			# ordinal 0 is the merged metadata, whose ObjectIds CVR snapshots can't reuse either; CVRs count from 1
+			for object_id in _metadata_object_ids(merged):
+				object_ids.add(object_id, 0)
+		ordinal = 0
+		with CastVoteRecordReportWriter(f, merged, indent, metrics=metrics) as writer:
+			for i, path in enumerate(paths):
+				batches = read_ahead.batches(i) if read_ahead else _fragment_batches(path, batch_size)
+				for batch in batches:
+					if check_ids:
+						for data in batch:
+							ordinal += 1
+							unique_ids.add(fragment_unique_id(data), ordinal)
+							for object_id in _OBJECT_ID.findall(data):
+								object_ids.add(object_id, ordinal)
+					writer.write_fragment(b''.join(prefix + data + suffix for data in batch).decode('utf-8'), len(batch))
+			if check_ids:
+				_check_duplicates(paths, merged, unique_ids, object_ids, batch_size)
+	finally:
+		if read_ahead:
+			read_ahead.close()
+		if check_ids:
+			unique_ids.close()
+			object_ids.close()
+	return writer.cvr_count
+
+
+def _metadata_object_ids(report):
+	for element in report.trailer_elements():
+		for elem in element.iter():
+			if elem.get('ObjectId') is not None:
+				yield elem.get('ObjectId').encode('utf-8')
+
+
+def _check_duplicates(paths, merged, unique_ids, object_ids, batch_size):
+	# ordinal -> the kinds of id ('UniqueId', 'ObjectId') it shares a hash on
+	flagged = {}
+	for label, ids in (('UniqueId', unique_ids), ('ObjectId', object_ids)):
+		for ordinals in ids.duplicates():
+			for ordinal in ordinals:
+				flagged.setdefault(ordinal, set()).add(label)
+	if not flagged:
+		return
+
+	# second pass for the actual ids of just the flagged CVRs, raising at the first one seen before
+	seen = {'UniqueId': set(), 'ObjectId': set()}
+	if 0 in flagged:
+		seen['ObjectId'].update(_metadata_object_ids(merged))
+	ordinal = 0
+	for path in paths:
+		for batch in _fragment_batches(path, batch_size):
+			for data in batch:
+				ordinal += 1
+				labels = flagged.get(ordinal)
+				if labels is None:
+					continue
+				if 'UniqueId' in labels:
+					unique_id = fragment_unique_id(data)
+					if unique_id in seen['UniqueId']:
+						raise MergeConflict('CVR {} in {} is already in the merged report'.format(unique_id, path))
+					seen['UniqueId'].add(unique_id)
+				if 'ObjectId' in labels:
+					for object_id in _OBJECT_ID.findall(data):
+						if object_id in seen['ObjectId']:
+							raise MergeConflict('ObjectId {} in {} is already in the merged report'.format(object_id.decode('utf-8'), path))
+						seen['ObjectId'].add(object_id)
@@ -0,0 +1,186 @@
+from collections import Counter
+import contextlib
+import json
+import sys
+import time
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+
+def peak_rss():
+	"""The process's peak resident set size in bytes, or None where the resource module isn't available."""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kilobytes on Linux, bytes on macOS
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Metrics:
+	"""Collects stage timings, counters and memory use for a conversion run.
+
+	Stage times are exclusive: while a stage is running inside another (say
+	building CVRs, which pulls rows from the CSV stage), the outer stage's
+	clock is paused, so the stage times add up to the time spent in stages.
+	timed() wraps an iterator so each next() is charged to a stage, which is
+	how the lazy generator pipeline gets split up.
+
+	progress_every is in seconds; when it's set, a progress line goes to
+	progress_file whenever that long has passed and the progress_counter
+	counter moves. profiler is anything with enable() and disable() - a
+	cProfile.Profile, say - and is switched on inside profiled() blocks,
+	which wrap the hot loops. record() adds anything else worth keeping -
+	a Pipeline's stage stats, say - to what to_dict() gives.
+	"""
+
+	enabled = True
+
+	def __init__(self, progress_every=None, progress_file=sys.stderr, progress_counter='cvrs', profiler=None):
+		self.seconds = Counter()
+		self.calls = Counter()
+		self.counters = Counter()
+		self.progress_every = progress_every
+		self.progress_file = progress_file
+		self.progress_counter = progress_counter
+		self.profiler = profiler
+		self.started = time.perf_counter()
+		self._next_progress = self.started + progress_every if progress_every else None
+		# [stage name, time it was last started or resumed] for each running stage
+		self._stack = []
+		# name -> anything JSON can hold, added to to_dict() as it is
+		self.extra = {}
+
+	def start(self, name):
+		now = time.perf_counter()
+		if self._stack:
+			parent = self._stack[-1]
+			self.seconds[parent[0]] += now - parent[1]
+		self._stack.append([name, now])
+
+	def stop(self):
+		now = time.perf_counter()
+		name, started = self._stack.pop()
+		self.seconds[name] += now - started
+		self.calls[name] += 1
+		if self._stack:
+			self._stack[-1][1] = now
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		self.start(name)
+		try:
+			yield self
+		finally:
+			self.stop()
+
+	def timed(self, iterable, name, counter=None):
+		"""Iterate over iterable, charging the time each item takes to stage name.
+
+		If counter is given, that counter goes up by one for each item.
+		"""
+		iterator = iter(iterable)
+		start = self.start
+		stop = self.stop
+		while True:
+			start(name)
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+			finally:
+				stop()
+			if counter is not None:
+				self.count(counter)
+			yield item
+
+	def count(self, name, n=1):
+		self.counters[name] += n
+		if self._next_progress is not None and name == self.progress_counter:
+			now = time.perf_counter()
+			if now >= self._next_progress:
+				self._next_progress = now + self.progress_every
+				self.progress(now)
+
+	def progress(self, now=None):
+		elapsed = (now or time.perf_counter()) - self.started
+		done = self.counters[self.progress_counter]
+		rss = peak_rss()
+		print('{:8.1f}s {:>12,} {} {:>10,.0f}/s {:>8.1f} MB written {:>8} MB peak RSS'.format(
+			elapsed, done, self.progress_counter, done / elapsed if elapsed else 0,
+			self.counters['bytes_written'] / 2 ** 20, '-' if rss is None else '{:.0f}'.format(rss / 2 ** 20)),
+			file=self.progress_file, flush=True)
+
+	def record(self, name, value):
+		self.extra[name] = value
+
+	@contextlib.contextmanager
+	def profiled(self):
+		"""Run the block with the profiler (if there is one) switched on."""
+		if self.profiler is None:
+			yield self
+			return
+		self.profiler.enable()
+		try:
+			yield self
+		finally:
+			self.profiler.disable()
+
+	def to_dict(self):
+		elapsed = time.perf_counter() - self.started
+		stages = {name: {'seconds': round(seconds, 6), 'calls': self.calls[name]} for name, seconds in self.seconds.items()}
+		rates = {}
+		if elapsed:
+			for name in ('rows', 'cvrs', 'bytes_written'):
+				if self.counters[name]:
+					rates[name + '_per_second'] = round(self.counters[name] / elapsed, 1)
+		result = {
+			'elapsed_seconds': round(elapsed, 6),
+			'unstaged_seconds': round(elapsed - sum(self.seconds.values()), 6),
+			'stages': stages,
+			'counters': dict(self.counters),
+			'rates': rates,
+			'peak_rss_bytes': peak_rss(),
+		}
+		result.update(self.extra)
+		return result
+
+	def dump(self, f):
+		"""Write to_dict() as JSON to the text file f."""
+		json.dump(self.to_dict(), f, indent=2)
+		f.write('\n')
+
+
+class NullMetrics:
+	"""Stands in for Metrics when nothing's being measured; every hook does nothing."""
+
+	enabled = False
+
+	def start(self, name):
+		pass
+
+	def stop(self):
+		pass
+
+	def stage(self, name):
+		return contextlib.nullcontext(self)
+
+	def timed(self, iterable, name, counter=None):
+		return iterable
+
+	def count(self, name, n=1):
+		pass
+
+	def progress(self, now=None):
+		pass
+
+	def record(self, name, value):
+		pass
+
+	def profiled(self):
+		return contextlib.nullcontext(self)
+
+
+NULL_METRICS = NullMetrics()
@@ -0,0 +1,63 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+import os
+
+from .writer import cvr_to_string
+
+
+def _chunks(rows, chunk_size):
+	rows = iter(rows)
+	while True:
+		chunk = list(islice(rows, chunk_size))
+		if not chunk:
+			return
+		yield chunk
+
+
+# (build_cvrs, serialize, separator) in a worker process, set once by _init_worker
+_worker = None
+
+
+def _init_worker(build_cvrs, serialize, separator):
+	global _worker
+	_worker = (build_cvrs, serialize, separator)
+
+
+def _serialize_chunk(rows):
+	build_cvrs, serialize, separator = _worker
+	fragments = [serialize(cvr) for cvr in build_cvrs(rows)]
+	return separator.join(fragments), len(fragments)
+
+
+def parallel_cvr_fragments(rows, build_cvrs, workers=None, chunk_size=1000, indent='  ', serialize=None, separator=''):
+	"""Build and serialize CVRs in a pool of worker processes.
+
+	rows is split into chunks of chunk_size, and each chunk is handed to
+	build_cvrs() in a worker, which must turn it into an iterable of CVRs.
+	build_cvrs has to be picklable (a module-level function, or a bound method
+	of something picklable like an EssPlan), and is sent to each worker once
+	when it starts rather than with every chunk. Yields
+	(fragment, count) pairs in the same order as the rows, ready for
+	CastVoteRecordReportWriter.write_fragment(), so the report comes out the
+	same as it would from a single process. Only a couple of chunks per worker
+	are in flight at once, so memory stays bounded however long rows is.
+
+	serialize turns a CVR into a string and defaults to cvr_to_string() with
+	indent; each chunk's strings are joined with separator. For JSON, pass
+	cvr_to_json and the writer's separator.
+	"""
+	if workers is None:
+		workers = os.cpu_count() or 1
+	if serialize is None:
+		serialize = partial(cvr_to_string, indent=indent)
+
+	with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(build_cvrs, serialize, separator)) as executor:
+		pending = deque()
+		for chunk in _chunks(rows, chunk_size):
+			pending.append(executor.submit(_serialize_chunk, chunk))
+			if len(pending) >= workers * 2:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
@@ -0,0 +1,302 @@
+import asyncio
+from dataclasses import dataclass, asdict
+from itertools import islice
+import queue
+import threading
+import time
+
+from .writer import cvr_to_string
+
+
+@dataclass
+class StageStats:
+	"""What one stage of a Pipeline did.
+
+	busy_seconds is time spent in the stage's own function, starved_seconds
+	waiting for something to work on, and blocked_seconds waiting for room
+	in the next stage's queue - a stage that's mostly blocked is waiting on
+	a slower one after it. queue_depth is how many batches were waiting in
+	the stage's input queue each time it took one, as a maximum and a mean.
+	"""
+	name: str = None
+	batches: int = 0
+	items: int = 0
+	busy_seconds: float = 0.0
+	starved_seconds: float = 0.0
+	blocked_seconds: float = 0.0
+	max_queue_depth: int = 0
+	mean_queue_depth: float = 0.0
+
+	def to_dict(self):
+		stats = asdict(self)
+		for name in ('busy_seconds', 'starved_seconds', 'blocked_seconds', 'mean_queue_depth'):
+			stats[name] = round(stats[name], 6)
+		return stats
+
+
+class _Stopped(Exception):
+	# another stage failed, so this one gives up
+	pass
+
+
+class Pipeline:
+	"""Runs a source, a chain of stages and a sink at the same time, connected by bounded queues.
+
+	source is any iterable; it's read in batches of batch_size items (a list
+	each), and each batch is passed through stages, a list of (name,
+	function) pairs where function takes a batch and returns the next
+	stage's batch, and finally to sink(batch). Batching keeps the cost of
+	handing things between stages small next to the work on them.
+
+	run() gives the source, each stage and the sink a thread of their own,
+	and run_async() does the same as asyncio tasks, with the work done in
+	asyncio.to_thread(). Python code only runs on one thread at a time, but
+	reading files, writing them and compressing them (see
+	BackgroundCompressor) let go of the GIL, so those overlap with building
+	and serializing ballots. Each queue holds at most queue_size batches, so
+	a slow sink holds everything before it up rather than letting batches
+	pile up in memory.
+
+	If any stage raises, the others stop and run() or run_async() raises the
+	same exception. Afterwards stats has a StageStats for each stage, source
+	and sink included.
+	"""
+
+	_DONE = object()
+
+	def __init__(self, source, stages, sink, batch_size=1000, queue_size=4):
+		self.source = source
+		self.stages = list(stages)
+		self.sink = sink
+		self.batch_size = batch_size
+		self.queue_size = queue_size
+		self.stats = [StageStats(name) for name in ['read'] + [name for name, function in self.stages] + ['sink']]
+
+	def stats_dict(self):
+		return [stats.to_dict() for stats in self.stats]
+
+	def _batches(self):
+		source = iter(self.source)
+		while True:
+			batch = list(islice(source, self.batch_size))
+			if not batch:
+				return
+			yield batch
+
+	@staticmethod
+	def _count(stats, batch, seconds):
+		stats.batches += 1
+		stats.busy_seconds += seconds
+		try:
+			stats.items += len(batch)
+		except TypeError:
+			pass
+
+	@staticmethod
+	def _took(stats, depth):
+		stats.max_queue_depth = max(stats.max_queue_depth, depth)
+		# a running mean over the batches taken so far, counting the end of the stream
+		stats.mean_queue_depth += (depth - stats.mean_queue_depth) / (stats.batches + 1)
+
+	def run(self):
+		"""Run the pipeline on threads, returning once the sink has had every batch."""
+		stop = threading.Event()
+		errors = []
+		queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+
+		def put(q, item, stats):
+			started = time.perf_counter()
+			while True:
+				if stop.is_set():
+					raise _Stopped()
+				try:
+					q.put(item, timeout=0.1)
+					break
+				except queue.Full:
+					pass
+			stats.blocked_seconds += time.perf_counter() - started
+
+		def get(q, stats):
+			started = time.perf_counter()
+			depth = q.qsize()
+			while True:
+				if stop.is_set():
+					raise _Stopped()
+				try:
+					item = q.get(timeout=0.1)
+					break
+				except queue.Empty:
+					pass
+			stats.starved_seconds += time.perf_counter() - started
+			self._took(stats, depth)
+			return item
+
+		def guarded(work):
+			def target():
+				try:
+					work()
+				except _Stopped:
+					pass
+				except BaseException as e:
+					errors.append(e)
+					stop.set()
+			return target
+
+		def read():
+			stats = self.stats[0]
+			batches = self._batches()
+			while True:
+				started = time.perf_counter()
+				batch = next(batches, self._DONE)
+				if batch is self._DONE:
+					stats.busy_seconds += time.perf_counter() - started
+					break
+				self._count(stats, batch, time.perf_counter() - started)
+				put(queues[0], batch, stats)
+			put(queues[0], self._DONE, stats)
+
+		def stage(i, function):
+			stats = self.stats[i + 1]
+			while True:
+				batch = get(queues[i], stats)
+				if batch is self._DONE:
+					break
+				started = time.perf_counter()
+				result = function(batch)
+				self._count(stats, batch, time.perf_counter() - started)
+				put(queues[i + 1], result, stats)
+			put(queues[i + 1], self._DONE, stats)
+
+		def sink():
+			stats = self.stats[-1]
+			while True:
+				batch = get(queues[-1], stats)
+				if batch is self._DONE:
+					break
+				started = time.perf_counter()
+				self.sink(batch)
+				self._count(stats, batch, time.perf_counter() - started)
+
+		threads = [threading.Thread(target=guarded(read), name='pipeline-read', daemon=True)]
+		for i, (name, function) in enumerate(self.stages):
+			threads.append(threading.Thread(target=guarded(lambda i=i, function=function: stage(i, function)), name='pipeline-' + name, daemon=True))
+		threads.append(threading.Thread(target=guarded(sink), name='pipeline-sink', daemon=True))
+		for thread in threads:
+			thread.start()
+		try:
+			for thread in threads:
+				thread.join()
+		except BaseException:
+			# Ctrl-C, say: let the threads wind down before going
+			stop.set()
+			for thread in threads:
+				thread.join()
+			raise
+		if errors:
+			raise errors[0]
+		return self.stats
+
+	async def run_async(self):
+		"""Run the pipeline as asyncio tasks, each doing its work on a thread with asyncio.to_thread()."""
+		queues = [asyncio.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+
+		async def put(q, item, stats):
+			started = time.perf_counter()
+			await q.put(item)
+			stats.blocked_seconds += time.perf_counter() - started
+
+		async def get(q, stats):
+			started = time.perf_counter()
+			depth = q.qsize()
+			item = await q.get()
+			stats.starved_seconds += time.perf_counter() - started
+			self._took(stats, depth)
+			return item
+
+		async def read():
+			stats = self.stats[0]
+			batches = self._batches()
+			while True:
+				started = time.perf_counter()
+				batch = await asyncio.to_thread(next, batches, self._DONE)
+				if batch is self._DONE:
+					stats.busy_seconds += time.perf_counter() - started
+					break
+				self._count(stats, batch, time.perf_counter() - started)
+				await put(queues[0], batch, stats)
+			await put(queues[0], self._DONE, stats)
+
+		async def stage(i, function):
+			stats = self.stats[i + 1]
+			while True:
+				batch = await get(queues[i], stats)
+				if batch is self._DONE:
+					break
+				started = time.perf_counter()
+				result = await asyncio.to_thread(function, batch)
+				self._count(stats, batch, time.perf_counter() - started)
+				await put(queues[i + 1], result, stats)
+			await put(queues[i + 1], self._DONE, stats)
+
+		async def sink():
+			stats = self.stats[-1]
+			while True:
+				batch = await get(queues[-1], stats)
+				if batch is self._DONE:
+					break
+				started = time.perf_counter()
+				await asyncio.to_thread(self.sink, batch)
+				self._count(stats, batch, time.perf_counter() - started)
+
+		tasks = [asyncio.ensure_future(read())]
+		tasks += [asyncio.ensure_future(stage(i, function)) for i, (name, function) in enumerate(self.stages)]
+		tasks.append(asyncio.ensure_future(sink()))
+		try:
+			await asyncio.gather(*tasks)
+		except BaseException:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+			raise
+		return self.stats
+
+
+class _Fragment:
+	# serialized CVRs; len() is how many, so the sink's stats count CVRs
+	__slots__ = ('text', 'count')
+
+	def __init__(self, text, count):
+		self.text = text
+		self.count = count
+
+	def __len__(self):
+		return self.count
+
+
+def report_pipeline(rows, build_cvrs, writer, batch_size=1000, queue_size=4, serialize=None, separator=''):
+	"""A Pipeline that turns rows into CVRs and writes them with writer.
+
+	The stages are build (build_cvrs(batch), e.g. an EssPlan's cvrs() with
+	compact=True) and serialize (each CVR through serialize, cvr_to_string()
+	with the writer's indent by default, joined with separator), and the
+	sink hands each serialized batch to writer.write_fragment(). For JSON
+	pass cvr_to_json and the writer's separator, as with
+	parallel_cvr_fragments(). The report comes out exactly as write_report()
+	would write it.
+	"""
+	if serialize is None:
+		indent = writer.indent
+
+		def serialize(cvr):
+			return cvr_to_string(cvr, indent)
+
+	def build(batch):
+		return list(build_cvrs(batch))
+
+	def serialize_batch(cvrs):
+		return _Fragment(separator.join([serialize(cvr) for cvr in cvrs]), len(cvrs))
+
+	def sink(fragment):
+		writer.write_fragment(fragment.text, fragment.count)
+
+	return Pipeline(rows, [('build', build), ('serialize', serialize_batch)], sink, batch_size, queue_size)
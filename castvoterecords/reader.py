@@ -0,0 +1,357 @@
+import bz2
+import gzip
+from io import BytesIO
+import lzma
+import xml.etree.ElementTree as ET
+
+from .CastVoteRecords import (Code, Candidate, Party, IdentifierType, CandidateContest, VoteVariation, CandidateSelection,
+	CVRContestSelection, CVRContest, CVRSnapshot, CVR, Election, GpUnit, ReportingUnitType, CastVoteRecordReport,
+	ReportingDevice, BallotMeasureContest, BallotMeasureSelection)
+from .compression import codec_for, open_compressed
+from .scan import read_envelope
+
+XSI_TYPE = '{http://www.w3.org/2001/XMLSchema-instance}type'
+# file objects that can't cheaply be read from the end
+_COMPRESSED_FILES = (gzip.GzipFile, lzma.LZMAFile, bz2.BZ2File)
+
+
+def _local(tag):
+	# '{NIST_V0_cast_vote_records.xsd}CVR' -> 'CVR', so files with or without the namespace both work
+	return tag.rpartition('}')[2]
+
+
+def _one_or_list(items):
+	# The report dataclass holds a single Election/GpUnit/ReportingDevice, but the schema allows several
+	if len(items) == 1:
+		return items[0]
+	return items
+
+
+class CastVoteRecordReportReader:
+	"""Reads a CastVoteRecordReport XML file a ballot at a time.
+
+	The schema puts the Election (and the GpUnits, Parties and devices) after
+	all of the CVRs, so read_metadata() gets those first: from an
+	uncompressed file it reads just the two ends (see read_envelope()), and
+	from a compressed one it makes a pass over the whole file that only
+	keeps the report-level elements. Then iterating over the
+	reader makes a second pass that turns each <CVR> into a CVR dataclass,
+	with its ContestId and ContestSelectionId references pointing at the
+	Contest and ContestSelection objects from the first pass. Elements are
+	cleared as soon as they've been used, so memory stays bounded no matter
+	how big the file is.
+
+	source is a file name or a seekable binary file object. Files named
+	.gz, .xz or .bz2 are decompressed as they're read.
+	"""
+
+	def __init__(self, source):
+		if not isinstance(source, str) and not (hasattr(source, 'seekable') and source.seekable()):
+			raise ValueError('CastVoteRecordReportReader needs a file name or a seekable file, since it reads the file twice')
+		self.source = source
+		self._start = None if isinstance(source, str) else source.tell()
+		self.report = None
+		self.elections = {}
+
+	def _iterparse(self, source=None):
+		if source is not None:
+			yield from ET.iterparse(source, events=('start', 'end'))
+			return
+		if self._start is not None:
+			self.source.seek(self._start)
+			yield from ET.iterparse(self.source, events=('start', 'end'))
+			return
+		with open_compressed(self.source) as f:
+			yield from ET.iterparse(f, events=('start', 'end'))
+
+	def _top_level(self, source=None):
+		# yields each complete child of the root, clearing it once the caller is done with it
+		depth = 0
+		root = None
+		for event, elem in self._iterparse(source):
+			if event == 'start':
+				if root is None:
+					root = elem
+				depth += 1
+				continue
+			depth -= 1
+			if depth == 1:
+				yield elem
+				root.clear()
+
+	def _envelope(self):
+		# the report without its CVRs, or None if the file's compressed and has to be read through
+		if self._start is None:
+			if codec_for(self.source) is not None:
+				return None
+			with open(self.source, 'rb') as f:
+				return read_envelope(f)
+		if isinstance(self.source, _COMPRESSED_FILES):
+			return None
+		self.source.seek(self._start)
+		return read_envelope(self.source)
+
+	def read_metadata(self):
+		"""Read the report without its CVRs, from the ends of the file if it isn't compressed."""
+		if self.report is not None:
+			return self.report
+		envelope = self._envelope()
+
+		parties = []
+		gp_units = []
+		devices = []
+		elections = []
+		self.report = CastVoteRecordReport(parties=parties)
+		for elem in self._top_level(BytesIO(envelope) if envelope is not None else None):
+			tag = _local(elem.tag)
+			if tag == 'Election':
+				elections.append(self._parse_election(elem))
+			elif tag == 'GeneratedDate':
+				self.report.generatedDate = elem.text
+			elif tag == 'GpUnit':
+				gp_units.append(self._parse_gp_unit(elem))
+			elif tag == 'Notes':
+				self.report.notes = elem.text
+			elif tag == 'Party':
+				parties.append(_parse_party(elem))
+			elif tag == 'ReportingDevice':
+				devices.append(_parse_reporting_device(elem))
+			elif tag == 'Version':
+				self.report.version = elem.text
+
+		# Parties and GpUnits come after the Election, so their references get filled in now
+		parties_by_id = {party.id: party for party in parties}
+		gp_units_by_id = {gp_unit.id: gp_unit for gp_unit in gp_units}
+		for election in elections:
+			for candidate in election.candidates:
+				if candidate.party is not None:
+					candidate.party = _lookup(parties_by_id.get, candidate.party.id, 'Party', candidate.id)
+			if election.election_scope is not None:
+				election.election_scope = _lookup(gp_units_by_id.get, election.election_scope.id, 'GpUnit', election.id)
+
+		self.elections = {election.id: election for election in elections}
+		self.report.election = _one_or_list(elections)
+		self.report.gp_unit = _one_or_list(gp_units)
+		self.report.reporting_device = _one_or_list(devices)
+		return self.report
+
+	def __iter__(self):
+		"""Make the second pass over the file, yielding one CVR at a time."""
+		self.read_metadata()
+		for elem in self._top_level():
+			if _local(elem.tag) == 'CVR':
+				yield self._parse_cvr(elem)
+
+	def _parse_election(self, elem):
+		election = Election(id=elem.get('ObjectId'), candidates=[], contests=[])
+		candidates_by_id = {}
+		for child in elem:
+			tag = _local(child.tag)
+			if tag == 'Candidate':
+				candidate = _parse_candidate(child)
+				candidates_by_id[candidate.id] = candidate
+				election.candidates.append(candidate)
+			elif tag == 'Contest':
+				election.contests.append(_parse_contest(child, candidates_by_id))
+			elif tag == 'ElectionScopeId':
+				# swapped for the real GpUnit at the end of read_metadata()
+				election.election_scope = GpUnit(id=child.text)
+			elif tag == 'Name':
+				election.name = child.text
+		return election
+
+	def _parse_gp_unit(self, elem):
+		gp_unit = GpUnit(id=elem.get('ObjectId'))
+		for child in elem:
+			tag = _local(child.tag)
+			if tag == 'Code':
+				gp_unit.code = _parse_code(child)
+			elif tag == 'Name':
+				gp_unit.name = child.text
+			elif tag == 'Type':
+				gp_unit.gp_type = ReportingUnitType(child.text)
+		return gp_unit
+
+	def _parse_cvr(self, elem):
+		cvr = CVR(cvr_snapshot=[])
+		# ElectionId comes after the snapshots, but we need the election to look their contests up in
+		for child in elem:
+			if _local(child.tag) == 'ElectionId':
+				cvr.election = _lookup(self.elections.get, child.text, 'Election', 'CVR')
+		if cvr.election is None:
+			raise ValueError('CVR has no ElectionId')
+
+		current_snapshot_id = None
+		for child in elem:
+			tag = _local(child.tag)
+			if tag == 'CurrentSnapshotId':
+				current_snapshot_id = child.text
+			elif tag == 'CVRSnapshot':
+				cvr.cvr_snapshot.append(_parse_cvr_snapshot(child, cvr.election))
+			elif tag == 'UniqueId':
+				cvr.id = child.text
+
+		# to_xml() treats the first snapshot as the current one
+		for i, snapshot in enumerate(cvr.cvr_snapshot):
+			if snapshot.id == current_snapshot_id:
+				cvr.cvr_snapshot.insert(0, cvr.cvr_snapshot.pop(i))
+				break
+
+		return cvr
+
+
+def _parse_cvr_snapshot(elem, election):
+	snapshot = CVRSnapshot(id=elem.get('ObjectId'), cvr_contests=[])
+	for child in elem:
+		if _local(child.tag) == 'CVRContest':
+			snapshot.cvr_contests.append(_parse_cvr_contest(child, election))
+	return snapshot
+
+
+def _parse_cvr_contest(elem, election):
+	cvr_contest = CVRContest()
+	for child in elem:
+		tag = _local(child.tag)
+		if tag == 'ContestId':
+			cvr_contest.contest = _lookup(election.contest_by_id, child.text, 'Contest', 'CVRContest')
+		elif tag == 'CVRContestSelection':
+			if cvr_contest.cvr_contest_selection is None:
+				cvr_contest.cvr_contest_selection = []
+			cvr_contest.cvr_contest_selection.append(_parse_cvr_contest_selection(child, cvr_contest.contest))
+		elif tag == 'Overvotes':
+			cvr_contest.overvotes = int(child.text)
+		elif tag == 'Undervotes':
+			cvr_contest.undervotes = int(child.text)
+		elif tag == 'WriteIns':
+			cvr_contest.writeins = int(child.text)
+	return cvr_contest
+
+
+def _lookup(find, object_id, kind, referrer):
+	try:
+		found = find(object_id)
+	except KeyError:
+		found = None
+	if found is None:
+		raise ValueError('{} refers to unknown {} {!r}'.format(referrer, kind, object_id))
+	return found
+
+
+def _parse_code(elem):
+	code = Code()
+	for child in elem:
+		tag = _local(child.tag)
+		if tag == 'Type':
+			code.code_type = IdentifierType(child.text)
+		elif tag == 'Value':
+			code.value = child.text
+		elif tag == 'Label':
+			code.label = child.text
+		elif tag == 'OtherType':
+			code.other_type = child.text
+	return code
+
+
+def _parse_party(elem):
+	party = Party(id=elem.get('ObjectId'))
+	for child in elem:
+		tag = _local(child.tag)
+		if tag == 'Abbreviation':
+			party.abbreviation = child.text
+		elif tag == 'Name':
+			party.name = child.text
+	return party
+
+
+def _parse_reporting_device(elem):
+	device = ReportingDevice(id=elem.get('ObjectId'))
+	for child in elem:
+		tag = _local(child.tag)
+		if tag == 'Model':
+			device.model = child.text
+		elif tag == 'Notes':
+			device.notes = child.text
+	return device
+
+
+def _parse_candidate(elem):
+	candidate = Candidate(id=elem.get('ObjectId'))
+	for child in elem:
+		tag = _local(child.tag)
+		if tag == 'Name':
+			candidate.name = child.text
+		elif tag == 'PartyId':
+			# swapped for the real Party once the Party elements have been read
+			candidate.party = Party(id=child.text)
+		elif tag == 'Code':
+			candidate.code = _parse_code(child)
+	return candidate
+
+
+def _parse_contest(elem, candidates_by_id):
+	if elem.get(XSI_TYPE) == 'BallotMeasureContest':
+		contest = BallotMeasureContest(id=elem.get('ObjectId'), contest_selections=[])
+	else:
+		contest = CandidateContest(id=elem.get('ObjectId'), contest_selections=[])
+
+	for child in elem:
+		tag = _local(child.tag)
+		if tag == 'ContestSelection':
+			contest.contest_selections.append(_parse_contest_selection(child, candidates_by_id, contest.id))
+		elif tag == 'Name':
+			contest.name = child.text
+		elif tag == 'Abbreviation':
+			contest.abbreviation = child.text
+		elif tag == 'Code':
+			contest.code = _parse_code(child)
+		elif tag == 'VoteVariation':
+			contest.vote_variation = VoteVariation(child.text)
+		elif tag == 'OtherVoteVariation':
+			contest.other_vote_variation = child.text
+		elif tag == 'NumberElected':
+			contest.number_elected = int(child.text)
+		elif tag == 'VotesAllowed':
+			contest.votes_allowed = int(child.text)
+	return contest
+
+
+def _parse_contest_selection(elem, candidates_by_id, contest_id):
+	if elem.get(XSI_TYPE) == 'BallotMeasureSelection':
+		selection = BallotMeasureSelection(id=elem.get('ObjectId'))
+		for child in elem:
+			if _local(child.tag) == 'Selection':
+				selection.selection = child.text
+		return selection
+
+	selection = CandidateSelection(id=elem.get('ObjectId'))
+	for child in elem:
+		tag = _local(child.tag)
+		if tag == 'CandidateIds':
+			# the schema allows a list of ids here, but CandidateSelection holds a single candidate
+			candidate_id = child.text.split()[0]
+			selection.candidate = _lookup(candidates_by_id.get, candidate_id, 'Candidate', contest_id)
+		elif tag == 'IsWriteIn':
+			selection.is_write_in = child.text == 'true'
+		elif tag == 'Code':
+			selection.code = _parse_code(child)
+	return selection
+
+
+def _parse_cvr_contest_selection(elem, contest):
+	cvr_contest_selection = CVRContestSelection()
+	for child in elem:
+		if _local(child.tag) == 'ContestSelectionId':
+			cvr_contest_selection.contest_selection = _lookup(contest.selection_by_id, child.text, 'ContestSelection', 'CVRContestSelection')
+	return cvr_contest_selection
+
+
+def read_report(source):
+	"""Read a whole report, CVRs and all, into a CastVoteRecordReport.
+
+	Only use this when the report comfortably fits in memory; otherwise
+	iterate over a CastVoteRecordReportReader.
+	"""
+	reader = CastVoteRecordReportReader(source)
+	report = reader.read_metadata()
+	report.cvrs = list(reader)
+	return report
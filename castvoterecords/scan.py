@@ -0,0 +1,131 @@
+from collections import namedtuple
+import os
+import re
+
+# offset and line are where the fragment's '<CVR' starts in the file (lines count from 1)
+CVRFragment = namedtuple('CVRFragment', ['offset', 'line', 'data'])
+
+_CVR_START = re.compile(rb'<CVR[\s>]')
+_CVR_END = b'</CVR>'
+_ROOT_NAMESPACES = re.compile(rb'\sxmlns(?::\w+)?\s*=\s*"[^"]*"')
+_UNIQUE_ID = re.compile(rb'<UniqueId>\s*([^<]*?)\s*</UniqueId>')
+_ROOT_START_TAG = re.compile(rb'<CastVoteRecordReport(?:\s[^>]*)?>')
+_OBJECT_ID = re.compile(rb'\sObjectId\s*=\s*"([^"]*)"')
+
+
+class ReportScanner:
+	"""Finds the raw bytes of each <CVR> in a report without parsing any XML.
+
+	Iterating over the scanner yields a CVRFragment for each CVR, reading the
+	binary file f a chunk at a time. Once the iteration is done, head holds
+	everything before the first CVR (the XML declaration and the root start
+	tag), and tail_offset and tail everything after the last one (the
+	Election and the rest of the report metadata), so head + tail is the
+	report with its CVRs taken out.
+
+	The scanner looks for literal <CVR> tags, which is what this package
+	writes; it doesn't understand comments or CDATA, or a namespace prefix on
+	the CVR elements.
+	"""
+
+	def __init__(self, f, chunk_size=1 << 20):
+		self.f = f
+		self.chunk_size = chunk_size
+		self.head = None
+		self.tail = None
+		self.tail_offset = None
+		self.count = 0
+
+	def __iter__(self):
+		buf = b''
+		pos = 0
+		# file offset and line number of buf[pos]
+		offset = self.f.tell()
+		line = 1
+		at_eof = False
+		while True:
+			match = _CVR_START.search(buf, pos)
+			end = buf.find(_CVR_END, match.end()) if match else -1
+			if end < 0:
+				if at_eof:
+					break
+				chunk = self.f.read(self.chunk_size)
+				if not chunk:
+					at_eof = True
+				buf = buf[pos:] + chunk
+				pos = 0
+				continue
+
+			start = match.start()
+			if self.head is None:
+				self.head = buf[pos:start]
+			elif buf[pos:start].strip():
+				raise ValueError('Unexpected content between CVRs at byte {}'.format(offset))
+			line += buf.count(b'\n', pos, start)
+			end += len(_CVR_END)
+			data = buf[start:end]
+			yield CVRFragment(offset + start - pos, line, data)
+			self.count += 1
+
+			line += data.count(b'\n')
+			offset += end - pos
+			pos = end
+
+		if self.head is None:
+			self.head = b''
+		self.tail_offset = offset
+		self.tail = buf[pos:]
+
+	def envelope(self):
+		"""The report with its CVRs taken out; only there once the scan has finished."""
+		return self.head + self.tail
+
+
+def root_namespaces(head):
+	"""The xmlns declarations on the root start tag, as bytes ready to go on a CVR start tag."""
+	return b''.join(_ROOT_NAMESPACES.findall(head))
+
+
+def standalone_fragment(fragment, namespaces):
+	"""A CVR fragment with the root's namespace declarations copied onto it, so it parses on its own."""
+	return b'<CVR' + namespaces + fragment[4:]
+
+
+def fragment_unique_id(fragment):
+	match = _UNIQUE_ID.search(fragment)
+	return match.group(1).decode('utf-8') if match else None
+
+
+def read_envelope(f, chunk_size=1 << 16):
+	"""The report in the seekable binary file f with its CVRs taken out, reading only the two ends of the file.
+
+	Gives the same report as ReportScanner.envelope(), less the whitespace
+	around the CVRs: the root start tag from the front of the file, and
+	everything after the last </CVR>, found by reading back from the end.
+	"""
+	start = f.tell()
+	head = b''
+	while True:
+		chunk = f.read(chunk_size)
+		head += chunk
+		match = _ROOT_START_TAG.search(head)
+		if match:
+			head = head[:match.end()]
+			break
+		if not chunk:
+			raise ValueError('No CastVoteRecordReport start tag in the file')
+
+	# everything after the root start tag, if there turn out to be no CVRs
+	floor = start + len(head)
+	pos = f.seek(0, os.SEEK_END)
+	tail = b''
+	while pos > floor:
+		read = min(chunk_size, pos - floor)
+		pos -= read
+		f.seek(pos)
+		tail = f.read(read) + tail
+		end = tail.rfind(_CVR_END)
+		if end >= 0:
+			tail = tail[end + len(_CVR_END):]
+			break
+	return head + tail
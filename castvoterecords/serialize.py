@@ -0,0 +1,85 @@
+XML_DECLARATION = '<?xml version="1.0" ?>\n'
+
+
+# minidom escapes quotes in text as well as in attributes, and we match it so
+# output is the same as the old prettify()
+def escape(text):
+	if '&' in text:
+		text = text.replace('&', '&amp;')
+	if '<' in text:
+		text = text.replace('<', '&lt;')
+	if '"' in text:
+		text = text.replace('"', '&quot;')
+	if '>' in text:
+		text = text.replace('>', '&gt;')
+	return text
+
+
+def _start_tag(elem):
+	start = '<' + elem.tag
+	for key, value in elem.items():
+		start += ' {}="{}"'.format(key, escape(value))
+	return start
+
+
+def _serialize(out, elem, indent, level):
+	if indent is None:
+		pad = child_pad = newline = ''
+	else:
+		pad = indent * level
+		child_pad = pad + indent
+		newline = '\n'
+
+	start = _start_tag(elem)
+	text = elem.text
+	if not len(elem):
+		if text:
+			out.append('{}{}>{}</{}>{}'.format(pad, start, escape(text), elem.tag, newline))
+		else:
+			out.append('{}{}/>{}'.format(pad, start, newline))
+		return
+
+	out.append(pad + start + '>' + newline)
+	if text:
+		out.append(child_pad + escape(text) + newline)
+	for child in elem:
+		_serialize(out, child, indent, level + 1)
+	out.append('{}</{}>{}'.format(pad, elem.tag, newline))
+
+
+def element_to_string(elem, indent='  ', level=0):
+	"""Serialize an Element (and its children) to a string in one pass.
+
+	With indent set, each element goes on its own line indented by level
+	copies of indent, and elements with only text stay on one line - the same
+	layout minidom's toprettyxml() gives. Pass indent=None for no whitespace
+	at all. Tails are ignored; none of the elements this package builds have
+	mixed content.
+	"""
+	out = []
+	_serialize(out, elem, indent, level)
+	return ''.join(out)
+
+
+def write_xml(f, elem, indent='  ', xml_declaration=True):
+	"""Write an Element tree to the binary file object f as UTF-8."""
+	if xml_declaration:
+		f.write(XML_DECLARATION.encode('utf-8'))
+	for child_string in _iter_top_level(elem, indent):
+		f.write(child_string.encode('utf-8'))
+
+
+def _iter_top_level(elem, indent):
+	# Write the root's children one at a time so we never hold the whole
+	# serialized document as one string
+	if not len(elem):
+		yield element_to_string(elem, indent)
+		return
+
+	newline = '' if indent is None else '\n'
+	yield _start_tag(elem) + '>' + newline
+	if elem.text:
+		yield (indent or '') + escape(elem.text) + newline
+	for child in elem:
+		yield element_to_string(child, indent, 1)
+	yield '</{}>{}'.format(elem.tag, newline)
@@ -0,0 +1,203 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from dataclasses import replace
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+from .CastVoteRecords import CandidateSelection, CandidateContest
+from .ess import EssCsvReader
+from .jsonwriter import CastVoteRecordReportJsonWriter
+from .writer import CastVoteRecordReportWriter
+
+SHARD_BY = ('precinct', 'ballot-style', 'count')
+MANIFEST_NAME = 'manifest.json'
+EXTENSIONS = {'xml': '.xml', 'json': '.json', 'ndjson': '.ndjson'}
+
+
+def subset_election(election, contest_ids):
+	"""A copy of election with only the Contests in contest_ids, and only the Candidates those use.
+
+	Everything keeps its id, so CVRs written against the whole Election
+	still point at the right things. An Election has to have at least one
+	Contest, so with no contest_ids at all the whole Election comes back.
+	"""
+	contests = [contest for contest in election.contests if contest.id in contest_ids]
+	if not contests:
+		return election
+	used = {sel.candidate.id for contest in contests for sel in contest.contest_selections or ()
+		if isinstance(sel, CandidateSelection) and sel.candidate}
+	candidates = [candidate for candidate in election.candidates or () if candidate.id in used]
+	return replace(election, contests=contests, candidates=candidates)
+
+
+def subset_report(report, election, contest_ids):
+	"""report with election cut down by subset_election(), and only the Parties that are still used."""
+	election = subset_election(election, contest_ids)
+	party_ids = {candidate.party.id for candidate in election.candidates or () if candidate.party}
+	party_ids.update(contest.party.id for contest in election.contests if isinstance(contest, CandidateContest) and contest.party)
+	parties = [party for party in report.parties or () if party.id in party_ids]
+	return replace(report, election=election, parties=parties, cvrs=None)
+
+
+class _DigestFile:
+	# passes writes through to f, keeping a SHA-256 and a byte count of them
+
+	def __init__(self, f):
+		self.f = f
+		self.sha256 = hashlib.sha256()
+		self.size = 0
+
+	def write(self, data):
+		self.sha256.update(data)
+		self.size += len(data)
+		return self.f.write(data)
+
+	def flush(self):
+		self.f.flush()
+
+
+def _write_shard(spool_path, election, report, path, fmt, indent):
+	# turn one shard's spooled rows into a report; runs in a worker process
+	with open(spool_path, newline='') as rows, open(path, 'wb') as f:
+		out = _DigestFile(f)
+		reader = EssCsvReader(rows, election)
+		if fmt == 'xml':
+			writer = CastVoteRecordReportWriter(out, report, indent)
+		else:
+			writer = CastVoteRecordReportJsonWriter(out, report, fmt == 'ndjson')
+		with writer:
+			writer.write_cvrs(reader.cvrs(compact=True))
+	os.remove(spool_path)
+	return writer.cvr_count, out.size, out.sha256.hexdigest()
+
+
+def _safe_name(key):
+	return re.sub(r'[^A-Za-z0-9._-]+', '_', key).strip('_.')
+
+
+class _Shard:
+	def __init__(self, index, key, spool_dir, header):
+		self.index = index
+		self.key = key
+		self.spool_path = os.path.join(spool_dir, '{:04d}.csv'.format(index))
+		self.spool = open(self.spool_path, 'w', newline='')
+		self.rows = csv.writer(self.spool)
+		self.rows.writerow(header)
+		self.count = 0
+		# BallotStyle -> indexes of its columns that have something in them on at least one of the shard's ballots
+		self.used = {}
+
+	def file_name(self, fmt):
+		name = 'shard-{:04d}'.format(self.index)
+		if self.key is not None and _safe_name(self.key):
+			name += '-' + _safe_name(self.key)
+		return name + EXTENSIONS[fmt]
+
+
+def write_ess_shards(reader, report, directory, shard_by='precinct', shard_size=None, workers=None, fmt='xml', indent='  ', rows=None):
+	"""Split the ballots from an EssCsvReader into separate reports, written side by side.
+
+	shard_by is 'precinct' or 'ballot-style' for a report per value of that
+	column, or 'count' for a report per shard_size ballots, in the order they
+	come. Each shard is a complete, schema-valid CastVoteRecordReport made
+	from report, but its Election only has the Contests that the shard's
+	ballots actually have, and only the Candidates and Parties those need.
+
+	The rows are read once and copied into a temporary CSV per shard in
+	directory, then the shards are written by a pool of worker processes
+	(os.cpu_count() of them by default), so a county-wide export turns into
+	one report per precinct in about the time of the biggest precinct. With
+	shard_by='count' each shard is handed to a worker as soon as it's full.
+	rows defaults to the reader's own; pass an islice() of it for part of the
+	export.
+
+	fmt is 'xml', 'json' or 'ndjson', and indent is for XML. When they're all
+	written, a manifest.json in directory lists each shard's file, key,
+	ballot count, size and SHA-256, which is also returned.
+	"""
+	if shard_by not in SHARD_BY:
+		raise ValueError('shard_by must be one of {}, not {!r}'.format(', '.join(SHARD_BY), shard_by))
+	plan = reader.plan
+	if shard_by == 'count':
+		if not shard_size or shard_size < 1:
+			raise ValueError("shard_by='count' needs a shard_size of at least 1")
+		key_index = None
+	else:
+		key_index = plan.precinct_index if shard_by == 'precinct' else plan.ballot_style_index
+		if key_index is None:
+			raise ValueError('The export has no {} column to shard by'.format(shard_by.replace('-', ' ')))
+	if rows is None:
+		rows = reader
+	if workers is None:
+		workers = os.cpu_count() or 1
+
+	os.makedirs(directory, exist_ok=True)
+	shards = []
+	results = {}
+	executor = ProcessPoolExecutor(workers) if workers > 1 else None
+
+	def submit(shard):
+		shard.spool.close()
+		contest_ids = {contest.id for style, used in shard.used.items() for index, contest, lookup in style.columns if index in used}
+		args = (shard.spool_path, plan.election, subset_report(report, plan.election, contest_ids),
+			os.path.join(directory, shard.file_name(fmt)), fmt, indent)
+		results[shard.index] = executor.submit(_write_shard, *args) if executor else _write_shard(*args)
+
+	try:
+		with tempfile.TemporaryDirectory(dir=directory, prefix='.spool-') as spool_dir:
+			by_key = {}
+			shard = None
+			for row in rows:
+				if key_index is None:
+					if shard is None or shard.count == shard_size:
+						if shard is not None:
+							submit(shard)
+						shard = _Shard(len(shards), None, spool_dir, reader.header)
+						shards.append(shard)
+				else:
+					key = row[key_index]
+					shard = by_key.get(key)
+					if shard is None:
+						shard = by_key[key] = _Shard(len(shards), key, spool_dir, reader.header)
+						shards.append(shard)
+				shard.rows.writerow(row)
+				shard.count += 1
+				style = plan.ballot_style(row)
+				used = shard.used.get(style)
+				if used is None:
+					used = shard.used[style] = set()
+				if len(used) < len(style.columns):
+					used.update(index for index, contest, lookup in style.columns if row[index])
+
+			for shard in shards:
+				if shard.index not in results:
+					submit(shard)
+			results = {index: result.result() if executor else result for index, result in results.items()}
+	finally:
+		for shard in shards:
+			shard.spool.close()
+		if executor:
+			executor.shutdown(cancel_futures=True)
+
+	manifest = {
+		'election': plan.election.id,
+		'shard_by': shard_by,
+		'format': fmt,
+		'cvrs': sum(shard.count for shard in shards),
+		'shards': [],
+	}
+	for shard in shards:
+		count, size, digest = results[shard.index]
+		entry = {'file': shard.file_name(fmt), 'cvrs': count, 'bytes': size, 'sha256': digest}
+		if shard.key is not None:
+			entry[shard_by] = shard.key
+		manifest['shards'].append(entry)
+
+	temporary = os.path.join(directory, MANIFEST_NAME + '.tmp')
+	with open(temporary, 'w') as f:
+		json.dump(manifest, f, indent=2)
+	os.replace(temporary, os.path.join(directory, MANIFEST_NAME))
+	return manifest
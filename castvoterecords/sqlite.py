@@ -0,0 +1,350 @@
+from itertools import islice
+import json
+import sqlite3
+
+from .CastVoteRecords import CVRContestSelection, CVRContest, CVRSnapshot, CVR, BallotMeasureContest, CandidateSelection, selection_name
+from .CastVoteRecords import _as_list
+from .compact import CompactCVR
+from .ess import EssCsvReader
+from .table import UNDERVOTE, OVERVOTE, WRITE_IN
+from .jsonreader import report_from_json
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+	report_key INTEGER PRIMARY KEY,
+	generated_date TEXT,
+	version TEXT,
+	-- the report without its CVRs, as CastVoteRecordReport.json_metadata() gives it
+	metadata TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS elections (
+	election_key INTEGER PRIMARY KEY,
+	report_key INTEGER NOT NULL REFERENCES reports,
+	election_id TEXT NOT NULL,
+	name TEXT
+);
+CREATE TABLE IF NOT EXISTS contests (
+	contest_key INTEGER PRIMARY KEY,
+	election_key INTEGER NOT NULL REFERENCES elections,
+	contest_id TEXT NOT NULL,
+	name TEXT,
+	contest_type TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS selections (
+	selection_key INTEGER PRIMARY KEY,
+	contest_key INTEGER NOT NULL REFERENCES contests,
+	selection_id TEXT NOT NULL,
+	-- the candidate's name, or Yes/No for a ballot measure
+	name TEXT,
+	is_write_in INTEGER NOT NULL DEFAULT 0
+);
+-- Each distinct way a contest was marked, stored once and shared by every
+-- ballot marked that way, like CVRContestPool does in memory.
+CREATE TABLE IF NOT EXISTS outcomes (
+	outcome_key INTEGER PRIMARY KEY,
+	contest_key INTEGER NOT NULL REFERENCES contests,
+	overvotes INTEGER NOT NULL DEFAULT 0,
+	undervotes INTEGER NOT NULL DEFAULT 0,
+	writeins INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS outcome_selections (
+	outcome_key INTEGER NOT NULL REFERENCES outcomes,
+	selection_key INTEGER NOT NULL REFERENCES selections
+);
+CREATE TABLE IF NOT EXISTS cvrs (
+	cvr_key INTEGER PRIMARY KEY,
+	election_key INTEGER NOT NULL REFERENCES elections,
+	unique_id TEXT NOT NULL,
+	snapshot_id TEXT
+);
+-- A row per CVRContest; position is its place in the CVR
+CREATE TABLE IF NOT EXISTS cvr_contests (
+	cvr_key INTEGER NOT NULL REFERENCES cvrs,
+	position INTEGER NOT NULL,
+	outcome_key INTEGER NOT NULL REFERENCES outcomes,
+	PRIMARY KEY (cvr_key, position)
+) WITHOUT ROWID;
+-- The votes on each CVR spelled out, for ad hoc queries
+CREATE VIEW IF NOT EXISTS cvr_selections AS
+	SELECT cvr_key, position, contest_key, selection_key, overvotes, undervotes, writeins
+	FROM cvr_contests JOIN outcomes USING (outcome_key) LEFT JOIN outcome_selections USING (outcome_key);
+"""
+
+# Dropped before a bulk load and made again afterwards, which is much quicker
+# than keeping them up to date a row at a time.
+INDEXES = {
+	'cvrs_unique_id': 'cvrs (unique_id)',
+	'cvrs_election': 'cvrs (election_key)',
+	'cvr_contests_outcome': 'cvr_contests (outcome_key)',
+	'outcomes_contest': 'outcomes (contest_key)',
+	'outcome_selections_outcome': 'outcome_selections (outcome_key)',
+	'outcome_selections_selection': 'outcome_selections (selection_key)',
+}
+
+
+class CVRDatabase:
+	"""Loads CVR reports into SQLite for ad hoc queries, and reads them back.
+
+	Elections, contests and selections get a row each. Each distinct contest
+	outcome (the selections marked, and any over/undervote or write-in) gets
+	a row in outcomes, and each CVR a row in cvrs plus a row per contest in
+	cvr_contests pointing at its outcome, so a question like "which ballots
+	voted for this candidate" is a join on indexed integers. The
+	cvr_selections view joins them back up. The report's metadata is kept
+	as JSON as well, so report() and iter_cvrs() give back the same
+	dataclasses that went in.
+
+	load_report() inserts with executemany(), batch_size CVRs at a time, in
+	one transaction, and only builds the indexes once the rows are in.
+
+	source is a file name or an open sqlite3.Connection.
+	"""
+
+	def __init__(self, source, batch_size=50000):
+		self.connection = source if isinstance(source, sqlite3.Connection) else sqlite3.connect(source)
+		self.batch_size = batch_size
+		self.connection.executescript(SCHEMA)
+
+	def close(self):
+		self.connection.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def create_indexes(self):
+		with self.connection:
+			self._create_indexes(self.connection.cursor())
+
+	def _create_indexes(self, cursor):
+		for name, columns in INDEXES.items():
+			cursor.execute('CREATE INDEX IF NOT EXISTS {} ON {}'.format(name, columns))
+
+	def _drop_indexes(self, cursor):
+		for name in INDEXES:
+			cursor.execute('DROP INDEX IF EXISTS {}'.format(name))
+
+	def load_report(self, report, cvrs=None):
+		"""Load a report and its CVRs (report.cvrs unless cvrs is given); returns the new report's key.
+
+		cvrs can be any iterable of CVRs or CompactCVRs, such as a
+		CastVoteRecordReportReader, and is consumed a batch at a time.
+		"""
+		if cvrs is None:
+			cvrs = report.cvrs or ()
+
+		def records(elections, cursor):
+			# (position, outcome key) for each contest on a shared ballot tuple
+			ballots = {}
+			for cvr in cvrs:
+				election_key, outcome_key = elections[cvr.election.id]
+				snapshot = cvr.cvr_snapshot[0]
+				cvr_contests = snapshot.cvr_contests or ()
+				cached = ballots.get(id(cvr_contests))
+				if cached is not None and cached[0] is cvr_contests:
+					keys = cached[1]
+				else:
+					keys = [outcome_key(cursor, cvr_contest) for cvr_contest in cvr_contests]
+					if isinstance(cvr_contests, tuple):
+						# CompactCVRs share one tuple between every ballot marked the same way
+						ballots[id(cvr_contests)] = (cvr_contests, keys)
+				yield election_key, cvr.id, snapshot.id, keys
+
+		return self._load(report, records)
+
+	def load_ess_csv(self, f, report):
+		"""Load an ESS CVR export (an open text file) for report's Election; returns the new report's key.
+
+		This goes straight from each cell to its outcome key, without making
+		a CVR per row, and gives the CVRs the ids EssPlan does.
+		"""
+		reader = EssCsvReader(f, report.election)
+		plan = reader.plan
+
+		def records(elections, cursor):
+			election_key, outcome_key = elections[plan.election.id]
+			pool = plan.pool
+			# cell value -> outcome key for each column, filled in as values turn up
+			keys_by_index = {index: {} for index, contest, lookup in plan.columns}
+			# BallotStyle -> its columns with their keys, so a row only looks at its style's contests
+			style_columns = {}
+			id_index = plan.id_index
+			for row in reader:
+				style = plan.ballot_style(row)
+				columns = style_columns.get(style)
+				if columns is None:
+					columns = style_columns[style] = [(index, contest, lookup, keys_by_index[index]) for index, contest, lookup in style.columns]
+				outcome_keys = []
+				for index, contest, lookup, keys in columns:
+					value = row[index]
+					if not value:
+						continue
+					key = keys.get(value)
+					if key is None:
+						code, sel = plan._decode(value, contest, lookup)
+						if code == OVERVOTE:
+							cvr_contest = pool.cvr_contest(contest, overvotes=1)
+						elif code == UNDERVOTE:
+							cvr_contest = pool.cvr_contest(contest, undervotes=1)
+						elif code == WRITE_IN:
+							cvr_contest = pool.cvr_contest(contest, writeins=1)
+						else:
+							cvr_contest = pool.cvr_contest(contest, sel)
+						key = keys[value] = outcome_key(cursor, cvr_contest)
+					outcome_keys.append(key)
+				cvr_number = row[id_index]
+				yield election_key, CompactCVR.id_format.format(cvr_number), CompactCVR.snapshot_id_format.format(cvr_number), outcome_keys
+
+		return self._load(report, records)
+
+	def _load(self, report, records):
+		# records(elections, cursor) yields (election key, unique id, snapshot id, outcome keys) for each CVR
+		with self.connection:
+			cursor = self.connection.cursor()
+			self._drop_indexes(cursor)
+			report_key, elections = self._insert_metadata(cursor, report)
+
+			cvr_key = cursor.execute('SELECT coalesce(max(cvr_key), 0) FROM cvrs').fetchone()[0]
+			records = records(elections, cursor)
+			while True:
+				batch = list(islice(records, self.batch_size))
+				if not batch:
+					break
+				cvr_rows = []
+				cvr_contest_rows = []
+				for election_key, unique_id, snapshot_id, outcome_keys in batch:
+					cvr_key += 1
+					cvr_rows.append((cvr_key, election_key, unique_id, snapshot_id))
+					for position, outcome_key in enumerate(outcome_keys):
+						cvr_contest_rows.append((cvr_key, position, outcome_key))
+
+				cursor.executemany('INSERT INTO cvrs (cvr_key, election_key, unique_id, snapshot_id) VALUES (?, ?, ?, ?)', cvr_rows)
+				cursor.executemany('INSERT INTO cvr_contests (cvr_key, position, outcome_key) VALUES (?, ?, ?)', cvr_contest_rows)
+
+			self._create_indexes(cursor)
+		return report_key
+
+	def _insert_metadata(self, cursor, report):
+		# returns {election id: (election key, a function giving a CVRContest's outcome key)}
+		metadata = report.json_metadata()
+		cursor.execute('INSERT INTO reports (generated_date, version, metadata) VALUES (?, ?, ?)',
+			(metadata['GeneratedDate'], report.version, json.dumps(metadata, separators=(',', ':'))))
+		report_key = cursor.lastrowid
+
+		elections = {}
+		for election in _as_list(report.election):
+			cursor.execute('INSERT INTO elections (report_key, election_id, name) VALUES (?, ?, ?)', (report_key, election.id, election.name))
+			election_key = cursor.lastrowid
+			contests = {}
+			for contest in election.contests:
+				contest_type = 'BallotMeasureContest' if isinstance(contest, BallotMeasureContest) else 'CandidateContest'
+				cursor.execute('INSERT INTO contests (election_key, contest_id, name, contest_type) VALUES (?, ?, ?, ?)',
+					(election_key, contest.id, contest.name, contest_type))
+				contest_key = cursor.lastrowid
+				selections = {}
+				for sel in contest.contest_selections:
+					is_write_in = isinstance(sel, CandidateSelection) and sel.is_write_in
+					cursor.execute('INSERT INTO selections (contest_key, selection_id, name, is_write_in) VALUES (?, ?, ?, ?)',
+						(contest_key, sel.id, selection_name(sel), int(bool(is_write_in))))
+					selections[sel.id] = cursor.lastrowid
+				contests[contest.id] = (contest_key, selections)
+			elections[election.id] = (election_key, _OutcomeKeys(contests))
+		return report_key, elections
+
+	def report_keys(self):
+		return [key for key, in self.connection.execute('SELECT report_key FROM reports ORDER BY report_key')]
+
+	def report(self, report_key=None):
+		"""The report (without its CVRs) loaded as report_key, or the only report in the database."""
+		if report_key is None:
+			report_key = self._only_report()
+		row = self.connection.execute('SELECT metadata FROM reports WHERE report_key = ?', (report_key,)).fetchone()
+		if row is None:
+			raise KeyError('No report {} in the database'.format(report_key))
+		return report_from_json(json.loads(row[0]))
+
+	def _only_report(self):
+		keys = self.report_keys()
+		if len(keys) != 1:
+			raise ValueError('The database holds {} reports, so say which one'.format(len(keys)))
+		return keys[0]
+
+	def iter_cvrs(self, report_key=None, report=None):
+		"""Yield the CVRs loaded as report_key, in the order they were loaded, as dataclasses.
+
+		The CVRs' Election and contest references point into report, which
+		defaults to self.report(report_key).
+		"""
+		if report_key is None:
+			report_key = self._only_report()
+		if report is None:
+			report = self.report(report_key)
+		by_id = {election.id: election for election in _as_list(report.election)}
+
+		elections = {}
+		for election_key, election_id in self.connection.execute('SELECT election_key, election_id FROM elections WHERE report_key = ?', (report_key,)):
+			elections[election_key] = by_id[election_id]
+
+		# outcome key -> (Contest, [ContestSelection], overvotes, undervotes, writeins)
+		outcomes = {}
+		query = ('SELECT outcome_key, election_key, contest_id, overvotes, undervotes, writeins FROM outcomes '
+			'JOIN contests USING (contest_key) WHERE election_key IN (SELECT election_key FROM elections WHERE report_key = ?)')
+		for outcome_key, election_key, contest_id, overvotes, undervotes, writeins in self.connection.execute(query, (report_key,)):
+			outcomes[outcome_key] = (elections[election_key].contest_by_id(contest_id), [], overvotes, undervotes, writeins)
+		query = ('SELECT outcome_key, selection_id FROM outcome_selections JOIN selections USING (selection_key) '
+			'WHERE outcome_key IN (SELECT outcome_key FROM outcomes JOIN contests USING (contest_key) '
+			'WHERE election_key IN (SELECT election_key FROM elections WHERE report_key = ?)) ORDER BY outcome_selections.rowid')
+		for outcome_key, selection_id in self.connection.execute(query, (report_key,)):
+			outcome = outcomes[outcome_key]
+			outcome[1].append(outcome[0].selection_by_id(selection_id))
+
+		# walk both tables in cvr_key order together rather than querying once per CVR
+		cvr_rows = self.connection.execute('SELECT cvr_key, election_key, unique_id, snapshot_id FROM cvrs '
+			'WHERE election_key IN (SELECT election_key FROM elections WHERE report_key = ?) ORDER BY cvr_key', (report_key,))
+		cvr_contest_rows = self.connection.execute('SELECT cvr_key, outcome_key FROM cvr_contests '
+			'WHERE cvr_key BETWEEN (SELECT min(cvr_key) FROM cvrs JOIN elections USING (election_key) WHERE report_key = ?) '
+			'AND (SELECT max(cvr_key) FROM cvrs JOIN elections USING (election_key) WHERE report_key = ?) '
+			'ORDER BY cvr_key, position', (report_key, report_key))
+		pending = next(cvr_contest_rows, None)
+		for cvr_key, election_key, unique_id, snapshot_id in cvr_rows:
+			cvr_contests = []
+			while pending is not None and pending[0] == cvr_key:
+				contest, selections, overvotes, undervotes, writeins = outcomes[pending[1]]
+				cvr_contests.append(CVRContest(contest=contest, overvotes=overvotes, undervotes=undervotes, writeins=writeins,
+					cvr_contest_selection=[CVRContestSelection(contest_selection=sel) for sel in selections] if selections else None))
+				pending = next(cvr_contest_rows, None)
+			yield CVR(id=unique_id, election=elections[election_key], cvr_snapshot=[CVRSnapshot(id=snapshot_id, cvr_contests=cvr_contests)])
+
+
+class _OutcomeKeys:
+	# Gives the outcome key for a CVRContest in one election, inserting the
+	# outcome the first time it's seen.
+
+	def __init__(self, contests):
+		self.contests = contests
+		self.keys = {}
+
+	def __call__(self, cursor, cvr_contest):
+		selections = cvr_contest.cvr_contest_selection
+		selection_ids = tuple(sel.contest_selection.id for sel in selections) if selections else ()
+		key = (cvr_contest.contest.id, selection_ids, cvr_contest.overvotes, cvr_contest.undervotes, cvr_contest.writeins)
+		try:
+			return self.keys[key]
+		except KeyError:
+			pass
+
+		contest_key, selection_keys = self.contests[cvr_contest.contest.id]
+		cursor.execute('INSERT INTO outcomes (contest_key, overvotes, undervotes, writeins) VALUES (?, ?, ?, ?)',
+			(contest_key, cvr_contest.overvotes, cvr_contest.undervotes, cvr_contest.writeins))
+		outcome_key = self.keys[key] = cursor.lastrowid
+		cursor.executemany('INSERT INTO outcome_selections (outcome_key, selection_key) VALUES (?, ?)',
+			[(outcome_key, selection_keys[selection_id]) for selection_id in selection_ids])
+		return outcome_key
+
+
+def write_sqlite(path, report, cvrs=None):
+	"""Load a report into the SQLite database at path, creating it if need be; returns the report's key."""
+	with CVRDatabase(path) as database:
+		return database.load_report(report, cvrs)
@@ -0,0 +1,261 @@
+from array import array
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+#
+# Each column holds one small int per ballot. Codes from 0 up are an index into
+# that contest's contest_selections; the negative ones are reserved.
+#
+UNDERVOTE = -1
+OVERVOTE = -2
+# a write-in that doesn't point at one of the contest's selections
+WRITE_IN = -3
+NOT_ON_BALLOT = -4
+
+
+class BallotTable:
+	"""Columnar storage for the marks on a lot of ballots.
+
+	Instead of a CVR -> CVRSnapshot -> CVRContest -> CVRContestSelection
+	object graph per ballot, there's one column of selection codes per
+	contest (int8 unless a contest has more than 127 selections) and a packed
+	list of CVR ids, so two million ballots by twenty contests is tens of MB.
+	column() hands back a NumPy view of a column when NumPy is installed, or
+	the array.array itself when it isn't.
+
+	The table holds one selection per contest per ballot, which is all a
+	vote-for-one contest needs.
+	"""
+
+	def __init__(self, election, contests=None):
+		self.election = election
+		self.contests = list(contests if contests is not None else election.contests)
+		self.columns = {}
+		self._selection_codes = {}
+		for contest in self.contests:
+			self.columns[contest.id] = array('b' if len(contest.contest_selections) < 127 else 'h')
+			self._selection_codes[contest.id] = {sel.id: i for i, sel in enumerate(contest.contest_selections)}
+		self._ids = bytearray()
+		self._id_offsets = array('Q', [0])
+
+	def __len__(self):
+		return len(self._id_offsets) - 1
+
+	@property
+	def nbytes(self):
+		total = len(self._ids) + len(self._id_offsets) * self._id_offsets.itemsize
+		for column in self.columns.values():
+			total += len(column) * column.itemsize
+		return total
+
+	def cvr_id(self, i):
+		return self._ids[self._id_offsets[i]:self._id_offsets[i + 1]].decode('utf-8')
+
+	def column(self, contest_id):
+		column = self.columns[contest_id]
+		if np is not None:
+			return np.frombuffer(column, dtype=column.typecode)
+		return column
+
+	def selection(self, contest_id, code):
+		"""The ContestSelection a code stands for, or None for the reserved codes."""
+		if code < 0:
+			return None
+		for contest in self.contests:
+			if contest.id == contest_id:
+				return contest.contest_selections[code]
+		raise KeyError(contest_id)
+
+	def append_codes(self, cvr_id, codes):
+		"""Add a ballot given one code per contest, in the same order as self.contests."""
+		self._ids += cvr_id.encode('utf-8')
+		self._id_offsets.append(len(self._ids))
+		for contest, code in zip(self.contests, codes):
+			self.columns[contest.id].append(code)
+
+	def append_cvr(self, cvr):
+		codes = dict.fromkeys(self.columns, NOT_ON_BALLOT)
+		for cvr_contest in cvr.cvr_snapshot[0].cvr_contests:
+			codes[cvr_contest.contest.id] = self._cvr_contest_code(cvr_contest)
+		self.append_codes(cvr.id, codes.values())
+
+	def _cvr_contest_code(self, cvr_contest):
+		if cvr_contest.overvotes:
+			return OVERVOTE
+		if cvr_contest.cvr_contest_selection:
+			if len(cvr_contest.cvr_contest_selection) > 1:
+				raise ValueError('BallotTable holds one selection per contest, but a CVRContest for {} has {}'.format(
+					cvr_contest.contest.id, len(cvr_contest.cvr_contest_selection)))
+			selection = cvr_contest.cvr_contest_selection[0].contest_selection
+			return self._selection_codes[cvr_contest.contest.id][selection.id]
+		if cvr_contest.writeins:
+			return WRITE_IN
+		return UNDERVOTE
+
+	@classmethod
+	def from_cvrs(cls, election, cvrs):
+		table = cls(election)
+		for cvr in cvrs:
+			table.append_cvr(cvr)
+		return table
+
+	@classmethod
+	def from_ess_csv(cls, election, f, id_format='_cvr_{}'):
+		"""Build a table straight from an ESS export, without making any CVR objects."""
+		# imported here since ess builds on this module's codes
+		from .ess import EssCsvReader
+
+		table = cls(election)
+		reader = EssCsvReader(f, election)
+		id_index = reader.plan.id_index
+		positions = {contest.id: i for i, contest in enumerate(table.contests)}
+		blank = [NOT_ON_BALLOT] * len(table.contests)
+		for row in reader:
+			codes = blank[:]
+			for contest, code in reader.plan.codes(row):
+				codes[positions[contest.id]] = code
+			table.append_codes(id_format.format(row[id_index]), codes)
+		return table
+
+
+class SparseBallotTable:
+	"""A BallotTable that only stores the contests each ballot's style has.
+
+	A county-wide election might have a hundred contests with any one ballot
+	on a dozen of them, and a BallotTable spends a NOT_ON_BALLOT code on
+	every one of the others. Here ballots are grouped by the set of contests
+	they have - their ballot style, in effect - and each group is a
+	BallotTable of just those contests (in parts), so memory goes with the
+	contests that are actually on the ballots. Within a group a contest the
+	ballot doesn't have is still NOT_ON_BALLOT, and undervotes are still
+	UNDERVOTE.
+
+	Ballots keep their order: which group each one is in is kept in a packed
+	array of two bytes a ballot, and where it is in that group is worked out
+	the first time cvr_id() or codes() needs it. column() puts a full column
+	together when something needs one, and tabulate() counts each group on
+	its own without doing that.
+	"""
+
+	def __init__(self, election, contests=None):
+		self.election = election
+		self.contests = list(contests if contests is not None else election.contests)
+		# tuple of contest ids -> BallotTable
+		self.parts = {}
+		self._parts = []
+		self._part_of = array('H')
+		# ballot -> row in its group, built when it's needed and dropped when a ballot is added
+		self._rows = None
+
+	def __len__(self):
+		return len(self._part_of)
+
+	@property
+	def nbytes(self):
+		return len(self._part_of) * self._part_of.itemsize + sum(part.nbytes for part in self._parts)
+
+	def part(self, contests):
+		"""The BallotTable for ballots with exactly these contests, in this order."""
+		key = tuple(contest.id for contest in contests)
+		part = self.parts.get(key)
+		if part is None:
+			part = self.parts[key] = BallotTable(self.election, contests)
+			part.index = len(self._parts)
+			self._parts.append(part)
+		return part
+
+	def _locate(self, i):
+		if self._rows is None:
+			self._rows = array('I', bytes(4 * len(self)))
+			counts = [0] * len(self._parts)
+			for j, index in enumerate(self._part_of):
+				self._rows[j] = counts[index]
+				counts[index] += 1
+		return self._parts[self._part_of[i]], self._rows[i]
+
+	def cvr_id(self, i):
+		part, row = self._locate(i)
+		return part.cvr_id(row)
+
+	def codes(self, i):
+		"""Ballot i's codes as a dict of contest id to code, for just the contests on its style."""
+		part, row = self._locate(i)
+		return {contest.id: part.columns[contest.id][row] for contest in part.contests}
+
+	def column(self, contest_id):
+		"""A full column for contest_id, with NOT_ON_BALLOT for the ballots whose style doesn't have it."""
+		for contest in self.contests:
+			if contest.id == contest_id:
+				break
+		else:
+			raise KeyError(contest_id)
+		typecode = 'b' if len(contest.contest_selections) < 127 else 'h'
+		parts = [part for part in self._parts if contest_id in part.columns]
+		if np is not None:
+			column = np.full(len(self), NOT_ON_BALLOT, dtype=typecode)
+			part_of = np.frombuffer(self._part_of, dtype=np.uint16)
+			for part in parts:
+				# a group's rows are in ballot order, so they line up with the mask
+				column[part_of == part.index] = part.column(contest_id)
+			return column
+		column = array(typecode, [NOT_ON_BALLOT]) * len(self)
+		for part in parts:
+			rows = (i for i, index in enumerate(self._part_of) if index == part.index)
+			for i, code in zip(rows, part.columns[contest_id]):
+				column[i] = code
+		return column
+
+	def selection(self, contest_id, code):
+		"""The ContestSelection a code stands for, or None for the reserved codes."""
+		if code < 0:
+			return None
+		for contest in self.contests:
+			if contest.id == contest_id:
+				return contest.contest_selections[code]
+		raise KeyError(contest_id)
+
+	def append_codes(self, cvr_id, contests, codes):
+		"""Add a ballot given the contests on it and a code for each."""
+		part = self.part(contests)
+		self._part_of.append(part.index)
+		self._rows = None
+		part.append_codes(cvr_id, codes)
+
+	def append_cvr(self, cvr):
+		cvr_contests = cvr.cvr_snapshot[0].cvr_contests or ()
+		part = self.part([cvr_contest.contest for cvr_contest in cvr_contests])
+		self._part_of.append(part.index)
+		self._rows = None
+		part.append_codes(cvr.id, [part._cvr_contest_code(cvr_contest) for cvr_contest in cvr_contests])
+
+	@classmethod
+	def from_cvrs(cls, election, cvrs):
+		table = cls(election)
+		for cvr in cvrs:
+			table.append_cvr(cvr)
+		return table
+
+	@classmethod
+	def from_ess_csv(cls, election, f, id_format='_cvr_{}'):
+		"""Build a table straight from an ESS export, grouping ballots by their Ballot Style's contests."""
+		from .ess import EssCsvReader
+
+		table = cls(election)
+		reader = EssCsvReader(f, election)
+		plan = reader.plan
+		id_index = plan.id_index
+		# BallotStyle -> part, so each row costs a dict lookup rather than hashing its contests
+		parts = {}
+		part_of = table._part_of
+		for row in reader:
+			style = plan.ballot_style(row)
+			part = parts.get(style)
+			if part is None:
+				part = parts[style] = table.part(style.contests)
+			part_of.append(part.index)
+			part.append_codes(id_format.format(row[id_index]),
+				[plan._decode(row[index], contest, lookup)[0] if row[index] else NOT_ON_BALLOT for index, contest, lookup in style.columns])
+		return table
@@ -0,0 +1,211 @@
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict
+
+from .CastVoteRecords import Contest, CandidateSelection
+from .table import np, SparseBallotTable, UNDERVOTE, OVERVOTE, WRITE_IN, NOT_ON_BALLOT
+
+
+@dataclass
+class ContestTally:
+	"""Totals for one contest.
+
+	selection_totals is keyed by ContestSelection id and includes the
+	contest's write-in selection, if it has one. writeins counts every
+	write-in, whether or not it points at a selection, and overvotes and
+	undervotes count ballots. ballots is how many ballots the contest was on.
+	"""
+	contest: Contest = None
+	selection_totals: Dict[str, int] = None
+	overvotes: int = 0
+	undervotes: int = 0
+	writeins: int = 0
+	ballots: int = 0
+
+
+def _empty_tallies(contests):
+	tallies = {}
+	for contest in contests:
+		totals = dict.fromkeys((sel.id for sel in contest.contest_selections), 0)
+		tallies[contest.id] = ContestTally(contest=contest, selection_totals=totals)
+	return tallies
+
+
+def _is_write_in(selection):
+	return isinstance(selection, CandidateSelection) and selection.is_write_in
+
+
+def _tally_from_counts(tally, counts):
+	# counts[code - NOT_ON_BALLOT] is how many ballots have that code
+	offset = -NOT_ON_BALLOT
+	for i, sel in enumerate(tally.contest.contest_selections):
+		tally.selection_totals[sel.id] = count = int(counts[i + offset])
+		if _is_write_in(sel):
+			tally.writeins += count
+	tally.overvotes = int(counts[OVERVOTE + offset])
+	tally.undervotes = int(counts[UNDERVOTE + offset])
+	tally.writeins += int(counts[WRITE_IN + offset])
+	tally.ballots = sum(int(c) for c in counts) - int(counts[NOT_ON_BALLOT + offset])
+
+
+def tabulate(table, use_numpy=None):
+	"""Count every contest in a BallotTable.
+
+	Returns a dict of contest id to ContestTally, in the table's contest
+	order. With NumPy each contest is a single bincount over its column;
+	use_numpy=False (or no NumPy installed) counts with a Counter instead,
+	which gives exactly the same results, just more slowly.
+
+	A SparseBallotTable is counted a group at a time, and adds up to the same
+	totals as the BallotTable of the same ballots.
+	"""
+	if use_numpy is None:
+		use_numpy = np is not None
+	elif use_numpy and np is None:
+		raise ImportError('tabulate(use_numpy=True) needs NumPy installed')
+
+	tallies = _empty_tallies(table.contests)
+	if isinstance(table, SparseBallotTable):
+		for part in table.parts.values():
+			_add_tallies(tallies, tabulate(part, use_numpy))
+		return tallies
+	for contest in table.contests:
+		n_codes = len(contest.contest_selections) - NOT_ON_BALLOT
+		if use_numpy:
+			# widen first: an int8 column's codes of 124 and up would wrap around when offset
+			counts = np.bincount(table.column(contest.id).astype(np.intp) - NOT_ON_BALLOT, minlength=n_codes)
+		else:
+			counter = Counter(table.columns[contest.id])
+			counts = [counter[code] for code in range(NOT_ON_BALLOT, n_codes + NOT_ON_BALLOT)]
+		_tally_from_counts(tallies[contest.id], counts)
+	return tallies
+
+
+def _count_code(tally, code):
+	# add one ballot with a BallotTable code to a tally
+	if code == NOT_ON_BALLOT:
+		return
+	tally.ballots += 1
+	if code >= 0:
+		sel = tally.contest.contest_selections[code]
+		tally.selection_totals[sel.id] += 1
+		if _is_write_in(sel):
+			tally.writeins += 1
+	elif code == OVERVOTE:
+		tally.overvotes += 1
+	elif code == UNDERVOTE:
+		tally.undervotes += 1
+	else:
+		tally.writeins += 1
+
+
+def _add_tallies(tallies, delta, sign=1):
+	# add (or with sign=-1, take away) each of delta's totals to the matching tally
+	for contest_id, change in delta.items():
+		tally = tallies[contest_id]
+		for sel_id, count in change.selection_totals.items():
+			tally.selection_totals[sel_id] += sign * count
+		tally.overvotes += sign * change.overvotes
+		tally.undervotes += sign * change.undervotes
+		tally.writeins += sign * change.writeins
+		tally.ballots += sign * change.ballots
+
+
+def tabulate_cvrs(election, cvrs):
+	"""Count CVR objects one at a time, without building a table first.
+
+	Gives the same results as tabulate(BallotTable.from_cvrs(election, cvrs)).
+	"""
+	tallies = _empty_tallies(election.contests)
+	for cvr in cvrs:
+		for cvr_contest in cvr.cvr_snapshot[0].cvr_contests:
+			tally = tallies[cvr_contest.contest.id]
+			tally.ballots += 1
+			if cvr_contest.overvotes:
+				tally.overvotes += 1
+			elif cvr_contest.cvr_contest_selection:
+				for cvr_contest_sel in cvr_contest.cvr_contest_selection:
+					sel = cvr_contest_sel.contest_selection
+					tally.selection_totals[sel.id] += 1
+					if _is_write_in(sel):
+						tally.writeins += 1
+			elif cvr_contest.writeins:
+				tally.writeins += 1
+			else:
+				tally.undervotes += 1
+	return tallies
+
+
+def tabulate_ess_rows(plan, rows):
+	"""Count rows of an ESS export with an EssPlan, without making any CVR objects.
+
+	Gives the same results as tabulate_cvrs(plan.election, plan.cvrs(rows)).
+	"""
+	tallies = _empty_tallies(plan.election.contests)
+	for row in rows:
+		for contest, code in plan.codes(row):
+			_count_code(tallies[contest.id], code)
+	return tallies
+
+
+class RunningTally:
+	"""Totals for an Election that are kept up to date as batches of ballots come in.
+
+	add_cvrs() and add_ess_rows() count a batch on its own, add its counts to
+	tallies in place and return them, so each update costs time in
+	proportion to the batch, not to everything counted so far. Each batch's
+	counts are kept under a batch id (one is made up if none is given), so
+	retract() can take a batch back out again - a tray that was rescanned or
+	rejected, say.
+
+	tallies is a dict of contest id to ContestTally, like tabulate() returns,
+	and so is each batch's delta.
+	"""
+
+	def __init__(self, election):
+		self.election = election
+		self.tallies = _empty_tallies(election.contests)
+		self.batches = {}
+		self._next_batch = 0
+
+	def __len__(self):
+		return len(self.batches)
+
+	def __contains__(self, batch_id):
+		return batch_id in self.batches
+
+	def _add(self, delta, batch_id):
+		if batch_id is None:
+			while self._next_batch in self.batches:
+				self._next_batch += 1
+			batch_id = self._next_batch
+		elif batch_id in self.batches:
+			raise ValueError('Batch {!r} has already been counted'.format(batch_id))
+		_add_tallies(self.tallies, delta)
+		self.batches[batch_id] = delta
+		return batch_id
+
+	def add_cvrs(self, cvrs, batch_id=None):
+		"""Count a batch of CVRs; returns (batch id, the batch's own tallies)."""
+		delta = tabulate_cvrs(self.election, cvrs)
+		return self._add(delta, batch_id), delta
+
+	def add_ess_rows(self, plan, rows, batch_id=None):
+		"""Count a batch of ESS export rows decoded with plan; returns (batch id, the batch's own tallies)."""
+		if plan.election.id != self.election.id:
+			raise ValueError('The plan is for Election {}, not {}'.format(plan.election.id, self.election.id))
+		delta = tabulate_ess_rows(plan, rows)
+		return self._add(delta, batch_id), delta
+
+	def delta(self, batch_id):
+		"""What a batch added to the totals."""
+		return self.batches[batch_id]
+
+	def retract(self, batch_id):
+		"""Take a batch's ballots back out of the totals; returns what it had added."""
+		try:
+			delta = self.batches.pop(batch_id)
+		except KeyError:
+			raise KeyError('No batch {!r} has been counted'.format(batch_id)) from None
+		_add_tallies(self.tallies, delta, -1)
+		return delta
@@ -0,0 +1,105 @@
+from .CastVoteRecords import CVRType, ContestStatus
+from .serialize import escape
+
+# Past this many distinct contest outcomes we stop remembering new ones
+MAX_CACHED_OUTCOMES = 100000
+
+
+class CVRTemplates:
+	"""Serializes CVRs from precomputed strings instead of Element trees.
+
+	Most of a CVR is the same on every ballot: the SelectionPosition block
+	in every CVRContestSelection, the snapshot Type, the tags and the
+	indentation. Those are worked out once per indent; the XML for each
+	distinct contest outcome (contest, selections, over/under/write-in
+	counts) is cached the first time it's seen, so a ballot comes down to
+	joining a handful of cached strings with its ids. The output is exactly
+	what element_to_string(cvr.to_xml(), indent, 1) gives.
+	"""
+
+	def __init__(self, indent='  '):
+		if indent is None:
+			pads = [''] * 7
+			self._nl = nl = ''
+		else:
+			pads = [indent * level for level in range(7)]
+			self._nl = nl = '\n'
+		self._pads = pads
+
+		self._selection_position = (
+			'{p5}<SelectionPosition>{nl}'
+			'{p6}<HasIndication>yes</HasIndication>{nl}'
+			'{p6}<IsAllocable>yes</IsAllocable>{nl}'
+			'{p6}<NumberVotes>1</NumberVotes>{nl}'
+			'{p5}</SelectionPosition>{nl}'
+			'{p5}<TotalNumberVotes>1</TotalNumberVotes>{nl}'
+			'{p4}</CVRContestSelection>{nl}').format(p4=pads[4], p5=pads[5], p6=pads[6], nl=nl)
+		self._snapshot_end = '{}<Type>{}</Type>{nl}{}</CVRSnapshot>{nl}'.format(pads[3], CVRType.ORIGINAL.value, pads[2], nl=nl)
+		self._cvr_start = pads[1] + '<CVR>' + nl
+		self._cvr_end = pads[1] + '</CVR>' + nl
+		self._outcomes = {}
+
+	def _element(self, level, tag, text):
+		if text:
+			return '{}<{}>{}</{}>{}'.format(self._pads[level], tag, escape(text), tag, self._nl)
+		return '{}<{}/>{}'.format(self._pads[level], tag, self._nl)
+
+	def _cvr_contest(self, cvr_contest):
+		pads = self._pads
+		nl = self._nl
+		parts = [pads[3], '<CVRContest>', nl, self._element(4, 'ContestId', cvr_contest.contest.id)]
+		if cvr_contest.cvr_contest_selection:
+			for cvr_contest_sel in cvr_contest.cvr_contest_selection:
+				parts.append(pads[4] + '<CVRContestSelection>' + nl)
+				parts.append(self._element(5, 'ContestSelectionId', cvr_contest_sel.contest_selection.id))
+				parts.append(self._selection_position)
+		if cvr_contest.overvotes:
+			parts.append(self._element(4, 'Overvotes', str(cvr_contest.overvotes)))
+			parts.append(self._element(4, 'Status', ContestStatus.OVERVOTED.value))
+		if cvr_contest.undervotes:
+			parts.append(self._element(4, 'Status', ContestStatus.UNDERVOTED.value))
+			parts.append(self._element(4, 'Undervotes', str(cvr_contest.undervotes)))
+		if cvr_contest.writeins:
+			parts.append(self._element(4, 'WriteIns', str(cvr_contest.writeins)))
+		parts.append(pads[3] + '</CVRContest>' + nl)
+		return ''.join(parts)
+
+	def cvr_contest_to_string(self, cvr_contest):
+		selections = cvr_contest.cvr_contest_selection
+		key = (cvr_contest.contest.id,
+			tuple(sel.contest_selection.id for sel in selections) if selections else (),
+			cvr_contest.overvotes, cvr_contest.undervotes, cvr_contest.writeins)
+		try:
+			return self._outcomes[key]
+		except KeyError:
+			pass
+		fragment = self._cvr_contest(cvr_contest)
+		if len(self._outcomes) < MAX_CACHED_OUTCOMES:
+			self._outcomes[key] = fragment
+		return fragment
+
+	def cvr_to_string(self, cvr):
+		snapshot = cvr.cvr_snapshot[0]
+		parts = [self._cvr_start,
+			self._element(2, 'CurrentSnapshotId', snapshot.id),
+			'{}<CVRSnapshot ObjectId="{}">{}'.format(self._pads[2], escape(snapshot.id), self._nl)]
+		if snapshot.cvr_contests:
+			for cvr_contest in snapshot.cvr_contests:
+				parts.append(self.cvr_contest_to_string(cvr_contest))
+		parts.append(self._snapshot_end)
+		parts.append(self._element(2, 'ElectionId', cvr.election.id))
+		parts.append(self._element(2, 'UniqueId', cvr.id))
+		parts.append(self._cvr_end)
+		return ''.join(parts)
+
+
+_templates = {}
+
+
+def templates_for(indent):
+	"""The shared CVRTemplates for an indent, made the first time it's asked for."""
+	try:
+		return _templates[indent]
+	except KeyError:
+		templates = _templates[indent] = CVRTemplates(indent)
+		return templates
@@ -0,0 +1,153 @@
+from .metrics import NULL_METRICS
+from .serialize import XML_DECLARATION, element_to_string, _start_tag
+from .templates import templates_for
+
+
+def cvr_to_string(cvr, indent='  ', fast=True):
+	"""Serialize a CVR the way CastVoteRecordReportWriter writes it inside the report.
+
+	The fast path fills in precomputed templates (see CVRTemplates);
+	fast=False goes through cvr.to_xml() and gives the same string.
+	"""
+	if fast:
+		return templates_for(indent).cvr_to_string(cvr)
+	return element_to_string(cvr.to_xml(), indent, 1)
+
+
+class CastVoteRecordReportWriter:
+	"""Writes a CastVoteRecordReport to a binary file object one CVR at a time.
+
+	The report passed in supplies everything except the CVRs - the Election,
+	GpUnit, Parties and ReportingDevice. Its cvrs member is ignored. Each CVR
+	handed to write_cvr() is serialized and written straight away, so memory
+	use doesn't depend on how many ballots go through the writer.
+
+	indent is passed on to element_to_string(); the default gives the same
+	layout as utils.prettify(), and None writes no whitespace at all. With
+	fast=False CVRs are serialized through their to_xml() methods rather
+	than from templates.
+
+	Pass a Metrics object as metrics to have serializing and writing timed
+	and CVRs, contests and bytes counted; without one the writer doesn't
+	measure anything.
+
+	Pass a ReportIndexBuilder as index to have where each CVR lands in the
+	file noted as it's written; save it once the writer is closed to get an
+	index for IndexedReport. That needs f to be uncompressed and to start
+	out empty, since the offsets are counted from the first byte written.
+	"""
+
+	def __init__(self, f, report, indent='  ', fast=True, metrics=None, index=None):
+		self.f = f
+		self.report = report
+		self.indent = indent
+		self.fast = fast
+		self._newline = '' if indent is None else '\n'
+		self.cvr_count = 0
+		self._started = False
+		self._closed = False
+		self.metrics = metrics or NULL_METRICS
+		if self.metrics.enabled:
+			# swapped in per instance, so the unmeasured path doesn't even check
+			self._write = self._write_measured
+			self.write_cvr = self._write_cvr_measured
+		self.index = index
+		if index is not None:
+			self._write_unindexed = self._write
+			self._write = self._write_indexed
+
+	def __enter__(self):
+		self.write_header()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		# don't write a trailer onto a half-written report
+		if exc_type is None:
+			self.close()
+
+	def _write(self, text):
+		self.f.write(text.encode('utf-8'))
+
+	def _write_measured(self, text):
+		metrics = self.metrics
+		data = text.encode('utf-8')
+		metrics.start('write')
+		self.f.write(data)
+		metrics.stop()
+		metrics.count('bytes_written', len(data))
+
+	def _write_indexed(self, text):
+		# every write holds whole CVRs, so the index can find them in it
+		self.index.feed(text.encode('utf-8'))
+		self._write_unindexed(text)
+
+	def write_header(self):
+		if self._started:
+			return
+		self._started = True
+
+		# the root stays open until close(), so write its start tag by hand
+		self._write(XML_DECLARATION + _start_tag(self.report.root_element()) + '>' + self._newline)
+
+	def write_cvr(self, cvr):
+		if not self._started:
+			self.write_header()
+		self._write(cvr_to_string(cvr, self.indent, self.fast))
+		self.cvr_count += 1
+
+	def _write_cvr_measured(self, cvr):
+		if not self._started:
+			self.write_header()
+		metrics = self.metrics
+		metrics.start('serialize')
+		text = cvr_to_string(cvr, self.indent, self.fast)
+		metrics.stop()
+		self._write(text)
+		self.cvr_count += 1
+		metrics.count('cvr_contests', len(cvr.cvr_snapshot[0].cvr_contests or ()))
+		metrics.count('cvrs')
+
+	def write_fragment(self, fragment, count=1):
+		"""Write CVRs that were already serialized by cvr_to_string() - by a worker process, say."""
+		if not self._started:
+			self.write_header()
+		self._write(fragment)
+		self.cvr_count += count
+		self.metrics.count('cvrs', count)
+
+	def write_cvrs(self, cvrs):
+		for cvr in cvrs:
+			self.write_cvr(cvr)
+
+	def close(self):
+		if self._closed:
+			return
+		if not self._started:
+			self.write_header()
+		self._closed = True
+
+		# The schema wants the Election and the rest of the report metadata after all the CVRs
+		with self.metrics.stage('trailer'):
+			for element in self.report.trailer_elements():
+				self._write(element_to_string(element, self.indent, 1))
+			self._write('</CastVoteRecordReport>\n')
+		with self.metrics.stage('write'):
+			self.f.flush()
+
+
+def write_report(f, report, cvrs=None, indent='  ', fast=True, metrics=None, index=None):
+	"""Stream a whole report to the binary file object f.
+
+	cvrs can be any iterable (a generator is best for big reports); if it's
+	not given, the report's own cvrs list is written. metrics is passed on
+	to the writer, which also runs the loop over cvrs inside
+	metrics.profiled(). index, a ReportIndexBuilder, is passed on too.
+	"""
+	if cvrs is None:
+		cvrs = report.cvrs
+
+	with CastVoteRecordReportWriter(f, report, indent, fast, metrics, index) as writer:
+		with writer.metrics.profiled():
+			writer.write_cvrs(cvrs)
+
+	return writer.cvr_count
@@ -0,0 +1,34 @@
+from castvoterecords.integrity import IntegrityChecker
+
+import argparse
+import sys
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Check a NIST CVR XML report, or an ESS CVR export, for duplicate ballots and ids that point at nothing')
+	parser.add_argument("report", help="The report to check, or with --csv the ESS export")
+	parser.add_argument("--csv", help="The file is an ESS CSV export, checked against the election in convert_to_cvr.py", action="store_true")
+	parser.add_argument("--memory", help="Megabytes of ids to hold in memory before spilling them to temporary files. Default is 256", type=int, default=256)
+	parser.add_argument("--tmpdir", help="Directory for the temporary files. Default is the system's")
+	parser.add_argument("--max-problems", help="Stop printing details after this many problems. Default is 100", type=int, default=100)
+	args = parser.parse_args()
+
+	checker = IntegrityChecker(args.memory << 20, args.tmpdir, args.max_problems)
+	if args.csv:
+		from convert_to_cvr import fall18_wd9
+		with open(args.report, newline='') as f:
+			result = checker.check_ess_csv(f, fall18_wd9)
+	else:
+		result = checker.check_report(args.report)
+
+	for problem in result.problems:
+		where = 'line {}'.format(problem.line) if problem.line is not None else 'metadata'
+		print('{}: {} ({})'.format(where, problem.message, problem.kind))
+	if result.problem_count > len(result.problems):
+		print('... and {} more'.format(result.problem_count - len(result.problems)))
+	print('Checked {} records: {} problems'.format(result.records, result.problem_count), file=sys.stderr)
+	exit(0 if result else 1)
+
+
+if __name__ == '__main__':
+	main()
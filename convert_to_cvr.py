@@ -1,16 +1,17 @@
-from castvoterecords import Code, Candidate, Party, IdentifierType, CandidateContest, VoteVariation, CandidateSelection, ContestSelection, CVRContestSelection, CVRContest, CVRSnapshot, CVR, Election, GpUnit, ReportingUnitType, CastVoteRecordReport, ReportingDevice, BallotMeasureContest, BallotMeasureSelection
-from utils import prettify
+from castvoterecords import Code, Candidate, Party, IdentifierType, CandidateContest, VoteVariation, CandidateSelection, Election, GpUnit, ReportingUnitType, CastVoteRecordReport, ReportingDevice, BallotMeasureContest, BallotMeasureSelection
+from castvoterecords import write_report, CastVoteRecordReportWriter, parallel_cvr_fragments, EssCsvReader, Metrics, NULL_METRICS
+from castvoterecords import write_json_report, CastVoteRecordReportJsonWriter, cvr_to_json, ReportAppender, AppendConflict, write_ess_shards, codec_for
+from castvoterecords import report_pipeline, ReportIndexBuilder, index_path_for
+from utils import open_output
 
-import csv
+from functools import partial
 from itertools import islice
 import argparse
+import asyncio
+import cProfile
+import sys
 
 
-parser = argparse.ArgumentParser(description='Convert an ESS Report into a NIS CVR XML')
-parser.add_argument("--file", help="CSV input file to process. Default is ward9_fall18.csv", default="ward9_fall18.csv")
-parser.add_argument("--all", help= "Process entire file instead of only 10 rows", action="store_true")
-args = parser.parse_args()
-
 #
 # We'll build the CVR up from the bottom. First, we'll create the political parties that appear in this CVR
 #
@@ -55,16 +56,12 @@ turnbull_selection = CandidateSelection(candidate=turnbull, id="_sel_GOV_Turnbul
 gov_writein = Candidate(code=wisc_statewide_code, name="write-in:", id="_GOV_write-in")
 gov_writein_selection = CandidateSelection(candidate=gov_writein, is_write_in=True, id="_sel_GOV_write-in")
 
-# Having a list of candidates is handy for later. Also, we'll want a map of candidate names
-# back to the selection, so we can look those up later
+# Having a list of candidates is handy for later
 gov_candidates = [walker, evers, anderson, white, turnbull, enz, gov_writein]
-gov_sels = {}
-for c in [walker_selection, evers_selection, anderson_selection, white_selection, enz_selection, turnbull_selection, gov_writein_selection]:
-	gov_sels[c.candidate.name] = c
 
 #
 # Once we've got all the candidates created, we'll create a contest to put them all in
-# TODO: add a helper in the CandidateContest object to look up a contest selection given a name
+# Contests can look their selections up by name (gov_contest.selection_by_name(...)), and the Election by id
 #
 gov_contest = CandidateContest(name='Governor / Lieutenant Governor', vote_variation=VoteVariation.N_OF_M, contest_selections=[walker_selection, evers_selection, anderson_selection, white_selection, turnbull_selection, enz_selection, gov_writein_selection], id="_Contest_GOV")
 
@@ -82,9 +79,6 @@ ag_writein = Candidate(code=wisc_statewide_code, name="write-in:", id="_AG_write
 ag_writein_selection = CandidateSelection(candidate=ag_writein, is_write_in=True, id="_sel_AG_write-in")
 
 ag_candidates = [schimel, kaul, larson, ag_writein]
-ag_sels = {}
-for c in [schimel_selection, kaul_selection, larson_selection, ag_writein_selection]:
-	ag_sels[c.candidate.name] = c
 
 ag_contest = CandidateContest(name='Attorney General', vote_variation=VoteVariation.N_OF_M, contest_selections=[schimel_selection, kaul_selection, larson_selection, ag_writein_selection], id="_Contest_AG")
 
@@ -99,9 +93,6 @@ sos_writein = Candidate(code=wisc_statewide_code, name="write-in:", id="_SOS_wri
 sos_writein_selection = CandidateSelection(candidate=sos_writein, is_write_in=True, id="_sel_SOS_write-in")
 
 sos_candidates = [schroeder, lafollette, sos_writein]
-sos_sels = {}
-for c in [schroeder_selection, lafollette_selection, sos_writein_selection]:
-	sos_sels[c.candidate.name] = c
 
 sos_contest = CandidateContest(name='Secretary of State', vote_variation=VoteVariation.N_OF_M, contest_selections=[schroeder_selection, lafollette_selection, sos_writein_selection], id="_Contest_SOS")
 
@@ -119,9 +110,6 @@ tres_writein = Candidate(code=wisc_statewide_code, name="write-in:", id="_TRES_w
 tres_writein_selection = CandidateSelection(candidate=tres_writein, is_write_in=True, id="_sel_TRES_write-in")
 
 tres_candidates = [hartwig, godlewski, zuelke, tres_writein]
-tres_sels = {}
-for c in [hartwig_selection, godlewski_selection, zuelke_selection, tres_writein_selection]:
-	tres_sels[c.candidate.name] = c
 
 tres_contest = CandidateContest(name='State Treasurer', vote_variation=VoteVariation.N_OF_M, contest_selections=[hartwig_selection, godlewski_selection, zuelke_selection, tres_writein_selection], id="_Contest_TRES")
 
@@ -136,9 +124,6 @@ ussen_writein = Candidate(code=federal_code, name="write-in:", id="_ussen_write-
 ussen_writein_selection = CandidateSelection(candidate=ussen_writein, is_write_in=True, id="_sel_ussen_write-in")
 
 ussen_candidates = [vukmir, baldwin, ussen_writein]
-ussen_sels = {}
-for c in [vukmir_selection, baldwin_selection, ussen_writein_selection]:
-	ussen_sels[c.candidate.name] = c
 
 ussen_contest = CandidateContest(name='United States Senator', vote_variation=VoteVariation.N_OF_M, contest_selections=[vukmir_selection, baldwin_selection, ussen_writein_selection], id="_Contest_USSEN")
 
@@ -150,9 +135,6 @@ house_writein = Candidate(code=federal_code, name="write-in:", id="_ushouse_writ
 house_writein_selection = CandidateSelection(candidate=house_writein, is_write_in=True, id="_sel_ushouse_write-in")
 
 house_candidates = [pocan, house_writein]
-house_sels = {}
-for c in [pocan_selection, house_writein_selection]:
-	house_sels[c.candidate.name] = c
 
 house_contest = CandidateContest(name='Representative in Congress District 2', vote_variation=VoteVariation.N_OF_M, contest_selections=[pocan_selection, house_writein_selection], id="_Contest_USHOUSE")
 
@@ -164,9 +146,6 @@ assembly_writein = Candidate(code=wisc_statewide_code, name="write-in:", id="_wi
 assembly_writein_selection = CandidateSelection(candidate=assembly_writein, is_write_in=True, id="_sel_wiassembly_write-in")
 
 assembly_candidates = [sargent, assembly_writein]
-assembly_sels = {}
-for c in [sargent_selection, assembly_writein_selection]:
-	assembly_sels[c.candidate.name] = c
 
 assembly_contest = CandidateContest(name='Representative to the Assembly District 48', vote_variation=VoteVariation.N_OF_M, contest_selections=[sargent_selection, assembly_writein_selection], id="_Contest_WIAssembly48")
 
@@ -178,9 +157,6 @@ sheriff_writein = Candidate(code=dane_code, name="write-in:", id="_danesheriff_w
 sheriff_writein_selection = CandidateSelection(candidate=sheriff_writein, is_write_in=True, id="_sel_danesheriff_write-in")
 
 sheriff_candidates = [mahoney, sheriff_writein]
-sheriff_sels = {}
-for c in [mahoney_selection, sheriff_writein_selection]:
-	sheriff_sels[c.candidate.name] = c
 
 sheriff_contest = CandidateContest(name='Sheriff Dane County', vote_variation=VoteVariation.N_OF_M, contest_selections=[mahoney_selection, sheriff_writein_selection], id="_Contest_DaneSheriff")
 
@@ -192,25 +168,16 @@ danecoc_writein = Candidate(code=dane_code, name="write-in:", id="_danecoc_write
 danecoc_writein_selection = CandidateSelection(candidate=danecoc_writein, is_write_in=True, id="_sel_danecoc_write-in")
 
 danecoc_candidates = [esqueda, danecoc_writein]
-danecoc_sels = {}
-for c in [esqueda_selection, danecoc_writein_selection]:
-	danecoc_sels[c.candidate.name] = c
 
 danecoc_contest = CandidateContest(name='Clerk of Circuit Court Dane County', vote_variation=VoteVariation.N_OF_M, contest_selections=[esqueda_selection, danecoc_writein_selection], id="_Contest_DaenCOC")
 
 weed_yes_selection = BallotMeasureSelection(selection='Yes', id="_sel_weed_yes")
 weed_no_selection = BallotMeasureSelection(selection='No', id="_sel_weed_no")
-weed_sels = {}
-weed_sels['Yes'] = weed_yes_selection
-weed_sels['No'] = weed_no_selection
 
 weed_referenda = BallotMeasureContest(name="County Referendum re: legalize marijuana", vote_variation=VoteVariation.N_OF_M, contest_selections=[weed_yes_selection, weed_no_selection], id="_Contest_Weed")
 
 tax_yes_selection = BallotMeasureSelection(selection='Yes', id="_sel_tax_yes")
 tax_no_selection = BallotMeasureSelection(selection='No', id="_sel_tax_no")
-tax_sels = {}
-tax_sels['Yes'] = tax_yes_selection
-tax_sels['No'] = tax_no_selection
 
 tax_referenda = BallotMeasureContest(name="County Referendum re: tax loopholes", vote_variation=VoteVariation.N_OF_M, contest_selections=[tax_yes_selection, tax_no_selection], id="_Contest_Tax")
 
@@ -233,83 +200,154 @@ fall18_wd9 = Election(id = '_fall_2018_madison_ward_9', name='Fall 2018 Ward 9',
 # The CSV included is ~2300 ballots with a whole slug of different offices to be elected.
 #
 
-ward9_file = open(args.file)
-ward9_data = csv.DictReader(ward9_file)
-
-cvrs = []
-
-limit = 10
-if args.all:
-	limit = None
-for row in islice(ward9_data, limit):
-	cvr_id = row['Cast Vote Record']
-
-	cvr_contests = []
-
+# Each row becomes a CVR. castvoterecords.EssCsvReader matches each column of the export to the contest with the
+# same name in our election, and each cell to the selection whose candidate name (or Yes/No) it holds.
+#
 # A CVRContest is an actual vote record for a specific office- it refers to the objects we created earlier to get the common data
-# So this first object is saying 'This is a vote in the gov contest and it's a vote for Tony Evers'
-# Then the second object is saying 'This is a vote in the ag contest and it's a vote for Josh Kaul' 
+# So for a ballot that voted for Tony Evers, there's a CVRContest saying 'This is a vote in the gov contest and it's a vote for Tony Evers'
 # Note that they're specific to individual voters - the CVRContest for Gov object (and CVRContesttSelection object) from ballot 239377 is a different 
 # object from the CVRContest 
 # for Gov for 269378, even though they're both for Evers - they could be marked differently or whatever, so the NIST CVR Standard treats them as different objects
-
-	# I am probably going to hell for this
-	contests = [
-			('Governor / Lieutenant Governor', gov_sels, gov_contest, 'gov'),
-			('Attorney General', ag_sels, ag_contest, 'ag'),
-			('Secretary of State', sos_sels, sos_contest, 'sos'),
-			('State Treasurer', tres_sels, tres_contest, 'tres'),
-			('United States Senator', ussen_sels, ussen_contest, 'ussen'),
-			('Representative in Congress District 2', house_sels, house_contest, 'ushouse'),
-			('Representative to the Assembly District 48', assembly_sels, assembly_contest, 'wiassem48'),
-			('Sheriff Dane County', sheriff_sels, sheriff_contest, 'danesheriff'),
-			('Clerk of Circuit Court Dane County', danecoc_sels, danecoc_contest, 'danecoc'),
-			('County Referendum re: tax loopholes', tax_sels, tax_referenda, 'tax'),
-			('County Referendum re: legalize marijuana', weed_sels, weed_referenda, 'weed')	
-			]
-	for c in contests: 
-		selection = row[c[0]]
-		choices = c[1]
-		contest = c[2]
-		suffix = c[3]
-
-
-		if selection == 'overvote':
-			cvr_contest = CVRContest(contest=contest, 
-						id='_cvr_contest_{}_{}'.format(cvr_id, suffix), 
-						overvotes = 1)
-		elif selection == 'undervote':
-			cvr_contest = CVRContest(contest=contest, 
-						id='_cvr_contest_{}_{}'.format(cvr_id, suffix), 
-						undervotes = 1)
-		else:
-			cvr_contest_selection = CVRContestSelection(contest_selection = choices[selection], id= '_cvr{}_cs_{}'.format(cvr_id, suffix))
-			cvr_contest = CVRContest(contest=contest, 
-						id='_cvr_contest_{}_{}'.format(cvr_id, suffix), 
-						cvr_contest_selection=[cvr_contest_selection]
-						)
-		cvr_contests.append(cvr_contest)
-		# end of processing a single contest for loop
-	# end of loop over all contests on a single ballot
-
 #
-# Now we put actual ballot together - we take the choices from ballot and bundle them together as a 'Snapshot', and wrap them in a 'CVR'
+# Then the choices from a ballot are bundled together as a 'Snapshot', and wrapped in a 'CVR'
 # We also need to say what election this is for, which is why we had to create that object before setting up the specific CVR records
 #
-	cvr = CVR(id="_cvr_{}".format(cvr_id), 
-			election=fall18_wd9, 
-			cvr_snapshot=[CVRSnapshot(id='_cvr_snapshot_{}_001'.format(cvr_id), cvr_contests=cvr_contests)]
-			)
-
-	cvrs.append(cvr)
-#end of processing all ballots
+# We ask for compact CVRs, which share one CVRContest between every ballot with the same mark in a contest
+# and only work out ids when they're written. They serialize exactly the same, but are much cheaper to build.
+#
 
 #
 # Finally, put the election metadata together with the ballot-level results and call it a report.
+# The writer streams each CVR out as soon as it's built and adds the election metadata at the end.
 #
-fall18_wd9_cvr_report = CastVoteRecordReport(election=fall18_wd9, cvrs = cvrs, gp_unit = ward9, reporting_device = ward9_tabulator, parties = parties)
-fall18_xml = fall18_wd9_cvr_report.to_xml()
-
-print(prettify(fall18_xml))
-
-
+fall18_wd9_cvr_report = CastVoteRecordReport(election=fall18_wd9, gp_unit = ward9, reporting_device = ward9_tabulator, parties = parties)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Convert an ESS Report into a NIST CVR XML or JSON report')
+	parser.add_argument("--file", help="CSV input file to process. Default is ward9_fall18.csv", default="ward9_fall18.csv")
+	parser.add_argument("--all", help= "Process entire file instead of only 10 rows", action="store_true")
+	parser.add_argument("--output", help="File to write the report to. Default is stdout. A name ending in .gz, .xz or .bz2 is compressed on a background thread as it's written", default="-")
+	parser.add_argument("--compress-level", help="Compression level for a compressed --output: 1-9 for .gz and .bz2, 0-9 for .xz. Default is the codec's usual (6, 6 and 9)", type=int)
+	parser.add_argument("--no-indent", help="Don't pretty-print the report, which makes it smaller and faster to write", action="store_true")
+	parser.add_argument("--format", help="xml (the default), json, or ndjson for JSON with one CVR per line after a line of report metadata", choices=["xml", "json", "ndjson"], default="xml")
+	parser.add_argument("--workers", help="Build and serialize CVRs in this many processes. Default is 1, which does everything in this process", type=int, default=1)
+	parser.add_argument("--chunk-size", help="Rows handed to a worker process at a time when --workers is more than 1, or passed between --pipeline stages at a time. Default is 1000", type=int, default=1000)
+	parser.add_argument("--append", help="Add the CSV's ballots to the existing XML report in --output instead of writing a new one. Ballots already in the report are an error", action="store_true")
+	parser.add_argument("--shard-by", help="Write a separate report per precinct, per ballot style, or per --shard-size ballots into the directory --output, written by --workers processes, with a manifest.json listing them", choices=["precinct", "ballot-style", "count"])
+	parser.add_argument("--shard-size", help="Ballots per report with --shard-by count", type=int)
+	parser.add_argument("--pipeline", help="Read, build, serialize and write on separate threads (or asyncio tasks) joined by bounded queues, so file I/O and compression overlap with building CVRs. --metrics then has each stage's timings and queue depths", nargs="?", const="threads", choices=["threads", "asyncio"])
+	parser.add_argument("--index", help="Also write an index of where each CVR is in the report, to --output with .idx added, for castvoterecords.IndexedReport to fetch ballots by UniqueId or position without reading the whole report. Needs an uncompressed XML report file", action="store_true")
+	parser.add_argument("--metrics", help="Write per-stage timings, counts and peak memory to this JSON file")
+	parser.add_argument("--progress", help="Print a progress line to stderr every this many seconds", type=float)
+	parser.add_argument("--profile", help="Run the conversion loop under cProfile and write the stats to this file")
+	args = parser.parse_args()
+	if args.append and (args.output == '-' or args.format != 'xml' or args.workers > 1 or codec_for(args.output)):
+		parser.error('--append needs an uncompressed XML report file as --output, and --workers 1')
+	if args.shard_by and (args.output == '-' or args.append):
+		parser.error('--shard-by needs a directory as --output, and can\'t be used with --append')
+	if args.pipeline and (args.workers > 1 or args.append or args.shard_by):
+		parser.error('--pipeline can\'t be used with --workers, --append or --shard-by')
+	if args.index and (args.output == '-' or args.format != 'xml' or codec_for(args.output) or args.append or args.shard_by):
+		parser.error('--index needs an uncompressed XML report file as --output, and can\'t be used with --append or --shard-by')
+	if args.shard_by == 'count' and not args.shard_size:
+		parser.error('--shard-by count needs --shard-size')
+
+	limit = 10
+	if args.all:
+		limit = None
+
+	indent = None if args.no_indent else '  '
+
+	metrics = NULL_METRICS
+	profiler = cProfile.Profile() if args.profile else None
+	if args.metrics or args.progress or profiler:
+		metrics = Metrics(progress_every=args.progress, profiler=profiler)
+
+	if args.append:
+		# new CVRs go in before the Election in the layout the report already has, so --no-indent doesn't apply
+		with open(args.file, newline='') as ward9_file:
+			with metrics.stage('read_header'):
+				ward9_data = EssCsvReader(ward9_file, fall18_wd9)
+			with metrics.stage('open_report'):
+				appender = ReportAppender(args.output)
+			rows = metrics.timed(islice(ward9_data, limit), 'read_csv', 'rows')
+			cvrs = metrics.timed(ward9_data.plan.cvrs(rows, compact=True), 'build_cvrs')
+			with metrics.stage('append'), metrics.profiled():
+				try:
+					metrics.count('cvrs', appender.append(cvrs))
+				except AppendConflict as e:
+					print('Cannot append: {}'.format(e), file=sys.stderr)
+					exit(1)
+	elif args.shard_by:
+		with open(args.file, newline='') as ward9_file:
+			with metrics.stage('read_header'):
+				ward9_data = EssCsvReader(ward9_file, fall18_wd9)
+			rows = metrics.timed(islice(ward9_data, limit), 'read_csv', 'rows')
+			with metrics.stage('shards'):
+				manifest = write_ess_shards(ward9_data, fall18_wd9_cvr_report, args.output, args.shard_by, args.shard_size, args.workers, args.format, indent, rows)
+			metrics.count('cvrs', manifest['cvrs'])
+	else:
+		convert(args, limit, indent, metrics)
+
+	if args.metrics:
+		with open(args.metrics, 'w') as f:
+			metrics.dump(f)
+	if profiler:
+		profiler.dump_stats(args.profile)
+
+
+def convert(args, limit, indent, metrics):
+	index = ReportIndexBuilder() if args.index else None
+	with open(args.file, newline='') as ward9_file, open_output(args.output, args.compress_level) as out:
+		with metrics.stage('read_header'):
+			ward9_data = EssCsvReader(ward9_file, fall18_wd9)
+		if args.pipeline:
+			convert_pipelined(args, islice(ward9_data, limit), ward9_data.plan, indent, out, metrics, index)
+		elif args.workers > 1:
+			rows = metrics.timed(islice(ward9_data, limit), 'read_csv', 'rows')
+			# workers send back each chunk of CVRs already serialized, and we write them in order
+			if args.format == 'xml':
+				writer = CastVoteRecordReportWriter(out, fall18_wd9_cvr_report, indent, metrics=metrics, index=index)
+				serialize, separator = None, ''
+			else:
+				writer = CastVoteRecordReportJsonWriter(out, fall18_wd9_cvr_report, args.format == 'ndjson', metrics=metrics)
+				serialize, separator = cvr_to_json, writer.separator
+			with writer, metrics.profiled():
+				fragments = parallel_cvr_fragments(rows, partial(ward9_data.plan.cvrs, compact=True), args.workers, args.chunk_size, indent, serialize, separator)
+				for fragment, count in metrics.timed(fragments, 'workers'):
+					writer.write_fragment(fragment, count)
+		else:
+			rows = metrics.timed(islice(ward9_data, limit), 'read_csv', 'rows')
+			cvrs = metrics.timed(ward9_data.plan.cvrs(rows, compact=True), 'build_cvrs')
+			if args.format == 'xml':
+				write_report(out, fall18_wd9_cvr_report, cvrs, indent, metrics=metrics, index=index)
+			else:
+				write_json_report(out, fall18_wd9_cvr_report, cvrs, args.format == 'ndjson', metrics=metrics)
+	if index is not None:
+		with metrics.stage('index'):
+			index.save(index_path_for(args.output))
+
+
+def convert_pipelined(args, rows, plan, indent, out, metrics, index=None):
+	# Metrics keeps one stack of running stages, so only the sink's thread (in the writer) touches it
+	if args.format == 'xml':
+		writer = CastVoteRecordReportWriter(out, fall18_wd9_cvr_report, indent, metrics=metrics, index=index)
+		serialize, separator = None, ''
+	else:
+		writer = CastVoteRecordReportJsonWriter(out, fall18_wd9_cvr_report, args.format == 'ndjson', metrics=metrics)
+		serialize, separator = cvr_to_json, writer.separator
+	with writer:
+		pipeline = report_pipeline(rows, partial(plan.cvrs, compact=True), writer, args.chunk_size, serialize=serialize, separator=separator)
+		with metrics.stage('pipeline'), metrics.profiled():
+			if args.pipeline == 'asyncio':
+				asyncio.run(pipeline.run_async())
+			else:
+				pipeline.run()
+	metrics.count('rows', pipeline.stats[0].items)
+	metrics.record('pipeline', pipeline.stats_dict())
+
+
+# Worker processes may import this file, so only run when it's the script
+if __name__ == '__main__':
+	main()
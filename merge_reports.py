@@ -0,0 +1,51 @@
+from castvoterecords import GpUnit, ReportingUnitType, Metrics, NULL_METRICS
+from castvoterecords.merge import merge_reports, MergeConflict
+from utils import open_output
+
+import argparse
+import os
+import sys
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Merge NIST CVR XML reports, e.g. one per ward or tabulator, into one report')
+	parser.add_argument("reports", help="The reports to merge, in the order their CVRs should go in", nargs="+")
+	parser.add_argument("--output", help="File to write the merged report to. Default is stdout", default="-")
+	parser.add_argument("--no-indent", help="Don't indent the merged report's CVRs or metadata", action="store_true")
+	parser.add_argument("--scope-id", help="Make every merged Election's scope a new GpUnit with this ObjectId, e.g. the county, instead of requiring the reports to agree on it")
+	parser.add_argument("--scope-name", help="Name of the --scope-id GpUnit. Default is the id")
+	parser.add_argument("--scope-type", help="Type of the --scope-id GpUnit. Default is combined-precinct", choices=[t.value for t in ReportingUnitType], default=ReportingUnitType.COMBINED_PRECINCT.value)
+	parser.add_argument("--no-check-ids", help="Don't check for duplicate UniqueIds and ObjectIds, which saves hashing every id and a second pass when hashes repeat", action="store_true")
+	parser.add_argument("--memory", help="Megabytes of hashed ids to hold in memory for the duplicate check before spilling them to temporary files. Default is 256", type=int, default=256)
+	parser.add_argument("--tmpdir", help="Directory for those temporary files. Default is the system's")
+	parser.add_argument("--workers", help="Read this many reports ahead in background threads while writing. Default is 0, which reads them one after another", type=int, default=0)
+	parser.add_argument("--metrics", help="Write timings and counts to this JSON file")
+	args = parser.parse_args()
+
+	scope = None
+	if args.scope_id:
+		scope = GpUnit(id=args.scope_id, name=args.scope_name or args.scope_id, gp_type=ReportingUnitType(args.scope_type))
+
+	metrics = Metrics() if args.metrics else NULL_METRICS
+	try:
+		try:
+			with open_output(args.output) as out:
+				count = merge_reports(args.reports, out, None if args.no_indent else '  ', scope, not args.no_check_ids, args.workers,
+					metrics=metrics, memory_budget=args.memory << 20, tmpdir=args.tmpdir)
+		except BaseException:
+			# a duplicate CVR can turn up halfway through, so don't leave the half-written report behind
+			if args.output != '-' and os.path.exists(args.output):
+				os.remove(args.output)
+			raise
+	except MergeConflict as e:
+		print('Cannot merge: {}'.format(e), file=sys.stderr)
+		exit(1)
+	print('Merged {} CVRs from {} reports'.format(count, len(args.reports)), file=sys.stderr)
+
+	if args.metrics:
+		with open(args.metrics, 'w') as f:
+			metrics.dump(f)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,5 +1,11 @@
 from castvoterecords import Code, Candidate, Party, IdentifierType, CandidateContest, VoteVariation, CandidateSelection, ContestSelection, CVRContestSelection, CVRContest, CVRSnapshot, CVR, Election, GpUnit, ReportingUnitType, CastVoteRecordReport, ReportingDevice, BallotMeasureContest, BallotMeasureSelection
-from utils import prettify
+from utils import write_pretty, open_output
+
+import argparse
+
+parser = argparse.ArgumentParser(description='Write a small hand-built NIST CVR XML')
+parser.add_argument("--output", help="File to write the report to. Default is stdout", default="-")
+args = parser.parse_args()
 
 #
 # We'll build the CVR up from the bottom. First, we'll create the political parties that appear in this CVR
@@ -139,6 +145,7 @@ cvr380 = CVR(id = '_cvr_269380', election=fall18_wd9, cvr_snapshot = [CVRSnapsho
 fall18_wd9_cvr_report = CastVoteRecordReport(election=fall18_wd9, cvrs = [cvr377, cvr378, cvr379, cvr380], gp_unit = ward19, reporting_device = ward19_tabulator, parties = parties)
 fall18_xml = fall18_wd9_cvr_report.to_xml()
 
-print(prettify(fall18_xml))
+with open_output(args.output) as out:
+	write_pretty(fall18_xml, out)
 
 
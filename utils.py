@@ -1,11 +1,31 @@
-from xml.dom import minidom
-import xml.etree.ElementTree as ET
+import contextlib
+import sys
+
+from castvoterecords import element_to_string, write_xml, open_compressed
+from castvoterecords.serialize import XML_DECLARATION
 
 
-# a helper from https://pymotw.com/2/xml/etree/ElementTree/create.html
 def prettify(elem):
     """Return a pretty-printed XML string for the Element.
+
+    This used to round-trip through minidom; it now gives the same layout in
+    a single pass. For big documents use write_pretty() instead so the whole
+    string never has to exist at once.
+    """
+    return XML_DECLARATION + element_to_string(elem, indent="  ")
+
+
+def write_pretty(elem, f, indent="  "):
+    """Write the Element pretty-printed to the binary file object f."""
+    write_xml(f, elem, indent=indent)
+
+
+def open_output(path, level=None):
+    """Open path for binary writing, with '-' (or None) meaning stdout.
+
+    A path ending in .gz, .xz or .bz2 is compressed as it's written, on a
+    background thread, at the codec's compression level level.
     """
-    rough_string = ET.tostring(elem,'unicode')
-    reparsed = minidom.parseString(rough_string)
-    return reparsed.toprettyxml(indent="  ")
+    if path in (None, '-'):
+        return contextlib.nullcontext(sys.stdout.buffer)
+    return open_compressed(path, 'wb', level)
@@ -1,25 +1,212 @@
-import sys
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
 from lxml import etree
 
-data = sys.argv[1]
-xsd = sys.argv[2]
+from castvoterecords import ReportScanner, open_compressed
+from castvoterecords.scan import root_namespaces, standalone_fragment, fragment_unique_id
+
+XSD_NS = 'http://www.w3.org/2001/XMLSchema'
+
+
+def validate_document(data, xsd):
+	"""The original mode: parse the whole document and validate it in one go."""
+	schema = etree.XMLSchema(etree.parse(xsd))
+
+	try:
+		with open_compressed(data) as f:
+			parsed_data = etree.parse(f)
+
+	except etree.XMLSyntaxError as e:
+		print("XML parsing failed")
+		print(e.error_log)
+		return False
+
+	try:
+		schema.assertValid(parsed_data)
+		print('File is valid according to schema')
+		return True
+
+	except etree.DocumentInvalid as e:
+		print("Unable to validate doc according to schema")
+		print(e.error_log)
+		return False
+
+
+#
+# Streaming mode. Each <CVR> is validated on its own against the schema's CVR
+# type, and what's left of the report once the CVRs are taken out (the
+# "envelope") is validated against the whole schema. A lone CVR can't resolve
+# its ElectionId/ContestId/ContestSelectionId IDREFs, since they point into
+# the Election at the end of the report, so the CVR schema treats IDREFs as
+# plain names and we check them against the envelope's ObjectIds ourselves.
+#
+
+def cvr_schema(xsd):
+	"""The NIST schema with CVR declared as a root element and IDREFs loosened to names.
+
+	Also returns the local names of the elements that hold IDREFs.
+	"""
+	tree = etree.parse(xsd)
+	root = tree.getroot()
+	idref_elements = set()
+	for elem in root.iter('{%s}element' % XSD_NS):
+		if elem.get('type') == 'xsd:IDREF':
+			elem.set('type', 'xsd:NCName')
+			idref_elements.add(elem.get('name'))
+		elif elem.get('type') == 'xsd:IDREFS':
+			elem.set('type', 'xsd:NMTOKENS')
+			idref_elements.add(elem.get('name'))
+	root.insert(0, etree.Element('{%s}element' % XSD_NS, name='CVR', type='CVR'))
+	return etree.XMLSchema(tree), idref_elements
+
+
+def _local(tag):
+	return tag.rpartition('}')[2]
+
+
+class CVRValidator:
+	"""Validates single CVR fragments; made once per process."""
+
+	def __init__(self, xsd, namespaces, known_ids):
+		self.schema, self.idref_elements = cvr_schema(xsd)
+		self.namespaces = namespaces
+		self.known_ids = known_ids
+
+	def validate(self, fragment):
+		"""Return a list of error messages for one CVRFragment; empty if it's valid."""
+		try:
+			elem = etree.fromstring(standalone_fragment(fragment.data, self.namespaces))
+		except etree.XMLSyntaxError as e:
+			return ['XML parsing failed: {}'.format(e)]
+
+		errors = []
+		if not self.schema.validate(elem):
+			for error in self.schema.error_log:
+				# error lines are relative to the fragment
+				errors.append('line {}: {}'.format(fragment.line + error.line - 1, error.message))
+
+		# the IDREFs the schema couldn't check
+		local_ids = set(elem.xpath('.//@ObjectId'))
+		for child in elem.iter():
+			if not isinstance(child.tag, str) or _local(child.tag) not in self.idref_elements:
+				continue
+			for ref in (child.text or '').split():
+				if ref not in local_ids and ref not in self.known_ids:
+					errors.append('line {}: {} {!r} does not refer to any ObjectId in the report'.format(
+						fragment.line + child.sourceline - 1, _local(child.tag), ref))
+		return errors
+
+
+_worker_validator = None
+
+
+def _init_worker(xsd, namespaces, known_ids):
+	global _worker_validator
+	_worker_validator = CVRValidator(xsd, namespaces, known_ids)
+
+
+def _validate_chunk(fragments):
+	return [(fragment, _worker_validator.validate(fragment)) for fragment in fragments]
+
+
+def _envelope(data):
+	# a first scan, just for what's around the CVRs; it doesn't hold on to any of them
+	with open_compressed(data) as f:
+		scanner = ReportScanner(f)
+		for _ in scanner:
+			pass
+	return scanner
+
+
+def _chunks(iterable, size):
+	iterable = iter(iterable)
+	while True:
+		chunk = list(islice(iterable, size))
+		if not chunk:
+			return
+		yield chunk
+
+
+def validate_streaming(data, xsd, workers=1, chunk_size=500, max_errors=100):
+	"""Validate the envelope, then each CVR as it streams past. Returns True if everything is valid."""
+	scanner = _envelope(data)
+	valid = True
+	try:
+		envelope = etree.fromstring(scanner.envelope())
+	except etree.XMLSyntaxError as e:
+		print("XML parsing failed outside the CVRs")
+		print(e.error_log)
+		return False
+
+	schema = etree.XMLSchema(etree.parse(xsd))
+	if not schema.validate(envelope):
+		valid = False
+		print("Report (without its CVRs) is not valid according to schema")
+		print(schema.error_log)
+
+	namespaces = root_namespaces(scanner.head)
+	known_ids = frozenset(envelope.xpath('//@ObjectId'))
+
+	error_count = 0
+	cvr_count = 0
+	with open_compressed(data) as f:
+		fragments = ReportScanner(f)
+		if workers > 1:
+			results = _parallel_results(fragments, xsd, namespaces, known_ids, workers, chunk_size)
+		else:
+			validator = CVRValidator(xsd, namespaces, known_ids)
+			results = ((fragment, validator.validate(fragment)) for fragment in fragments)
+
+		for fragment, errors in results:
+			cvr_count += 1
+			if not errors:
+				continue
+			valid = False
+			error_count += 1
+			if error_count <= max_errors:
+				print('CVR {} at byte {} is not valid:'.format(fragment_unique_id(fragment.data), fragment.offset))
+				for error in errors:
+					print('  ' + error)
+
+	if error_count > max_errors:
+		print('... and {} more invalid CVRs'.format(error_count - max_errors))
+	if valid:
+		print('File is valid according to schema ({} CVRs checked one at a time)'.format(cvr_count))
+	else:
+		print('{} of {} CVRs are invalid'.format(error_count, cvr_count))
+	return valid
+
+
+def _parallel_results(fragments, xsd, namespaces, known_ids, workers, chunk_size):
+	with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(xsd, namespaces, known_ids)) as executor:
+		pending = deque()
+		for chunk in _chunks(fragments, chunk_size):
+			pending.append(executor.submit(_validate_chunk, chunk))
+			if len(pending) >= workers * 2:
+				yield from pending.popleft().result()
+		while pending:
+			yield from pending.popleft().result()
 
-parsed_xsd = etree.parse(xsd)
-schema = etree.XMLSchema(parsed_xsd)
 
-try:
-	parsed_data = etree.parse(data)
+def main():
+	parser = argparse.ArgumentParser(description='Validate a NIST CVR XML report against the XSD')
+	parser.add_argument("data", help="The report to validate, which can be compressed (.gz, .xz or .bz2)")
+	parser.add_argument("xsd", help="The schema, e.g. NIST_V0_cast_vote_records.xsd")
+	parser.add_argument("--stream", help="Validate one CVR at a time instead of loading the whole document", action="store_true")
+	parser.add_argument("--workers", help="With --stream, validate CVRs in this many processes. Default is 1", type=int, default=1)
+	parser.add_argument("--chunk-size", help="CVRs handed to a worker process at a time. Default is 500", type=int, default=500)
+	parser.add_argument("--max-errors", help="Stop printing details after this many invalid CVRs. Default is 100", type=int, default=100)
+	args = parser.parse_args()
 
-except etree.XMLSyntaxError as e:
-	print("XML parsing failed")
-	print(e.error_log)
-	exit()
+	if args.stream:
+		valid = validate_streaming(args.data, args.xsd, args.workers, args.chunk_size, args.max_errors)
+	else:
+		valid = validate_document(args.data, args.xsd)
+	exit(0 if valid else 1)
 
-try:
-	schema.assertValid(parsed_data)
-	print('File is valid according to schema')
-	exit()
 
-except etree.DocumentInvalid as e:
-	print("Unable to validate doc according to schema")
-	print(e.error_log)
+if __name__ == '__main__':
+	main()